@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+"""
+Compare per task latency of creating a dns alias when a new route53
+client is built for every task against reusing a pooled client.
+
+Requests are sent to a local stub of the route53 api so the numbers
+reflect client construction and connection setup, not AWS. The stub
+speaks plain http, so the cost of a TLS handshake, which the pool also
+saves in production, is not included.
+
+    python benchmarks/dns_client_pool.py --tasks 200
+"""
+
+import argparse
+import os
+import statistics
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+
+import boto3
+
+from nti.environments.management.aws import AWSClientPool
+
+_HOSTED_ZONE = 'Z123'
+
+_CHANGE_RESPONSE = b"""<?xml version="1.0" encoding="UTF-8"?>
+<ChangeResourceRecordSetsResponse xmlns="https://route53.amazonaws.com/doc/2013-04-01/">
+  <ChangeInfo>
+    <Id>/change/C1</Id>
+    <Status>PENDING</Status>
+    <SubmittedAt>2020-01-01T00:00:00.000Z</SubmittedAt>
+  </ChangeInfo>
+</ChangeResourceRecordSetsResponse>"""
+
+
+class _Route53Stub(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are separate writes, don't let them sit behind
+    # a delayed ack on a kept-alive connection.
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(_CHANGE_RESPONSE)))
+        self.end_headers()
+        self.wfile.write(_CHANGE_RESPONSE)
+
+    def log_message(self, *args):
+        pass
+
+
+def _change(client, dns_name):
+    client.change_resource_record_sets(
+        HostedZoneId=_HOSTED_ZONE,
+        ChangeBatch={'Changes': [{'Action': 'CREATE',
+                                  'ResourceRecordSet': {'Name': dns_name,
+                                                        'Type': 'A',
+                                                        'AliasTarget': {'HostedZoneId': _HOSTED_ZONE,
+                                                                        'DNSName': 'spin.nextthot.com',
+                                                                        'EvaluateTargetHealth': False}}}]})
+
+
+def _run(label, tasks, do_task):
+    timings = []
+    for i in range(tasks):
+        start = time.perf_counter()
+        do_task('site%i.nextthot.com' % i)
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    print('%-10s mean %7.2fms  p50 %7.2fms  p95 %7.2fms' % (label,
+                                                           statistics.mean(timings),
+                                                           timings[len(timings) // 2],
+                                                           timings[int(len(timings) * .95)]))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tasks', type=int, default=100)
+    args = parser.parse_args()
+
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _Route53Stub)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    endpoint = 'http://127.0.0.1:%i' % server.server_address[1]
+
+    def _new_client(service_name):
+        return boto3.session.Session().client(service_name, endpoint_url=endpoint)
+
+    def _unpooled(dns_name):
+        # What DNSAliasAdder did before: a fresh client every task
+        _change(boto3.client('route53', endpoint_url=endpoint), dns_name)
+
+    pool = AWSClientPool(_new_client)
+    def _pooled(dns_name):
+        pool.invoke('route53', _change, dns_name)
+
+    _run('unpooled', args.tasks, _unpooled)
+    _run('pooled', args.tasks, _pooled)
+
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+"""
+Compare the per task cost of our celery signal handlers' statsd
+metrics sent a packet per metric, as perfmetrics does, against a
+BufferedStatsdClient, with a local UDP socket standing in for statsd.
+
+    python benchmarks/statsd_emission.py --tasks 20000 --packet-size 1400
+"""
+
+import argparse
+import socket
+import threading
+import time
+import uuid
+
+from perfmetrics import set_statsd_client
+
+from perfmetrics.statsd import StatsdClient
+
+from nti.environments.management.celery import PUBLISHED_AT_HEADER
+from nti.environments.management.celery import task_postrun_handler
+from nti.environments.management.celery import task_prerun_handler
+from nti.environments.management.celery import task_success_handler
+
+from nti.environments.management.metrics import BufferedStatsdClient
+
+
+class _Request(object):
+    eta = None
+
+
+class _Task(object):
+    name = 'nti.environments.management.tasks.SetupEnvironmentTask'
+
+    def __init__(self):
+        self.request = _Request()
+        setattr(self.request, PUBLISHED_AT_HEADER, time.time())
+
+
+class _Sink(object):
+    """
+    Counts the packets and metrics that arrive on a local UDP socket.
+    """
+
+    def __init__(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.settimeout(0.5)
+        self.port = self.sock.getsockname()[1]
+        self.packets = 0
+        self.metrics = 0
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                data = self.sock.recv(65536)
+            except socket.timeout:
+                continue
+            except OSError:
+                return
+            self.packets += 1
+            self.metrics += data.count(b'\n') + 1
+
+    def wait(self, metrics, timeout=5):
+        deadline = time.time() + timeout
+        while self.metrics < metrics and time.time() < deadline:
+            time.sleep(0.01)
+
+    def close(self):
+        self.sock.close()
+
+
+def _run_tasks(tasks):
+    task = _Task()
+    start = time.perf_counter()
+    for _ in range(tasks):
+        task_id = str(uuid.uuid4())
+        task_prerun_handler(task_id, task)
+        task_success_handler(task)
+        task_postrun_handler(task_id, task)
+    return time.perf_counter() - start
+
+
+def _run(label, client, sink, tasks):
+    set_statsd_client(client)
+    try:
+        elapsed = _run_tasks(tasks)
+        if isinstance(client, BufferedStatsdClient):
+            client.flush()
+    finally:
+        set_statsd_client(None)
+
+    # prerun, queue_wait, success, runtime and postrun
+    sink.wait(tasks * 5)
+    print('  %-28s %6.2fus/task  %6i packets  %6i metrics received' % (label,
+                                                                      elapsed / tasks * 1e6,
+                                                                      sink.packets,
+                                                                      sink.metrics))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tasks', type=int, default=10000)
+    parser.add_argument('--packet-size', type=int, default=1400)
+    args = parser.parse_args()
+
+    # Warm up the timers, histograms and caches
+    _run_tasks(100)
+
+    sink = _Sink()
+    _run('packet per metric', StatsdClient('127.0.0.1', sink.port), sink, args.tasks)
+    sink.close()
+
+    sink = _Sink()
+    buffered = BufferedStatsdClient(StatsdClient('127.0.0.1', sink.port),
+                                    packet_size=args.packet_size)
+    _run('buffered (%i bytes)' % args.packet_size, buffered, sink, args.tasks)
+    buffered.close()
+    sink.close()
+
+
+if __name__ == '__main__':
+    main()
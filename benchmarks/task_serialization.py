@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+"""
+Compare the size and encode/decode cost of setup task messages and
+results using pickle, which we have always used, against the compact
+nti-msgpack serializer.
+
+The payloads mirror a real setup: the group results and SiteInfo handed
+to the join task, and the finished SiteInfo returned by finalize.
+
+    python benchmarks/task_serialization.py --iterations 20000
+"""
+
+import argparse
+import datetime
+import time
+
+from kombu.serialization import dumps
+from kombu.serialization import loads
+
+from nti.environments.management.serialization import SERIALIZER
+from nti.environments.management.serialization import register_serializer
+from nti.environments.management.tasks import SiteInfo
+
+
+def _timings(host, **phases):
+    return {'host': host, 'started_at': time.time(), 'phases': phases}
+
+
+def _group_results():
+    return [{'timings': _timings('tier1', dns_alias=0.21)},
+            {'live': False, 'timings': _timings('tier1', backend_write=0.02)},
+            {'host_system': 'host3.nextthought.com',
+             'admin_invitation': '/dataserver2/@@accept-site-invitation?code=7Hd92kLw',
+             'admin_invitation_code': '7Hd92kLw',
+             'socket_verified': True,
+             'ds_site_id': 's1f2a3b4c5d6e7f8',
+             'peer_environments': ['S%032x' % i for i in range(12)],
+             'timings': _timings('host3', provision=41.7, socket_verify=3.2)}]
+
+
+def _site_info():
+    info = SiteInfo('S1f2a3b4c5d6e7f8a9b0c1d2e3f4a5b6', 'acme-university.nextthot.com')
+    info.start_time = datetime.datetime.utcnow()
+    return info
+
+
+def _finished_site_info():
+    info = _site_info()
+    info.task_result_dict = _group_results()[2]
+    info.ds_site_id = info.task_result_dict['ds_site_id']
+    info.reload_task = (('3b1c0f6e-8f57-4c3a-9d5e-1f2a3b4c5d6e', None), None)
+    info.reload_requested_at = time.time()
+    info.public_verified = True
+    info.phase_timings = {'dns_alias': 0.21, 'backend_write': 0.02, 'provision': 41.7,
+                          'socket_verify': 3.2, 'queue_wait.dns': 0.05,
+                          'queue_wait.haproxy': 10.1, 'queue_wait.provision': 0.4,
+                          'verify': 1.1, 'total': 47.9}
+    info.verify_attempts = (0.4, 0.7)
+    info.end_time = datetime.datetime.utcnow()
+    return info
+
+
+_PAYLOADS = {
+    # A celery protocol 2 body: (args, kwargs, embed)
+    'join message': lambda: ((_group_results(), _site_info()), {}, {'callbacks': None}),
+    'setup result': _finished_site_info,
+}
+
+
+def _run(serializer, payload, iterations):
+    content_type, encoding, data = dumps(payload, serializer=serializer)
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        dumps(payload, serializer=serializer)
+    encode = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        loads(data, content_type, encoding, accept=[content_type])
+    decode = time.perf_counter() - start
+
+    print('  %-12s %6i bytes  encode %6.2fus  decode %6.2fus' % (serializer,
+                                                                len(data),
+                                                                encode / iterations * 1e6,
+                                                                decode / iterations * 1e6))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--iterations', type=int, default=10000)
+    args = parser.parse_args()
+
+    register_serializer()
+
+    for name, factory in _PAYLOADS.items():
+        print(name)
+        payload = factory()
+        for serializer in ('pickle', SERIALIZER):
+            _run(serializer, payload, args.iterations)
+
+
+if __name__ == '__main__':
+    main()
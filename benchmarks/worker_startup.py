@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+"""
+Measure worker startup, i.e. importing nti.environments.management.worker
+and configuring its app, and how finding the task classes to route and
+bind scales with the number of adapters registered.
+
+Each run is a fresh interpreter. `--extra` registers that many unrelated
+adapters, standing in for a larger application, before the worker is
+configured. Startup includes the single search of the adapter
+registrations for tasks registered without the task directive. The
+legacy figure searches every adapter registration, as routing and
+binding each did before the task directive, and is counted twice
+because startup did it twice. The indexed figure reads the task
+directive's index, as routing and binding now do.
+
+    python benchmarks/worker_startup.py --runs 10 --extra 0 5000
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+_CONFIG = os.path.join(_HERE, '..', 'example.ini')
+
+
+def _legacy_bindable_tasks(registry):
+    from nti.environments.management.interfaces import IApplicationTask
+    for adapter in registry.registeredAdapters():
+        if adapter.provided.isOrExtends(IApplicationTask) \
+           and getattr(adapter.factory, 'bind', None):
+            yield adapter.factory
+
+
+def _child(extra):
+    from zope import component
+    from zope import interface
+
+    class IExtra(interface.Interface):
+        pass
+
+    registry = component.getGlobalSiteManager()
+    for i in range(extra):
+        registry.registerAdapter(lambda context: None, (interface.Interface,), IExtra, name='extra%i' % i)
+
+    start = time.perf_counter()
+    from nti.environments.management.worker import get_app
+    get_app()
+    startup = time.perf_counter() - start
+
+    from nti.environments.management.celery import _bindable_tasks
+
+    start = time.perf_counter()
+    for _ in range(2):
+        list(_legacy_bindable_tasks(registry))
+    legacy = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(2):
+        _bindable_tasks()
+    indexed = time.perf_counter() - start
+
+    json.dump({'startup': startup, 'legacy': legacy, 'indexed': indexed}, sys.stdout)
+
+
+def _ms(values):
+    return '%8.2fms' % (statistics.median(values) * 1000)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--extra', type=int, nargs='+', default=[0, 1000, 10000])
+    parser.add_argument('--child', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        _child(args.child)
+        return
+
+    env = dict(os.environ)
+    env.setdefault('NTI_MANAGEMENT_CONFIG', _CONFIG)
+
+    print('%8s %10s %10s %10s' % ('extra', 'startup', 'legacy', 'indexed'))
+    for extra in args.extra:
+        runs = []
+        for _ in range(args.runs):
+            out = subprocess.check_output([sys.executable, __file__, '--child', str(extra)], env=env)
+            runs.append(json.loads(out))
+        print('%8i %s %s %s' % (extra,
+                                _ms([r['startup'] for r in runs]),
+                                _ms([r['legacy'] for r in runs]),
+                                _ms([r['indexed'] for r in runs])))
+
+
+if __name__ == '__main__':
+    main()
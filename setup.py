@@ -19,8 +19,10 @@ requires = [
     'zope.security',
     'dnspython',
     'requests',
+    'aiohttp',
     'nti.tools.aws @ git+ssh://git@github.com/OpenNTI/nti.tools.aws',
-    'perfmetrics'
+    'perfmetrics',
+    'msgpack'
 ]
 
 tests_require = [
@@ -61,6 +63,10 @@ setup(
     },
     install_requires=requires,
     entry_points={
+        'console_scripts': [
+            'nti_environments_bulk_setup = nti.environments.management.bulk:main',
+            'nti_environments_collapse_profiles = nti.environments.management.profiling:main',
+        ],
     },
     scripts=[
         'bin/mocks/nti_environments_management_mock_init'
@@ -0,0 +1,89 @@
+"""
+Process lifetime management of boto3 clients.
+"""
+
+import os
+import threading
+
+import boto3
+
+from botocore.exceptions import ClientError
+
+logger = __import__('logging').getLogger(__name__)
+
+#: Error codes AWS returns when the credentials a client was built with
+#: are no longer valid.
+_EXPIRED_CREDENTIAL_CODES = frozenset(('ExpiredToken',
+                                       'ExpiredTokenException',
+                                       'RequestExpired',
+                                       'TokenRefreshRequired'))
+
+def _new_client(service_name):
+    # Sessions are not thread safe, so each client gets its own
+    return boto3.session.Session().client(service_name)
+
+def is_expired_credentials_error(e):
+    return isinstance(e, ClientError) \
+        and e.response.get('Error', {}).get('Code') in _EXPIRED_CREDENTIAL_CODES
+
+class AWSClientPool(object):
+    """
+    Lazily creates boto3 clients, one per service, and reuses them for
+    the lifetime of the process. Building a client resolves credentials,
+    loads the endpoint and service models and, on first use, establishes
+    a new TLS connection, none of which we want to pay for on every task.
+
+    boto3 clients are thread safe, but they must not be shared across a
+    fork. If we notice we are in a different process than the one that
+    created the clients we throw them away and start over.
+    """
+
+    def __init__(self, client_factory=_new_client):
+        self.client_factory = client_factory
+        self._lock = threading.Lock()
+        self._clients = {}
+        self._pid = os.getpid()
+
+    def client(self, service_name):
+        """
+        Return the client for service_name, creating it if necessary.
+        """
+        with self._lock:
+            if self._pid != os.getpid():
+                logger.debug('Discarding aws clients inherited across a fork')
+                self._clients = {}
+                self._pid = os.getpid()
+
+            try:
+                return self._clients[service_name]
+            except KeyError:
+                logger.debug('Creating %s client for process %i', service_name, self._pid)
+                client = self._clients[service_name] = self.client_factory(service_name)
+                return client
+
+    def discard(self, service_name):
+        """
+        Forget the client for service_name so the next request rebuilds it.
+        """
+        with self._lock:
+            self._clients.pop(service_name, None)
+
+    def reset(self):
+        with self._lock:
+            self._clients = {}
+
+    def invoke(self, service_name, func, *args, **kwargs):
+        """
+        Call `func(client, *args, **kwargs)` with the pooled client
+        for service_name. If AWS tells us our credentials have expired
+        the client is rebuilt, picking up fresh credentials, and the call
+        is made one more time.
+        """
+        try:
+            return func(self.client(service_name), *args, **kwargs)
+        except ClientError as e:
+            if not is_expired_credentials_error(e):
+                raise
+            logger.info('Credentials for %s client expired. Rebuilding client', service_name)
+            self.discard(service_name)
+        return func(self.client(service_name), *args, **kwargs)
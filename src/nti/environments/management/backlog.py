@@ -0,0 +1,140 @@
+"""
+Sampling of the depth of our queues and the age of the oldest message
+waiting in each.
+"""
+
+import threading
+import time
+
+from kombu.utils.json import loads
+
+from perfmetrics import statsd_client
+
+from .celery import PUBLISHED_AT_HEADER
+
+from .timing import _metric_safe
+
+logger = __import__('logging').getLogger(__name__)
+
+
+def _headers(message):
+    if isinstance(message, (bytes, str)):
+        message = loads(message)
+    return message.get('headers') or {}
+
+
+def _peek_memory(channel, queue):
+    waiting = channel._queue_for(queue).queue
+    return [waiting[0]] if waiting else []
+
+
+def _peek_redis(channel, queue):
+    # Messages are pushed on the left and popped from the right,
+    # with a list per priority.
+    client = channel.client
+    return [message for message in (client.lindex(channel._q_for_pri(queue, pri), -1)
+                                    for pri in channel.priority_steps)
+            if message is not None]
+
+
+#: How to peek at the oldest message(s) of a queue without consuming
+#: it, by the module of the transport's channel. Other transports only
+#: report their depth.
+_PEEKERS = {
+    'kombu.transport.memory': _peek_memory,
+    'kombu.transport.redis': _peek_redis,
+}
+
+
+def oldest_published_at(channel, queue):
+    """
+    The time the oldest message in queue was published, or None if
+    the queue is empty, the transport can't tell us, or the message
+    wasn't stamped when published.
+    """
+    peek = _PEEKERS.get(type(channel).__module__)
+    if peek is None:
+        return None
+
+    stamps = [_headers(message).get(PUBLISHED_AT_HEADER) for message in peek(channel, queue)]
+    stamps = [stamp for stamp in stamps if stamp is not None]
+    return min(stamps) if stamps else None
+
+
+class BacklogSampler(object):
+    """
+    Periodically emits, for each of the app's task queues, the number
+    of messages waiting as the gauge `celery.queue.<queue>.depth` and
+    the age in seconds of the oldest of them as
+    `celery.queue.<queue>.oldest_age`.
+    """
+
+    def __init__(self, app, interval):
+        self.app = app
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _queue_names(self):
+        return [queue.name for queue in self.app.conf.task_queues or ()]
+
+    def sample(self):
+        """
+        Sample every queue once, returning a dict of queue name to
+        `(depth, oldest_age)`. oldest_age is None if it isn't known.
+        """
+        samples = {}
+        now = time.time()
+        with self.app.connection_for_read() as connection:
+            channel = connection.default_channel
+            for name in self._queue_names():
+                try:
+                    depth = channel.queue_declare(queue=name, passive=True).message_count
+                    published_at = oldest_published_at(channel, name) if depth else None
+                except Exception: # pylint: disable=broad-except
+                    logger.exception('Unable to sample queue %s', name)
+                    continue
+                oldest_age = max(now - published_at, 0) if published_at is not None else None
+                samples[name] = (depth, oldest_age)
+
+        self._emit(samples)
+        return samples
+
+    def _emit(self, samples):
+        statsd = statsd_client()
+        if statsd is None:
+            return
+
+        for name, (depth, oldest_age) in samples.items():
+            prefix = 'celery.queue.%s' % _metric_safe(name)
+            statsd.gauge('%s.depth' % prefix, depth)
+            statsd.gauge('%s.oldest_age' % prefix, oldest_age or 0)
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.sample()
+            except Exception: # pylint: disable=broad-except
+                logger.exception('Unable to sample queue backlog')
+
+    def start(self):
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name='backlog-sampler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+def backlog_sampler(app, settings):
+    """
+    Returns a BacklogSampler for app if `[monitoring] backlog_interval`
+    is set, otherwise None.
+    """
+    interval = settings.getfloat('monitoring', 'backlog_interval', fallback=0)
+    if interval <= 0:
+        return None
+    return BacklogSampler(app, interval)
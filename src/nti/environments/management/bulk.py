@@ -0,0 +1,300 @@
+"""
+Setting up environments in bulk.
+
+Site specs are read from a CSV file with a header row, or from JSON
+lines, each with the fields of `SiteSpec`. Each site goes through the
+same tasks as ISetupEnvironmentTask, but the number of sites in each
+stage at once is limited per stage, results are reported as each site
+finishes, and finished sites are recorded in a checkpoint file so an
+interrupted run can be resumed.
+"""
+
+import argparse
+import csv
+import datetime
+import json
+import os
+import sys
+import threading
+
+from collections import namedtuple
+
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+
+from celery import chain
+
+from .interfaces import ISetupEnvironmentTask
+
+from .tasks import SiteInfo
+from .tasks import verify_setup_site
+
+logger = __import__('logging').getLogger(__name__)
+
+#: The fields describing a site to set up
+SiteSpec = namedtuple('SiteSpec', ('site_id', 'site_name', 'dns_name', 'name', 'email'))
+
+#: A row of the input, by line number, that doesn't describe a site
+InvalidSiteSpec = namedtuple('InvalidSiteSpec', ('line', 'site_id', 'error'))
+
+#: The stages of a setup, in the order of ISetupEnvironmentTask.stage_signatures
+STAGES = ('dns', 'haproxy', 'provision')
+
+_DEFAULT_LIMITS = {'dns': 10, 'haproxy': 10, 'provision': 5}
+_DEFAULT_MAX_SITES = 20
+
+STATUS_OK = 'ok'
+STATUS_ERROR = 'error'
+
+
+def read_site_specs(stream, format=None):
+    """
+    Yield a SiteSpec for each site described in stream. format is
+    'csv' or 'jsonl'. If it isn't given we guess from the first line.
+
+    A row that doesn't describe a site yields an InvalidSiteSpec rather
+    than raising, so the sites already started from earlier rows carry
+    on and are recorded.
+    """
+    if format is None:
+        first = stream.readline()
+        format = 'jsonl' if first.lstrip().startswith('{') else 'csv'
+        lines = _prepend(first, stream)
+    else:
+        lines = stream
+
+    if format == 'csv':
+        rows = _csv_rows(lines)
+    elif format == 'jsonl':
+        rows = _jsonl_rows(lines)
+    else:
+        raise ValueError('Unknown site spec format %s' % format)
+
+    for line, row in rows:
+        if isinstance(row, Exception):
+            yield InvalidSiteSpec(line, None, 'Unreadable site spec. %s' % row)
+            continue
+        try:
+            yield SiteSpec(**{field: row[field].strip() for field in SiteSpec._fields})
+        except (KeyError, AttributeError, TypeError) as e:
+            site_id = row.get('site_id') if isinstance(row, dict) else None
+            yield InvalidSiteSpec(line, site_id, 'Invalid site spec %r. Missing %s' % (row, e))
+
+
+def _csv_rows(lines):
+    reader = csv.DictReader(lines)
+    while True:
+        try:
+            row = next(reader)
+        except StopIteration:
+            return
+        except csv.Error as e:
+            yield reader.line_num, e
+            continue
+        yield reader.line_num, row
+
+
+def _jsonl_rows(lines):
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            yield number, json.loads(line)
+        except ValueError as e:
+            yield number, e
+
+
+def _prepend(line, stream):
+    yield line
+    yield from stream
+
+
+class Checkpoint(object):
+    """
+    An append only record, in JSON lines, of the sites that have been
+    set up. Sites that failed are recorded too, but only successes are
+    skipped when resuming.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.completed = set()
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        result = json.loads(line)
+                    except ValueError:
+                        # A line torn by the interruption we are resuming from
+                        continue
+                    if result.get('status') == STATUS_OK:
+                        self.completed.add(result['site_id'])
+
+    def __contains__(self, site_id):
+        return site_id in self.completed
+
+    def record(self, result):
+        with self._lock:
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(result) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            if result['status'] == STATUS_OK:
+                self.completed.add(result['site_id'])
+
+
+class BulkSetup(object):
+    """
+    Sets up many environments, at most `max_sites` at a time and at
+    most `limits[stage]` sites in each of the STAGES at once.
+
+    `verify_site` and `timeout`, in seconds, apply to each site.
+    """
+
+    def __init__(self, app, limits=None, max_sites=_DEFAULT_MAX_SITES,
+                 checkpoint=None, verify_site=True, timeout=None, setup=None):
+        self.app = app
+        self.setup = setup if setup is not None else ISetupEnvironmentTask(app)
+        limits = dict(_DEFAULT_LIMITS, **(limits or {}))
+        self.limits = {stage: threading.BoundedSemaphore(limits[stage]) for stage in STAGES}
+        self.max_sites = max_sites
+        self.checkpoint = checkpoint
+        self.verify_site = verify_site
+        self.timeout = timeout
+
+    def run(self, specs):
+        """
+        Set up the sites in specs, yielding a result dict for each as it
+        finishes. Sites already completed according to the checkpoint
+        are skipped. specs is consumed as sites are started, so it may
+        be a stream.
+        """
+        with ThreadPoolExecutor(max_workers=self.max_sites, thread_name_prefix='bulk-setup') as pool:
+            pending = set()
+            try:
+                for spec in specs:
+                    if isinstance(spec, InvalidSiteSpec):
+                        yield self._record({'site_id': spec.site_id,
+                                            'line': spec.line,
+                                            'status': STATUS_ERROR,
+                                            'error': spec.error})
+                        continue
+
+                    if self.checkpoint is not None and spec.site_id in self.checkpoint:
+                        logger.info('Skipping site %s completed by a previous run', spec.site_id)
+                        continue
+
+                    pending.add(pool.submit(self._setup_site, spec))
+                    if len(pending) >= self.max_sites:
+                        finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        yield from self._finished(finished)
+
+                while pending:
+                    finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    yield from self._finished(finished)
+            finally:
+                # However we are leaving, be it an error reading specs,
+                # an interrupt or our caller closing us, the pool sees
+                # the sites already started through. Record them so a
+                # resumed run doesn't set them up again.
+                if pending:
+                    finished, _ = wait(pending)
+                    for future in finished:
+                        self._record(future.result())
+
+    def _record(self, result):
+        if self.checkpoint is not None:
+            self.checkpoint.record(result)
+        return result
+
+    def _finished(self, futures):
+        # Record them all before handing any back, our caller may stop
+        # at the first
+        results = [self._record(future.result()) for future in futures]
+        yield from results
+
+    def _run_stages(self, spec):
+        signatures = self.setup.stage_signatures(*spec)
+        dispatched = []
+        try:
+            for stage, signature in zip(STAGES, signatures):
+                self.limits[stage].acquire()
+                try:
+                    dispatched.append((stage, signature.apply_async()))
+                except BaseException:
+                    self.limits[stage].release()
+                    raise
+
+            group_result = []
+            while dispatched:
+                stage, async_result = dispatched[0]
+                group_result.append(async_result.get(timeout=self.timeout))
+                dispatched.pop(0)
+                self.limits[stage].release()
+            return group_result
+        finally:
+            # We are giving up on the stages we haven't heard from
+            for stage, _ in dispatched:
+                self.limits[stage].release()
+
+    def _setup_site(self, spec):
+        info = SiteInfo(spec.site_id, spec.dns_name.lower())
+        info.start_time = datetime.datetime.utcnow()
+        result = {'site_id': spec.site_id, 'dns_name': info.dns_name}
+        try:
+            group_result = self._run_stages(spec)
+            steps = self.setup.pipeline_signatures({verify_setup_site.__name__: {'verify_site': self.verify_site}})
+            info = chain(self.setup.join_task.s(group_result, info), *steps)().get(timeout=self.timeout)
+        except Exception as e: # pylint: disable=broad-except
+            logger.exception('Setup of site %s failed', spec.site_id)
+            result.update(status=STATUS_ERROR, error='%s: %s' % (type(e).__name__, e))
+            return result
+
+        result.update(status=STATUS_OK,
+                      ds_site_id=info.ds_site_id,
+                      host=info.host,
+                      admin_invitation=info.admin_invitation,
+                      elapsed=info.elapsed_time,
+                      phase_timings=info.phase_timings)
+        return result
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Set up environments in bulk')
+    parser.add_argument('input', nargs='?', default='-',
+                        help='A CSV or JSON lines file of site specs, or - for stdin')
+    parser.add_argument('--format', choices=('csv', 'jsonl'))
+    parser.add_argument('--checkpoint',
+                        help='Record finished sites here, and skip those already set up')
+    parser.add_argument('--sites', type=int, default=_DEFAULT_MAX_SITES,
+                        help='How many sites to set up at once')
+    for stage in STAGES:
+        parser.add_argument('--%s-concurrency' % stage, type=int, default=_DEFAULT_LIMITS[stage],
+                            help='How many sites may be in the %s stage at once' % stage)
+    parser.add_argument('--timeout', type=float,
+                        help='Seconds to wait for each stage of a site')
+    parser.add_argument('--no-verify', action='store_true')
+    args = parser.parse_args(args)
+
+    from .worker import get_app
+
+    bulk = BulkSetup(get_app(),
+                     limits={stage: getattr(args, '%s_concurrency' % stage) for stage in STAGES},
+                     max_sites=args.sites,
+                     checkpoint=Checkpoint(args.checkpoint) if args.checkpoint else None,
+                     verify_site=not args.no_verify,
+                     timeout=args.timeout)
+
+    stream = sys.stdin if args.input == '-' else open(args.input, newline='')
+    failures = 0
+    with stream:
+        for result in bulk.run(read_site_specs(stream, args.format)):
+            failures += result['status'] != STATUS_OK
+            print(json.dumps(result), flush=True)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
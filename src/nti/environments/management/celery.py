@@ -26,6 +26,7 @@ from celery import Celery as _Celery
 from celery import Task as _Task
 from celery._state import connect_on_app_finalize
 
+from celery.signals import before_task_publish
 from celery.signals import task_failure
 from celery.signals import task_postrun
 from celery.signals import task_prerun
@@ -35,6 +36,8 @@ from kombu import binding
 from kombu import Exchange
 from kombu import Queue
 
+import datetime
+
 import functools
 
 import random
@@ -43,8 +46,6 @@ from perfmetrics import statsd_client
 
 import time
 
-import threading
-
 from zope.component.hooks import setHooks
 
 from zope.configuration import config
@@ -52,12 +53,22 @@ from zope.configuration import xmlconfig
 
 from zope.dottedname import resolve as dottedname
 
-from zope.component import getGlobalSiteManager
-
 from zope import interface
 
 from .interfaces import ICeleryApp
-from .interfaces import IApplicationTask
+
+from .latency import TimerStore
+from .latency import histograms
+
+from .profiling import start_profiling
+from .profiling import stop_profiling
+
+from .prometheus import metrics_registry
+
+from .serialization import SERIALIZER
+from .serialization import register_serializer
+
+from .zcml import task_factories
 
 logger = __import__('logging').getLogger(__name__)
 
@@ -71,6 +82,14 @@ celery.app.backends.BACKEND_ALIASES[
 # We need to register that the sqs:// url scheme uses a netloc
 urlparse.uses_netloc.append("sqs")
 
+register_serializer()
+
+#: The serializer used for task messages and results unless
+#: `celery.serializer` says otherwise. Workers and clients must be
+#: able to decode each other's messages, so any of these are accepted
+#: regardless of which one is used.
+DEFAULT_SERIALIZER = 'pickle'
+
 class TLSRedisBackend(celery.backends.redis.RedisBackend):
     """
     A version of the redis backend supporting TLS
@@ -192,15 +211,18 @@ def configure_celery(name='nti.environments.management', settings=None, loader=N
         if "region" in parsed_query:
             broker_transport_options["region"] = parsed_query["region"][0]
 
+    serializer = settings.get("celery.serializer") or DEFAULT_SERIALIZER
+
     app = Celery(name, autofinalize=False, set_as_current=False)
 
     app.conf.update(
-        accept_content=["json", "msgpack", "pickle"],
+        accept_content=["json", "msgpack", "pickle", SERIALIZER],
+        result_accept_content=["json", "msgpack", "pickle", SERIALIZER],
         broker_url=broker_url,
         broker_transport_options=broker_transport_options,
         result_backend=settings["celery.backend_url"],
-        task_serializer="pickle",
-        results_serializer="pickle",
+        task_serializer=serializer,
+        result_serializer=serializer,
         worker_disable_rate_limits=True
     )
     
@@ -210,71 +232,120 @@ def configure_celery(name='nti.environments.management', settings=None, loader=N
     
     return app
 
-def _bindable_tasks(registry=None):
+def _bindable_tasks():
     """
-    Look for any adapter registration that implements IApplicationTask
-    This is probably really slow, but it allows us to not have to switch the
-    mocks in and out here, we rely on the zcml implementations
+    The IApplicationTask factories recorded by the task zcml directive,
+    or by `record_adapter_tasks`, that know how to bind themselves to
+    an app.
     """
-    if registry is None:
-        registry = getGlobalSiteManager()
-
-    for adapter in registry.registeredAdapters():
-        if adapter.provided.isOrExtends(IApplicationTask) \
-           and getattr(adapter.factory, 'bind', None):
-            yield adapter.factory
+    return [factory for factory in task_factories()
+            if getattr(factory, 'bind', None)]
 
-_metric_state = threading.local()
+_timers = TimerStore()
 
 def _start_timer(timer_name, task_name, task_id):
     """
     Starts and tracks a timer with the given name for the given task name and instance id.
+    Returns how many timers that were never stopped were evicted.
     """
-    try:
-        _metric_state.timers[(timer_name, task_name, task_id)] = time.time()
-    except AttributeError:
-        _metric_state.timers = {(timer_name, task_name, task_id): time.time()}
+    return _timers.start((timer_name, task_name, task_id))
 
 def _stop_timer(timer_name, task_name, task_id):
     """
     Stops the timer and returns the elapsed time in seconds.
     If the timer had not yet been started this function returns None.
     """
-    started = None
-    try:
-        started = _metric_state.timers.pop((timer_name, task_name, task_id))
-    except (AttributeError, KeyError):
+    return _timers.stop((timer_name, task_name, task_id))
+
+#: The message header we stamp with the time a task was published
+PUBLISHED_AT_HEADER = 'nti_published_at'
+
+@before_task_publish.connect
+def task_publish_handler(headers=None, **kwargs):
+    # Stamped on every publish, so a retry's wait starts from the retry
+    if headers is not None:
+        headers[PUBLISHED_AT_HEADER] = time.time()
+
+def _queue_wait(request):
+    """
+    The seconds the task described by request waited to start, or None
+    if it wasn't stamped when it was published. Time spent waiting for
+    an eta or countdown doesn't count.
+    """
+    published_at = getattr(request, PUBLISHED_AT_HEADER, None)
+    if published_at is None:
         return None
 
-    return time.time() - started
+    eta = getattr(request, 'eta', None)
+    if eta:
+        if isinstance(eta, str):
+            eta = datetime.datetime.fromisoformat(eta)
+        published_at = max(published_at, eta.timestamp())
+    return max(time.time() - published_at, 0)
 
 @task_prerun.connect
 def task_prerun_handler(task_id, task, *args, **kwargs):
+    tname = task.name
+
+    # Timers and histograms are kept whether or not we have statsd
+    evicted = _start_timer('runtime', tname, task_id)
+    waited = _queue_wait(task.request)
+    if waited is not None:
+        histograms.record(tname, 'queue_wait', waited)
+
+    registry = metrics_registry()
+    if registry is not None:
+        registry.inc('nti_celery_tasks_started_total', task=tname)
+        registry.add('nti_celery_tasks_in_flight', 1, task=tname)
+        if waited is not None:
+            registry.observe('nti_celery_task_queue_wait_seconds', waited, task=tname)
+
+    start_profiling(task_id, tname)
+
     statsd = statsd_client()
     if statsd is None:
         return
 
-    tname = task.name
-
-    _start_timer('runtime', tname, task_id)
     statsd.incr('celery.task.%s.prerun' % tname)
+    if evicted:
+        statsd.incr('celery.task.timers.evicted', evicted)
+    if waited is not None:
+        statsd.timing('celery.task.%s.queue_wait' % tname, waited * 1000)
 
 @task_postrun.connect
 def task_postrun_handler(task_id, task, *args, **kwargs):
+    tname = task.name
+
+    stop_profiling(task_id, tname)
+
+    elapsed = _stop_timer('runtime', tname, task_id)
+    if elapsed is not None:
+        histograms.record(tname, 'runtime', elapsed)
+
+    registry = metrics_registry()
+    if registry is not None:
+        registry.add('nti_celery_tasks_in_flight', -1, task=tname)
+        if elapsed is not None:
+            registry.observe('nti_celery_task_runtime_seconds', elapsed, task=tname)
+
     statsd = statsd_client()
     if statsd is None:
         return
 
-    tname = task.name
-
-    elapsed = _stop_timer('runtime', tname, task_id)
     if elapsed is not None:
         statsd.timing('celery.task.%s.t' % tname, elapsed * 1000)
     
     statsd.incr('celery.task.%s.postrun' % tname)
 
+def _count_finished(task_name, outcome):
+    registry = metrics_registry()
+    if registry is not None:
+        registry.inc('nti_celery_tasks_finished_total', task=task_name, outcome=outcome)
+
 @task_success.connect
 def task_success_handler(sender, *args, **kwargs):
+    _count_finished(sender.name, 'success')
+
     statsd = statsd_client()
     if statsd is None:
         return
@@ -283,6 +354,8 @@ def task_success_handler(sender, *args, **kwargs):
 
 @task_failure.connect
 def task_failure_handler(sender, *args, **kwargs):
+    _count_finished(sender.name, 'failure')
+
     statsd = statsd_client()
     if statsd is None:
         return
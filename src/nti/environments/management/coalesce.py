@@ -0,0 +1,104 @@
+"""
+Helpers for coalescing requests made from concurrent threads into
+a single unit of work.
+"""
+
+import threading
+
+logger = __import__('logging').getLogger(__name__)
+
+
+class _PendingRequest(object):
+
+    __slots__ = ('item', 'result', 'error', 'done')
+
+    def __init__(self, item):
+        self.item = item
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class _Batch(object):
+
+    def __init__(self):
+        self.requests = []
+        self.full = threading.Event()
+
+
+class Coalescer(object):
+    """
+    Gathers items submitted from concurrent threads for up to `window`
+    seconds, or until `max_size` items are pending, and hands them to
+    `handler` as a single list.
+
+    `handler` must return a sequence of results, one for each item it
+    was given. A result that is an exception instance is raised in the
+    thread that submitted that item. If the handler itself raises, every
+    submitter of the batch sees that exception.
+
+    The first thread to submit to a new batch waits out the window and
+    invokes the handler on behalf of everyone else, so no background
+    threads are involved. Note that this only coalesces requests that are
+    made concurrently within a process, e.g. a celery worker using the
+    threads pool.
+    """
+
+    def __init__(self, handler, window, max_size):
+        assert max_size > 0, 'max_size must be positive'
+
+        self.handler = handler
+        self.window = window
+        self.max_size = max_size
+
+        self._lock = threading.Lock()
+        self._batch = None
+
+    def submit(self, item):
+        """
+        Add the item to the current batch, blocking until the batch
+        has been handled. Returns the result for item.
+        """
+        request = _PendingRequest(item)
+        with self._lock:
+            batch = self._batch
+            leader = batch is None
+            if leader:
+                batch = self._batch = _Batch()
+            batch.requests.append(request)
+            if len(batch.requests) >= self.max_size:
+                # Seal the batch, the next submitter starts a new one
+                self._batch = None
+                batch.full.set()
+
+        if leader:
+            batch.full.wait(self.window)
+            with self._lock:
+                if self._batch is batch:
+                    self._batch = None
+            self._run(batch.requests)
+        else:
+            request.done.wait()
+
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def _run(self, requests):
+        logger.debug('Handling coalesced batch of %i request(s)', len(requests))
+        try:
+            results = self.handler([r.item for r in requests])
+            if len(results) != len(requests):
+                raise ValueError('Expected %i results but handler returned %i'
+                                 % (len(requests), len(results)))
+            for request, result in zip(requests, results):
+                if isinstance(result, Exception):
+                    request.error = result
+                else:
+                    request.result = result
+        except Exception as e:  # pylint: disable=broad-except
+            for request in requests:
+                request.error = e
+        finally:
+            for request in requests:
+                request.done.set()
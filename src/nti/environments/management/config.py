@@ -1,12 +1,48 @@
+import os
+import threading
+import time
+
 from configparser import ConfigParser
 
+from perfmetrics import statsd_client
+
 from zope import component
 from zope import interface
 
-import os
+from zope.component.hooks import setHooks
+from zope.component.hooks import site as current_site
+
+from zope.interface.registry import Components
 
 from .interfaces import ISettings
 
+logger = __import__('logging').getLogger(__name__)
+
+#: Sections that can't be applied to a running worker
+_RESTART_SECTIONS = ('celery', 'statsd')
+
+
+def _settings_locations(config):
+    return [l for l in (os.environ.get('NTI_MANAGEMENT_CONFIG', None),
+                        config.get('nti.environments.management.config', None)) if l]
+
+
+def read_settings(locations, required=False):
+    """
+    Read the settings from the given files, returning an ISettings.
+    Files that can't be read are skipped unless `required` is set, in
+    which case an OSError is raised.
+    """
+    config = ConfigParser()
+    read = config.read(locations)
+    if required and len(read) != len(locations):
+        missing = [l for l in locations if l not in read]
+        raise OSError('Unable to read settings from %s' % missing)
+
+    interface.alsoProvides(config, ISettings)
+    return config
+
+
 def configure_settings(config=None):
     """
     Configures and returns settings from our configuration.
@@ -15,17 +51,164 @@ def configure_settings(config=None):
     """
     if config is None:
         config = {}
-        
-    locations = [os.environ.get('NTI_MANAGEMENT_CONFIG', None), config.get('nti.environments.management.config', None)]
-    
-    config = ConfigParser()
-    config.read([l for l in locations if l])
 
-    interface.alsoProvides(config, ISettings)
+    config = read_settings(_settings_locations(config))
 
     component.getGlobalSiteManager().registerUtility(config, ISettings)
     
     return config
 
+def settings_sections(*sections, reloadable=True):
+    """
+    Declares the settings sections a utility factory reads, directly or
+    through the utilities it looks up. A SettingsReloader only rebuilds
+    the utility when one of them changes. The utility of a factory that
+    isn't `reloadable` holds state that rebuilding it would lose, so it
+    is never rebuilt and changes to its sections are only logged.
+    """
+    def declare(factory):
+        factory.settings_sections = frozenset(sections)
+        factory.settings_reloadable = reloadable
+        return factory
+    return declare
+
 def is_devmode(config):
     return os.getenv('DEVMODE', False) or config.getboolean('general', 'devmode', fallback=False)
+
+
+class _StagingSite(object):
+
+    def __init__(self, registry):
+        self.registry = registry
+
+    def getSiteManager(self):
+        return self.registry
+
+
+class SettingsReloader(object):
+    """
+    Watches the files our settings were read from and, when they change,
+    reloads the ISettings and rebuilds the utilities that were registered
+    with a factory, since those capture their settings when created.
+    Factories that declare their `settings_sections` are only rebuilt
+    when one of those sections changed, the rest on any change.
+
+    The new utilities are built in a staging registry layered over
+    the real one, so they see the new settings and each other. If
+    any of the files can't be read or parsed, or any factory raises,
+    the change is rejected and nothing is swapped. Otherwise the settings and
+    utilities are all registered at once.
+
+    `check` is cheap enough to call before every task, which is how
+    the worker uses it. The files are only stat'ed every `interval`
+    seconds. Changes to the celery section can't be applied without
+    restarting the worker, nor can the statsd client or the sections of
+    factories that aren't reloadable, so they are only logged.
+    """
+
+    def __init__(self, locations, interval, registry=None):
+        self.locations = list(locations)
+        self.interval = interval
+        self.registry = registry if registry is not None else component.getGlobalSiteManager()
+        self._lock = threading.Lock()
+        self._next_check = time.monotonic() + interval
+        self._mtimes = self._stat()
+        # Once swapped, the registrations no longer have the factory
+        self._factories = []
+        self._restart_sections = set(_RESTART_SECTIONS)
+        for reg in self.registry.registeredUtilities():
+            if reg.factory is None or reg.provided is ISettings:
+                continue
+            if getattr(reg.factory, 'settings_reloadable', True):
+                self._factories.append((reg.provided, reg.name, reg.factory))
+            else:
+                self._restart_sections.update(reg.factory.settings_sections)
+
+    def _stat(self):
+        mtimes = []
+        for location in self.locations:
+            try:
+                mtimes.append(os.stat(location).st_mtime_ns)
+            except OSError:
+                mtimes.append(None)
+        return mtimes
+
+    def check(self, *args, **kwargs):
+        """
+        Reload the settings if the files have changed, returning
+        True if the new settings were applied.
+        """
+        if time.monotonic() < self._next_check or not self._lock.acquire(blocking=False):
+            return False
+        try:
+            self._next_check = time.monotonic() + self.interval
+            mtimes = self._stat()
+            if mtimes == self._mtimes:
+                return False
+            # Whether or not we can apply it, don't retry this version
+            self._mtimes = mtimes
+            return self.reload()
+        finally:
+            self._lock.release()
+
+    def reload(self):
+        statsd = statsd_client()
+        start = time.perf_counter()
+        old = self.registry.getUtility(ISettings)
+        try:
+            settings = read_settings(self.locations, required=True)
+            changed = self._changed_sections(old, settings)
+            staging = Components('settings-reload', bases=(self.registry,))
+            staging.registerUtility(settings, ISettings)
+            rebuilt = []
+            setHooks()
+            with current_site(_StagingSite(staging)):
+                for provided, name, factory in self._factories:
+                    sections = getattr(factory, 'settings_sections', None)
+                    if sections is not None and not sections & changed:
+                        continue
+                    utility = factory()
+                    staging.registerUtility(utility, provided, name)
+                    rebuilt.append((utility, provided, name))
+        except Exception: # pylint: disable=broad-except
+            logger.exception('Rejecting changed settings in %s', self.locations)
+            if statsd is not None:
+                statsd.incr('environments.settings.reload_failed')
+            return False
+
+        for section in sorted(self._restart_sections & changed):
+            logger.warning('Settings in [%s] changed, restart the worker to apply them', section)
+            if statsd is not None:
+                statsd.incr('environments.settings.restart_required')
+
+        self.registry.registerUtility(settings, ISettings)
+        for utility, provided, name in rebuilt:
+            self.registry.registerUtility(utility, provided, name)
+
+        elapsed = time.perf_counter() - start
+        logger.info('Reloaded settings from %s and rebuilt %i utilities in %.3fs',
+                    self.locations, len(rebuilt), elapsed)
+        if statsd is not None:
+            statsd.incr('environments.settings.reload')
+            statsd.timing('environments.settings.reload.t', elapsed * 1000)
+        return True
+
+    @staticmethod
+    def _section(settings, section):
+        return dict(settings[section]) if settings.has_section(section) else None
+
+    @classmethod
+    def _changed_sections(cls, old, new):
+        return {section for section in set(old.sections()) | set(new.sections())
+                if cls._section(old, section) != cls._section(new, section)}
+
+
+def settings_reloader(settings, config=None):
+    """
+    Returns a SettingsReloader for our settings files if
+    `[general] reload_interval` is set, otherwise None.
+    """
+    interval = settings.getfloat('general', 'reload_interval', fallback=0)
+    if interval <= 0:
+        return None
+    return SettingsReloader(_settings_locations(config or {}), interval)
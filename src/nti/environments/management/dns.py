@@ -3,7 +3,7 @@ A simulated environment setup task and accompanying script
 entry point.
 """
 
-import boto3
+from botocore.exceptions import ClientError
 
 from dns.resolver import query as dnsresolver
 from dns.resolver import NXDOMAIN
@@ -13,13 +13,21 @@ from zope import interface
 
 from nti.tools.aws.route53 import add_dns_recordset
 
+from .config import settings_sections
+
 from .interfaces import IDNSAliasRecordCreator
 from .interfaces import IDNSMappingTask
 from .interfaces import ISettings
 
+from .aws import AWSClientPool
+
+from .coalesce import Coalescer
+
 from .tasks import AbstractTask
 from .tasks import mock_task
 
+from .timing import PhaseTimer
+
 logger = __import__('logging').getLogger(__name__)
 
 def is_dns_name_available(name):
@@ -35,28 +43,131 @@ def mock_dns(*args, **kwargs):
 def _add_dns_mapping(task, dns_name):
     """
     Creates an alias A record for the provided dns_name.
-    Zone and alias_target come from configuration
+    Zone and alias_target come from configuration. Returns the timings
+    of the change.
     """
-    component.getUtility(IDNSAliasRecordCreator).add_alias(dns_name)
+    timer = PhaseTimer()
+    with timer.phase('dns_change'):
+        component.getUtility(IDNSAliasRecordCreator).add_alias(dns_name)
+    return {'timings': timer.as_dict()}
+
+#: Route53 accepts at most this many changes in one ChangeResourceRecordSets call
+_MAX_ROUTE53_CHANGES = 1000
+
+_DEFAULT_BATCH_SIZE = 100
+
+#: The errors Route53 rejects a batch with because of one of its changes
+_INVALID_BATCH_ERRORS = ('InvalidChangeBatch', 'InvalidInput')
 
 @interface.implementer(IDNSAliasRecordCreator)
 class DNSAliasAdder(object):
-    
-    def __init__(self, zone, target):
+    """
+    Creates alias A records in `zone` pointing at `target`.
+
+    If a positive `batch_window` is given, concurrent calls to `add_alias`
+    are coalesced for up to that many seconds (or until `batch_size` names
+    are pending) and submitted to Route53 as a single change batch. Each
+    caller still blocks until its own record has been submitted and sees
+    only its own error. Coalescing requires the dns worker to process
+    tasks concurrently, e.g. using the threads pool.
+
+    Batched changes assume `target` lives in `zone`.
+
+    Route53 clients come from `clients`, an :class:`AWSClientPool` that
+    lives as long as this utility, so they are built once per worker
+    process rather than once per task.
+    """
+
+    _hosted_zone_id = None
+
+    def __init__(self, zone, target, batch_window=0, batch_size=_DEFAULT_BATCH_SIZE, clients=None):
         assert zone[-1] == '.', 'Zones must end in "."'
         
         self.zone = zone
         self.target = target
+        self.clients = clients if clients is not None else AWSClientPool()
+
+        self._buffer = None
+        if batch_window > 0:
+            self._buffer = Coalescer(self._add_aliases,
+                                     batch_window,
+                                     min(batch_size, _MAX_ROUTE53_CHANGES))
 
     def add_alias(self, dns_name):
-        client = boto3.client('route53')
-        logger.info('Creating A record alias for %s to %s in zone %s', dns_name, self.target, self.zone)
-        add_dns_recordset(client, self.zone, dns_name, alias_target=self.target)
+        if self._buffer is not None:
+            logger.info('Queuing A record alias for %s to %s in zone %s', dns_name, self.target, self.zone)
+            return self._buffer.submit(dns_name)
 
+        logger.info('Creating A record alias for %s to %s in zone %s', dns_name, self.target, self.zone)
+        self.clients.invoke('route53', add_dns_recordset, self.zone, dns_name, alias_target=self.target)
+
+    def _get_hosted_zone_id(self, client):
+        if self._hosted_zone_id is None:
+            resp = client.list_hosted_zones_by_name(DNSName=self.zone, MaxItems='1')
+            zones = [z for z in resp['HostedZones'] if z['Name'] == self.zone]
+            if not zones:
+                raise ValueError('Unable to find hosted zone %s' % self.zone)
+            self._hosted_zone_id = zones[0]['Id'].split('/')[-1]
+        return self._hosted_zone_id
+
+    def _alias_change(self, dns_name, hosted_zone_id):
+        return {
+            'Action': 'CREATE',
+            'ResourceRecordSet': {
+                'Name': dns_name,
+                'Type': 'A',
+                'AliasTarget': {
+                    'HostedZoneId': hosted_zone_id,
+                    'DNSName': self.target,
+                    'EvaluateTargetHealth': False
+                }
+            }
+        }
+
+    def _change_record_sets(self, client, hosted_zone_id, changes):
+        client.change_resource_record_sets(HostedZoneId=hosted_zone_id,
+                                           ChangeBatch={'Changes': changes})
+
+    def _add_aliases(self, dns_names):
+        """
+        Submit a single change batch for all of dns_names. If Route53 rejects
+        the batch as invalid we fall back to submitting each change
+        individually so a bad name only fails its own caller. Any other
+        error, e.g. throttling, fails every caller.
+        """
+        hosted_zone_id = self.clients.invoke('route53', self._get_hosted_zone_id)
+
+        # The same name may be requested more than once, only send it once.
+        unique = list(dict.fromkeys(dns_names))
+        changes = [self._alias_change(name, hosted_zone_id) for name in unique]
+
+        logger.info('Creating %i A record alias(es) to %s in zone %s',
+                    len(changes), self.target, self.zone)
+        try:
+            self.clients.invoke('route53', self._change_record_sets, hosted_zone_id, changes)
+            return [None] * len(dns_names)
+        except ClientError as e:
+            if len(changes) == 1 or e.response['Error']['Code'] not in _INVALID_BATCH_ERRORS:
+                raise
+            logger.exception('Batch of %i changes rejected. Submitting individually', len(changes))
+
+        results = {}
+        for name, change in zip(unique, changes):
+            try:
+                self.clients.invoke('route53', self._change_record_sets, hosted_zone_id, [change])
+                results[name] = None
+            except ClientError as e:
+                results[name] = e
+        return [results[name] for name in dns_names]
+
+@settings_sections('dns')
 def _record_creator_factory():
     settings = component.getUtility(ISettings)['dns']
 
-    return DNSAliasAdder(settings['zone'], settings['alias_target'])
+    return DNSAliasAdder(settings['zone'],
+                         settings['alias_target'],
+                         batch_window=settings.getfloat('batch_window', fallback=0),
+                         batch_size=settings.getint('batch_size', fallback=_DEFAULT_BATCH_SIZE))
 
 @interface.implementer(IDNSMappingTask)
 class AddDNSMappingTask(AbstractTask):
@@ -1,11 +1,15 @@
 import argparse
 import os
+import re
 import time
+import select
 import socket
 import subprocess
 import json
 import functools
 import socket
+import tempfile
+import threading
 
 from celery import group
 
@@ -23,14 +27,23 @@ from zope.configuration import xmlconfig
 
 from zope.dottedname import resolve as dottedname
 
+from perfmetrics import statsd_client
+
+from .config import settings_sections
+
 from .interfaces import IHaproxyBackendTask
 from .interfaces import IHaproxyReloadTask
+from .interfaces import IHaproxyRemoveBackendTask
 from .interfaces import IHaproxyConfigurator
 from .interfaces import ISettings
 
+from .prometheus import metrics_registry
+
 from .tasks import AbstractTask
 from .tasks import mock_task
 
+from .timing import PhaseTimer
+
 logger = __import__('logging').getLogger(__name__)
 
 _BACKEND_DEFINITION = r"""backend $SITE_ID_backend_static
@@ -73,24 +86,211 @@ backend $SITE_ID_backend_node
 
 _REPLACEMENT_PATTERN = "$SITE_ID"
 
+# A pool slot has the same three backends as a site, but each server is
+# declared by a server-template so it can be pointed at a site at runtime.
+_SLOT_DEFINITION = r"""backend $SLOT_backend_static
+        mode http
+        balance roundrobin
+        option prefer-last-server
+
+        timeout server 15m
+        timeout connect 4s
+
+        option httpchk GET /_ops/ping HTTP/1.1\r\nHost:\ $CHECK_HOST
+
+        server-template web 1 $ADDR:8085 weight 1 on-error fastinter check inter 2000 rise 1 fall 2 send-proxy$DISABLED
+
+backend $SLOT_backend_data
+        mode http
+        balance leastconn
+        hash-type consistent sdbm avalanche
+        option prefer-last-server
+        option http-server-close
+
+        timeout server 15m
+        timeout connect 4s
+
+        option httpchk GET /_ops/ping HTTP/1.1\r\nHost:\ $CHECK_HOST
+
+        server-template data 1 $ADDR:8081 weight 1 on-error fastinter check inter 2000 rise 1 fall 20 send-proxy$DISABLED
+
+backend $SLOT_backend_node
+        mode http
+        option prefer-last-server
+        timeout server 15m
+        timeout connect 4s
+        option http-server-close
+
+        option httpchk GET /mobile/api/_ops/ping HTTP/1.1\r\nHost:\ $CHECK_HOST
+
+        server-template node 1 $ADDR:8083 weight 1 on-error fastinter check inter 2000 rise 1 fall 2 send-proxy$DISABLED
+"""
+
+#: The (backend suffix, server name, port) of each server in a slot
+_SLOT_SERVERS = (('static', 'web1', 8085),
+                 ('data', 'data1', 8081),
+                 ('node', 'node1', 8083))
+
+_UNASSIGNED_ADDR = '0.0.0.0'
+
 _DEFAULT_ADMIN_SOCKET = "/run/haproxy-master.sock"
 
+#: How long we wait for the master process to come back after a reload
+_RELOAD_TIMEOUT = 5
+
+#: How often we poll the master process while waiting for a reload
+_RELOAD_POLL_INTERVAL = 0.05
+
+# In interactive mode the cli terminates every response with an empty line
+# and a prompt, "> " for the stats socket and "master> " for the master socket.
+_PROMPT = re.compile(br'(?:^|\n)[^\s>]*> $')
+
+class HAProxyRuntimeClient(object):
+    """
+    A client for the haproxy runtime api that keeps its connection
+    to the (master) socket open between commands.
+
+    We put the cli into interactive mode with the `prompt` command so
+    haproxy doesn't hang up after each response, and use the prompt to
+    find the end of each response, however large. Several commands may
+    be sent in a single round trip; haproxy runs them in order and we
+    return their combined output.
+
+    The master process drops all cli connections when it reloads, and
+    the cli closes idle connections, so we transparently reconnect when
+    we find our connection closed. A command is never resent once it
+    has been written to the socket.
+    """
+
+    def __init__(self, socket_file, timeout=1):
+        self.socket_file = socket_file
+        self.timeout = timeout
+        self._sock = None
+        self._lock = threading.RLock()
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(self.timeout)
+            sock.connect(self.socket_file)
+            self._sock = sock
+            self._send('prompt')
+            self._read_response()
+        except BaseException:
+            sock.close()
+            self._sock = None
+            raise
+
+    def _is_stale(self):
+        """
+        A kept-alive connection is stale if haproxy has closed it on us,
+        which we see as a readable socket at eof.
+        """
+        readable, _, _ = select.select([self._sock], [], [], 0)
+        if not readable:
+            return False
+        try:
+            self._sock.setblocking(False)
+            return not self._sock.recv(1, socket.MSG_PEEK)
+        except BlockingIOError:
+            return False
+        except OSError:
+            return True
+        finally:
+            self._sock.settimeout(self.timeout)
+
+    def _send(self, line):
+        self._sock.sendall(bytes(line + '\n', 'utf-8'))
+
+    def _read_response(self):
+        chunks = []
+        tail = b''
+        while True:
+            data = self._sock.recv(65536)
+            if not data:
+                # haproxy hung up, e.g. the master process is reloading
+                self.close()
+                break
+            chunks.append(data)
+            tail = (tail + data)[-64:]
+            if _PROMPT.search(tail):
+                break
+        response = b''.join(chunks)
+        match = _PROMPT.search(response[-64:])
+        if match:
+            # Drop the prompt and the empty line haproxy emits before it
+            response = response[:len(response) - len(match.group(0))]
+        return str(response, 'utf-8')
+
+    def execute(self, *commands, timeout=None):
+        """
+        Send commands to haproxy in a single round trip, separated
+        by ';', returning the combined output.
+        """
+        with self._lock:
+            if timeout is not None:
+                self.timeout = timeout
+
+            if self._sock is not None and self._is_stale():
+                self.close()
+            if self._sock is None:
+                self._connect()
+            else:
+                # It may have been connected with another timeout
+                self._sock.settimeout(self.timeout)
+
+            try:
+                self._send('; '.join(commands))
+                return self._read_response()
+            except BaseException:
+                # We have no idea what state the connection is in
+                self.close()
+                raise
+
+    def close(self):
+        with self._lock:
+            if self._sock is not None:
+                try:
+                    self._sock.close()
+                finally:
+                    self._sock = None
+
+_runtime_clients = {}
+_runtime_clients_pid = None
+_runtime_clients_lock = threading.Lock()
+
+def runtime_client(socket_file):
+    """
+    Returns the shared HAProxyRuntimeClient for socket_file, creating it
+    if necessary. Clients are not shared across forks.
+    """
+    global _runtime_clients_pid
+    with _runtime_clients_lock:
+        if _runtime_clients_pid != os.getpid():
+            _runtime_clients.clear()
+            _runtime_clients_pid = os.getpid()
+        try:
+            return _runtime_clients[socket_file]
+        except KeyError:
+            client = _runtime_clients[socket_file] = HAProxyRuntimeClient(socket_file)
+            return client
+
 def send_command(socket_file, command, read_timeout=1):
+    """
+    Send command over the shared connection to socket_file, returning the
+    output or False if haproxy didn't respond in time.
+    """
     try:
-        unix_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-        unix_socket.settimeout(read_timeout)
-        unix_socket.connect(socket_file)
-        unix_socket.send(bytes(command + '\n', 'utf-8'))
-        data = str(unix_socket.recv(65536), 'utf-8')
+        return runtime_client(socket_file).execute(command, timeout=read_timeout)
     except (socket.timeout):
         """
         TODO: Add logic to determine if the lack of response was expected.
         If it was not expected we need to rethrow the exception.
         """
-        data = False
-    finally:
-        unix_socket.close()
-    return data
+        return False
+
+def _backend_name(site_id):
+    return f'{site_id}_backend'
 
 def backend_filename(site_id):
     return f"10-{site_id}.cfg"
@@ -121,9 +321,8 @@ def add_backend_mapping(map_location, dns_name, site_id):
     TODO add some sort of locking / lock file in case the serial processing
     gets screwed up.
 
-    TODO Haproxy 1.8 let's us manipulate the mappings through the API
-    but it's unclear if this is ever automatically flushed to disk. We
-    can probably come up with something safer than this approach.
+    See write_backend_mapping and set_runtime_mapping for updating
+    the mappings through the runtime API instead.
 
     https://www.haproxy.com/blog/introduction-to-haproxy-maps/#editing-with-the-runtime-api
 
@@ -131,13 +330,107 @@ def add_backend_mapping(map_location, dns_name, site_id):
     logger.info('Updating haproxy backend map map=(%s) site=(%s) dns_name(%s)',
                 map_location, site_id, dns_name)
     with open(map_location, 'a') as f:
-        f.write(f'{dns_name}\t{site_id}_backend\n')
+        f.write(f'{dns_name}\t{_backend_name(site_id)}\n')
+
+def _write_atomically(path, contents, mode=None):
+    """
+    Write contents to a temporary file alongside path, sync it, and
+    rename it into place so readers never see a partially written file.
+    """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path),
+                               prefix='.' + os.path.basename(path))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(contents)
+            f.flush()
+            os.fsync(f.fileno())
+        if mode is not None:
+            os.chmod(tmp, mode)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+def write_backend_mappings(map_location, mappings):
+    """
+    Atomically rewrite the mapping file so that it maps each dns name in
+    mappings to the given backend, replacing any existing entries for those
+    names. The new file is written and synced alongside the original and
+    then renamed into place, so haproxy never sees a partially written map.
+
+    Like add_backend_mapping we expect to be invoked serially.
+    """
+    logger.info('Writing %i haproxy backend mapping(s) to map=(%s)',
+                len(mappings), map_location)
+    with open(map_location, 'r') as f:
+        lines = [l if l.endswith('\n') else l + '\n'
+                 for l in f
+                 if l.split()[:1] and l.split()[0] not in mappings]
+    lines.extend(f'{dns_name}\t{backend}\n' for dns_name, backend in mappings.items())
+
+    _write_atomically(map_location, ''.join(lines), os.stat(map_location).st_mode & 0o7777)
+
+def remove_backend_mappings(map_location, backends):
+    """
+    Atomically remove every mapping to one of backends from the mapping
+    file, returning the dns names that were mapped to them. See
+    write_backend_mappings.
+    """
+    logger.info('Removing haproxy backend mappings to %s from map=(%s)',
+                sorted(backends), map_location)
+    lines = []
+    removed = []
+    with open(map_location, 'r') as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 2 and parts[1] in backends:
+                removed.append(parts[0])
+            elif parts:
+                lines.append(line if line.endswith('\n') else line + '\n')
+
+    _write_atomically(map_location, ''.join(lines), os.stat(map_location).st_mode & 0o7777)
+    return removed
+
+def write_backend_mapping(map_location, dns_name, backend):
+    """
+    Atomically map dns_name to backend in the mapping file. See
+    write_backend_mappings.
+    """
+    logger.info('Writing haproxy backend map map=(%s) backend=(%s) dns_name(%s)',
+                map_location, backend, dns_name)
+    write_backend_mappings(map_location, {dns_name: backend})
 
 class HAProxyCommandException(Exception):
     """
     Raised if an error occurs communicating with haproxy
     """
 
+def _check_command_output(output, allowed=()):
+    """
+    Commands that change state print little or nothing when they
+    succeed. Raise an HAProxyCommandException if output contains lines
+    that don't start with one of the allowed messages.
+    """
+    if output is False:
+        raise HAProxyCommandException('No response from haproxy')
+
+    errors = [line for line in output.splitlines()
+              if line.strip() and not line.strip().startswith(tuple(allowed))]
+    if errors:
+        raise HAProxyCommandException('; '.join(errors))
+
+def set_runtime_mapping(client, map_name, dns_name, backend, worker='@1'):
+    """
+    Map dns_name to backend in the running haproxy without a reload.
+    Any existing entry is replaced. Both commands go to the worker in a
+    single round trip.
+    """
+    logger.info('Updating live haproxy map map=(%s) backend=(%s) dns_name(%s)',
+                map_name, backend, dns_name)
+    output = client.execute(f'{worker} del map {map_name} {dns_name}',
+                            f'{worker} add map {map_name} {dns_name} {backend}')
+    _check_command_output(output, allowed=('Key not found.',))
+
 def check_haproxy_status_output(output):
     """
     Given output from haproxy proc status, parse to see if the config was reloaded
@@ -201,7 +494,27 @@ def check_haproxy_status_output(output):
     return True
 
 
-def reload_haproxy_cfg(admin_socket, check_reload=True):
+def _await_proc_status(admin_socket, timeout, interval):
+    """
+    Poll the master process with 'show proc' until it answers. While
+    the master re-executes itself the socket refuses connections, hangs
+    up, or doesn't respond, so we keep trying until timeout.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            output = send_command(admin_socket, 'show proc')
+            if output:
+                return output
+        except (ConnectionError, FileNotFoundError) as e:
+            logger.debug('Haproxy master not yet available. %s', e)
+
+        if time.monotonic() >= deadline:
+            raise HAProxyCommandException('Timed out waiting for haproxy to reload')
+        time.sleep(interval)
+
+def reload_haproxy_cfg(admin_socket, check_reload=True,
+                       timeout=_RELOAD_TIMEOUT, interval=_RELOAD_POLL_INTERVAL):
     """
     Reload the haproxy config by sending the reload command over
     the admin socket.
@@ -215,42 +528,362 @@ def reload_haproxy_cfg(admin_socket, check_reload=True):
     # were restarted. Again, we're run serially so were are hand waving around
     # a ton of synchronization issues.
 
-    if check_reload:
-        # The afore mentioned reload command also puts the socket in a weird state
-        # for a very short time afterwards as well. For now we will just sleep for
-        # a short fixed amount of time and hope that works.
-        time.sleep(0.2)
+    if not check_reload:
+        _count_reload('unchecked')
+        return
 
-        logger.info('Sending \'show proc\' command to haproxy master process.')
-        output = send_command(admin_socket, 'show proc')
-        logger.info('\'show proc\' command sent.')
+    # The afore mentioned reload command also puts the socket in a weird state
+    # for a short time afterwards as well, so poll until the master answers.
+    logger.info('Sending \'show proc\' command to haproxy master process.')
+    try:
+        output = _await_proc_status(admin_socket, timeout, interval)
+    except HAProxyCommandException:
+        _count_reload('timeout')
+        raise
+    logger.info('\'show proc\' command sent.')
 
-        try:
-            check_haproxy_status_output(output)
-        except HAProxyCommandException as e:
-            logger.exception('HAProxy Reload failed')
-            raise HAProxyCommandException('Haproxy reload failed: %s', e)
+    try:
+        check_haproxy_status_output(output)
+    except HAProxyCommandException as e:
+        _count_reload('failure')
+        logger.exception('HAProxy Reload failed')
+        raise HAProxyCommandException('Haproxy reload failed: %s', e)
+    _count_reload('success')
+
+def _count_reload(outcome):
+    registry = metrics_registry()
+    if registry is not None:
+        registry.inc('nti_haproxy_reloads_total', outcome=outcome)
+
+# What `set server addr` says when it succeeds
+_SET_SERVER_MESSAGES = ('IP changed from', 'no need to change', 'port changed from')
+
+class BackendSlotPool(object):
+    """
+    A fixed number of pre-declared backend slots, each able to serve
+    any one site. A site is given a slot at runtime by pointing the
+    slot's servers at the site with `set server addr` and `enable server`
+    and mapping the site's dns name to the slot, none of which requires a
+    reload.
+
+    The slots are declared in `20-slots.cfg` in folder and which site
+    holds which slot is recorded in `slots.json`. Assignments are held in
+    memory and written out, along with the map file, by `flush`. Until
+    they are flushed they are lost if haproxy reloads.
+    """
+
+    config_filename = '20-slots.cfg'
+    state_filename = 'slots.json'
+
+    def __init__(self, folder, size):
+        self.folder = folder
+        self.size = size
+        self.assignments = {}
+        self.unflushed = 0
+        self.deployed = os.path.exists(self.config_path)
+        if os.path.exists(self.state_path):
+            with open(self.state_path, 'r') as f:
+                self.assignments = json.load(f)
+
+    @property
+    def config_path(self):
+        return os.path.join(self.folder, self.config_filename)
+
+    @property
+    def state_path(self):
+        return os.path.join(self.folder, self.state_filename)
+
+    def slot_names(self):
+        return ['slot%03i' % i for i in range(1, self.size + 1)]
+
+    def slot_for(self, site_id):
+        for slot, assignment in self.assignments.items():
+            if assignment['site_id'] == site_id:
+                return slot
+        return None
+
+    def claim(self, site_id, dns_name):
+        """
+        Assign a free slot to site_id, returning its name or None if
+        the pool is exhausted. A site that already has a slot keeps it.
+        """
+        slot = self.slot_for(site_id)
+        if slot is None:
+            free = [name for name in self.slot_names() if name not in self.assignments]
+            if not free:
+                return None
+            slot = free[0]
+        self.assignments[slot] = {'site_id': site_id, 'dns_name': dns_name}
+        self.unflushed += 1
+        return slot
+
+    def release(self, slot):
+        self.assignments.pop(slot, None)
+
+    def render(self):
+        definitions = []
+        for slot in self.slot_names():
+            assignment = self.assignments.get(slot)
+            if assignment is None:
+                check_host, addr, disabled = slot, _UNASSIGNED_ADDR, ' disabled'
+            else:
+                site_id = assignment['site_id']
+                check_host, addr, disabled = site_id, f'{site_id}.nti', ''
+            definitions.append(_SLOT_DEFINITION.replace('$SLOT', slot)
+                                               .replace('$CHECK_HOST', check_host)
+                                               .replace('$ADDR', addr)
+                                               .replace('$DISABLED', disabled))
+        return '\n'.join(definitions)
+
+    def flush(self, map_location):
+        logger.info('Writing %i backend slot assignment(s) to %s', len(self.assignments), self.folder)
+        mappings = {a['dns_name']: _backend_name(slot) for slot, a in self.assignments.items()}
+        if mappings:
+            write_backend_mappings(map_location, mappings)
+        _write_atomically(self.config_path, self.render())
+        _write_atomically(self.state_path, json.dumps(self.assignments, indent=2, sort_keys=True))
+        self.unflushed = 0
+
+def resolve_site_address(site_id):
+    """
+    Resolve the internal address of the pod for site_id.
+    """
+    try:
+        return socket.gethostbyname(f'{site_id}.nti')
+    except socket.gaierror as e:
+        raise InternalDNSNotReady('Unable to resolve %s.nti: %s' % (site_id, e))
+
+def activate_slot(client, slot, addr, map_name, dns_name, worker='@1'):
+    """
+    Point the servers in slot at addr, enable them, and map dns_name
+    to the slot, all in a single round trip.
+
+    The health checks haproxy has loaded for the slot send the slot's
+    name as their Host, and the runtime API can't change that, so they
+    are stopped until the next reload loads the slot with the site's
+    Host. Until then haproxy treats the servers as up.
+    """
+    logger.info('Activating haproxy slot=(%s) addr=(%s) dns_name=(%s)', slot, addr, dns_name)
+    commands = []
+    for suffix, server, port in _SLOT_SERVERS:
+        target = f'{_backend_name(slot)}_{suffix}/{server}'
+        commands.append(f'{worker} set server {target} addr {addr} port {port}')
+        commands.append(f'{worker} disable health {target}')
+        commands.append(f'{worker} enable server {target}')
+    commands.append(f'{worker} del map {map_name} {dns_name}')
+    commands.append(f'{worker} add map {map_name} {dns_name} {_backend_name(slot)}')
+    output = client.execute(*commands)
+    _check_command_output(output, allowed=_SET_SERVER_MESSAGES + ('Key not found.',))
+
+def deactivate_slot(client, slot, map_name, dns_name, worker='@1'):
+    """
+    Remove the mapping of dns_name to slot and put the slot's servers
+    in maintenance, all in a single round trip.
+    """
+    logger.info('Deactivating haproxy slot=(%s) dns_name=(%s)', slot, dns_name)
+    commands = [f'{worker} del map {map_name} {dns_name}']
+    for suffix, server, _ in _SLOT_SERVERS:
+        commands.append(f'{worker} disable server {_backend_name(slot)}_{suffix}/{server}')
+    output = client.execute(*commands)
+    _check_command_output(output, allowed=('Key not found.',))
+
+#: Append mappings to the map file, haproxy picks them up on reload
+MAP_UPDATES_FILE = 'file'
+
+#: Push mappings to the running haproxy and atomically rewrite the map file
+MAP_UPDATES_RUNTIME = 'runtime'
+
+#: Write a backend definition per site, which requires a reload
+BACKEND_MODE_SITE = 'site'
+
+#: Assign sites to pre-declared backend slots at runtime
+BACKEND_MODE_POOL = 'pool'
+
+_DEFAULT_POOL_SIZE = 100
+
+_DEFAULT_POOL_FLUSH_EVERY = 10
 
 @interface.implementer(IHaproxyConfigurator)
 class HAProxyConfigurator(object):
     """
     An object that can configure haproxy.
+
+    By default new dns mappings are appended to the map file and take
+    effect when haproxy is next reloaded. With `map_updates` set to
+    'runtime' the map file is rewritten atomically and, if haproxy has
+    already loaded the backend being mapped to, the mapping is pushed to
+    the running haproxy with `add map`. A backend we have just written
+    isn't loaded until the next reload, so mapping a new site this way
+    still needs one; it is the pool below that avoids it. `runtime_map`
+    is the name haproxy knows the map by, if it differs from our path to
+    it. Should haproxy reject the live update we still have the file, so
+    the mapping takes effect on the next reload.
+
+    With `backend_mode` set to 'pool' new sites are given one of
+    `pool_size` pre-declared backend slots (see :class:`BackendSlotPool`)
+    so neither the backend nor the mapping requires a reload. Slot
+    assignments are written to disk every `pool_flush_every` sites and
+    before every reload. If the pool is exhausted, or a slot can't be
+    activated, we fall back to writing a backend for the site.
     """
 
-    def __init__(self, backends_folder, backend_map, admin_socket=_DEFAULT_ADMIN_SOCKET):
+    #: The process runtime commands are sent to through the master socket
+    worker = '@1'
+
+    def __init__(self, backends_folder, backend_map, admin_socket=_DEFAULT_ADMIN_SOCKET,
+                 map_updates=MAP_UPDATES_FILE, runtime_map=None,
+                 backend_mode=BACKEND_MODE_SITE, pool_size=_DEFAULT_POOL_SIZE,
+                 pool_flush_every=_DEFAULT_POOL_FLUSH_EVERY):
+        assert map_updates in (MAP_UPDATES_FILE, MAP_UPDATES_RUNTIME), \
+            'Unknown map update mode %s' % map_updates
+        assert backend_mode in (BACKEND_MODE_SITE, BACKEND_MODE_POOL), \
+            'Unknown backend mode %s' % backend_mode
+
         self.backends_folder = backends_folder
         self.backend_map = backend_map
         self.admin_socket = admin_socket
+        self.map_updates = map_updates
+        self.runtime_map = runtime_map
+        self.pool_flush_every = pool_flush_every
+
+        # Sites whose backends we've written since haproxy last reloaded
+        self._unloaded = set()
+
+        self.pool = None
+        if backend_mode == BACKEND_MODE_POOL:
+            self.pool = BackendSlotPool(backends_folder, pool_size)
+
+    @property
+    def _map_name(self):
+        return self.runtime_map or self.backend_map
 
     def add_backend(self, site_id, dns_name):
+        """
+        Returns True if the backend and mapping are live, or False
+        if they require a reload.
+        """
         logger.info('Adding haproxy backend for site=(%s) dns_name=(%s)', site_id, dns_name)
+        if self.pool is not None and self._add_pooled_backend(site_id, dns_name):
+            return True
+
         write_backend(site_id, self.backends_folder)
-        add_backend_mapping(self.backend_map, dns_name, site_id)
+        self._unloaded.add(site_id)
+        self.add_mapping(site_id, dns_name)
+        return False
+
+    def _backend_loaded(self, site_id):
+        return site_id not in self._unloaded \
+            and os.path.exists(os.path.join(self.backends_folder, backend_filename(site_id)))
+
+    def _add_pooled_backend(self, site_id, dns_name):
+        if not self.pool.deployed:
+            # The slots have never been loaded by haproxy. Write them
+            # out so they are available after the upcoming reload.
+            logger.info('Deploying %i haproxy backend slots', self.pool.size)
+            self.pool.flush(self.backend_map)
+            self.pool.deployed = True
+            return False
+
+        slot = self.pool.claim(site_id, dns_name)
+        if slot is None:
+            logger.warning('Haproxy backend slots exhausted. Adding backend for site=(%s)', site_id)
+            return False
 
-    def reload_config(self):
+        try:
+            activate_slot(runtime_client(self.admin_socket),
+                          slot,
+                          resolve_site_address(site_id),
+                          self._map_name,
+                          dns_name,
+                          worker=self.worker)
+        except InternalDNSNotReady:
+            self.pool.release(slot)
+            raise
+        except (OSError, HAProxyCommandException):
+            logger.exception('Unable to activate haproxy slot=(%s) for site=(%s)', slot, site_id)
+            self.pool.release(slot)
+            return False
+
+        if self.pool.unflushed >= self.pool_flush_every:
+            self.pool.flush(self.backend_map)
+        return True
+
+    def add_mapping(self, site_id, dns_name):
+        """
+        Map dns_name to the backends for site_id. Returns True if the
+        mapping is live, or False if it requires a reload.
+        """
+        if self.map_updates == MAP_UPDATES_FILE:
+            add_backend_mapping(self.backend_map, dns_name, site_id)
+            return False
+
+        backend = _backend_name(site_id)
+        write_backend_mapping(self.backend_map, dns_name, backend)
+        if not self._backend_loaded(site_id):
+            # Haproxy would route dns_name to a backend it doesn't have
+            logger.info('Haproxy has not loaded backend=(%s). Mapping for dns_name=(%s) '
+                        'will take effect on reload', backend, dns_name)
+            return False
+        try:
+            set_runtime_mapping(runtime_client(self.admin_socket),
+                                self._map_name,
+                                dns_name,
+                                backend,
+                                worker=self.worker)
+        except (OSError, HAProxyCommandException):
+            logger.exception('Unable to update live haproxy map for dns_name=(%s). '
+                             'Mapping will take effect on reload', dns_name)
+            return False
+        return True
+
+    def remove_backend(self, site_id):
+        """
+        Remove the backend and mappings of site_id. Returns True if
+        they are gone from the running haproxy, or False if that
+        requires a reload.
+        """
+        logger.info('Removing haproxy backend for site=(%s)', site_id)
+        slot = self.pool.slot_for(site_id) if self.pool is not None else None
+        if slot is not None:
+            return self._release_slot(site_id, slot)
+
+        removed = remove_backend_mappings(self.backend_map, {_backend_name(site_id)})
+        try:
+            os.remove(os.path.join(self.backends_folder, backend_filename(site_id)))
+        except FileNotFoundError:
+            logger.warning('No haproxy backend definition for site=(%s)', site_id)
+        self._unloaded.discard(site_id)
+        logger.info('Removed haproxy mappings for dns_names=(%s)', removed)
+        return False
+
+    def _release_slot(self, site_id, slot):
+        dns_name = self.pool.assignments[slot]['dns_name']
+        self.pool.release(slot)
+        # Written now, so the slot can't come back with a reload
+        remove_backend_mappings(self.backend_map, {_backend_name(slot)})
+        self.pool.flush(self.backend_map)
+        try:
+            deactivate_slot(runtime_client(self.admin_socket),
+                            slot,
+                            self._map_name,
+                            dns_name,
+                            worker=self.worker)
+        except (OSError, HAProxyCommandException):
+            logger.exception('Unable to deactivate haproxy slot=(%s) for site=(%s)', slot, site_id)
+            return False
+        return True
+
+    def reload_config(self, check_reload=False):
+        if self.pool is not None and self.pool.unflushed:
+            # Anything not on disk is lost when haproxy reloads
+            self.pool.flush(self.backend_map)
+        written = set(self._unloaded)
         logger.info('Issuing reload of haproxy config')
-        reload_haproxy_cfg(self.admin_socket, False)
+        reload_haproxy_cfg(self.admin_socket, check_reload)
+        self._unloaded -= written
 
+# Pool slot claims and backends haproxy hasn't loaded yet would be lost
+@settings_sections('haproxy', reloadable=False)
 def _haproxy_configurator_factory():
     settings = component.getUtility(ISettings)
     haproxy = settings['haproxy']
@@ -258,7 +891,112 @@ def _haproxy_configurator_factory():
     haproxy_map = os.path.join(haproxy_config_root, 'maps/env.map')
     admin_socket = haproxy['admin_socket']
 
-    return HAProxyConfigurator(haproxy_config_root, haproxy_map, admin_socket)
+    return HAProxyConfigurator(haproxy_config_root, haproxy_map, admin_socket,
+                               map_updates=haproxy.get('map_updates', MAP_UPDATES_FILE),
+                               runtime_map=haproxy.get('runtime_map'),
+                               backend_mode=haproxy.get('backend_mode', BACKEND_MODE_SITE),
+                               pool_size=haproxy.getint('pool_size', fallback=_DEFAULT_POOL_SIZE),
+                               pool_flush_every=haproxy.getint('pool_flush_every',
+                                                               fallback=_DEFAULT_POOL_FLUSH_EVERY))
+
+#: Publishers' clocks may be this far behind ours (seconds). A reload
+#: only satisfies a request if it started at least this long after the
+#: request was made, so a lagging clock can't pass off a reload that
+#: began before the change was written.
+_CLOCK_SKEW_ALLOWANCE = 0.1
+
+class ReloadCoordinator(object):
+    """
+    Merges haproxy reload requests so that one reload, and one status
+    check, serves every request made before it started.
+
+    Each request carries the time it was made, after whatever config
+    change it needs picked up was written. A request made before the
+    start of the most recent reload is already satisfied and gets that
+    reload's outcome without reloading again. Otherwise we wait `window`
+    seconds, giving other requests a chance to arrive, and reload.
+
+    Requests are handled one at a time, so this works whether the tier1
+    worker processes tasks serially or concurrently with threads. With
+    a serial worker, N requests queued during a reload are served by a
+    single further reload.
+    """
+
+    def __init__(self, reload_func, window=0):
+        self.reload_func = reload_func
+        self.window = window
+
+        self._lock = threading.Lock()
+        self._last_started = None
+        self._last_error = None
+
+        self.requests = 0
+        self.reloads = 0
+
+    def request_reload(self, requested_at=None):
+        """
+        Block until a reload that started after requested_at has
+        completed, raising its exception if it failed.
+        """
+        if requested_at is None:
+            requested_at = time.time()
+
+        with self._lock:
+            self.requests += 1
+            if self._last_started is not None \
+               and requested_at + _CLOCK_SKEW_ALLOWANCE <= self._last_started:
+                logger.info('Reload requested at %s satisfied by reload started at %s',
+                            requested_at, self._last_started)
+                self._emit(coalesced=True)
+                if self._last_error is not None:
+                    raise self._last_error
+                return
+
+            if self.window:
+                time.sleep(self.window)
+
+            self._last_started = time.time()
+            self.reloads += 1
+            self._last_error = None
+            try:
+                self.reload_func()
+            except Exception as e:
+                # Requests this reload was meant to serve see the same failure
+                self._last_error = e
+                raise
+            finally:
+                self._emit(coalesced=False)
+
+    def _emit(self, coalesced):
+        statsd = statsd_client()
+        if statsd is None:
+            return
+
+        statsd.incr('haproxy.reload.requested')
+        statsd.incr('haproxy.reload.coalesced' if coalesced else 'haproxy.reload.executed')
+        statsd.gauge('haproxy.reload.coalesce_ratio', self.requests / max(self.reloads, 1))
+
+_reload_coordinator = None
+_reload_coordinator_settings = None
+
+def reload_coordinator():
+    """
+    Returns the process wide ReloadCoordinator for the IHaproxyConfigurator.
+    Settings can be reloaded while we run, so a new one is made when
+    they change.
+    """
+    global _reload_coordinator, _reload_coordinator_settings
+    settings = component.getUtility(ISettings)
+    if settings is not _reload_coordinator_settings:
+        haproxy = settings['haproxy']
+        check_reload = haproxy.getboolean('reload_check', fallback=False)
+        def _reload():
+            configurator = component.getUtility(IHaproxyConfigurator)
+            configurator.reload_config(check_reload=check_reload)
+        _reload_coordinator = ReloadCoordinator(_reload,
+                                                window=haproxy.getfloat('reload_window', fallback=0))
+        _reload_coordinator_settings = settings
+    return _reload_coordinator
 
 class InternalDNSNotReady(Exception):
     """
@@ -268,8 +1006,11 @@ class InternalDNSNotReady(Exception):
 
 def configure_haproxy(task, site_id, dns_name, dns_check_interval=1, dns_max_wait=30):
     """
-    Generate the haproxy backend and reload the configuration. Note
-    that the internal poddns name must exist for this to work. We expect
+    Generate the haproxy backend and reload the configuration, if
+    required. Returns a dictionary noting whether the backend went live
+    without a reload, whether our reload succeeded, so the setup needn't
+    reload again, and our timings. Note that the internal poddns name must exist
+    for this to work. We expect
     that to have completed before we are called or shortly after.
 
     TODO Ideally we would make this job dependent on the job generating
@@ -279,13 +1020,31 @@ def configure_haproxy(task, site_id, dns_name, dns_check_interval=1, dns_max_wai
     before everything.
     """
     configurator = component.getUtility(IHaproxyConfigurator)
-    configurator.add_backend(site_id, dns_name)
-
+    timer = PhaseTimer()
+    try:
+        with timer.phase('backend_write'):
+            live = configurator.add_backend(site_id, dns_name)
+    except InternalDNSNotReady as e:
+        # Pooled backends are pointed at the pod's address, so we need it now.
+        logger.info('%s. Trying again in %s seconds', e, dns_check_interval)
+        raise task.retry(countdown=dns_check_interval,
+                         max_retries=dns_max_wait // dns_check_interval)
+
+    if live:
+        logger.info('Backend for site=(%s) is live without a reload', site_id)
+        return {'live': True, 'timings': timer.as_dict()}
+
+    reloaded = False
     try:
-        configurator.reload_config()
+        with timer.phase('reload'):
+            reload_coordinator().request_reload(time.time())
+        reloaded = True
     except ConnectionError:
         # This is tightly coupled with the fact that we retry later
         logger.warn('ConnectionError when reloading config. Trying again later')
+    except HAProxyCommandException:
+        logger.exception('Reload failed. Trying again later')
+    return {'live': False, 'reloaded': reloaded, 'timings': timer.as_dict()}
 
 def mock_haproxy(task, *args, **kwargs):
     return mock_task(task, *args, **kwargs)
@@ -309,15 +1068,52 @@ class MockSetupHAProxyBackend(SetupHAProxyBackend):
     TC = mock_haproxy
 
 
+def remove_haproxy_backend(task, site_id):
+    """
+    Remove the haproxy backend and mappings of a deleted site, freeing
+    its slot if it has one, and reload if required.
+    """
+    configurator = component.getUtility(IHaproxyConfigurator)
+    timer = PhaseTimer()
+    with timer.phase('backend_remove'):
+        live = configurator.remove_backend(site_id)
+    if not live:
+        try:
+            with timer.phase('reload'):
+                reload_coordinator().request_reload(time.time())
+        except ConnectionError:
+            task.retry()
+    return {'live': live, 'timings': timer.as_dict()}
+
+@interface.implementer(IHaproxyRemoveBackendTask)
+class RemoveHAProxyBackend(AbstractTask):
+
+    NAME = 'remove_haproxy_backend'
+    TC = remove_haproxy_backend
+    QUEUE = 'tier1'
+
+    def __call__(self, site_id):
+        return self.task.apply_async((site_id,))
+
+
+@interface.implementer(IHaproxyRemoveBackendTask)
+class MockRemoveHAProxyBackend(RemoveHAProxyBackend):
+
+    NAME = 'mock_' + RemoveHAProxyBackend.NAME
+    TC = mock_haproxy
+
+
 def mock_reload(*args, **kwargs):
     return mock_task(*args, **kwargs)
 
-def reload_haproxy(task):
-    configurator = component.getUtility(IHaproxyConfigurator)
+def reload_haproxy(task, requested_at=None):
+    timer = PhaseTimer()
     try:
-        configurator.reload_config()
+        with timer.phase('reload'):
+            reload_coordinator().request_reload(requested_at)
     except ConnectionError:
         task.retry()
+    return {'timings': timer.as_dict()}
 
 @interface.implementer(IHaproxyReloadTask)
 class HAProxyReload(AbstractTask):
@@ -331,7 +1127,8 @@ class HAProxyReload(AbstractTask):
         super(HAProxyReload, cls).bind(app, max_retries=10, default_retry_delay=1)
 
     def __call__(self):
-        return self.task.apply_async()
+        # Any reload that starts after now satisfies this request
+        return self.task.apply_async(kwargs={'requested_at': time.time()})
 
 
 @interface.implementer(IHaproxyReloadTask)
@@ -90,11 +90,12 @@ class IEnvironmentProvisioner(interface.Interface):
     different levels of things we needed to initialize.
     """
 
-    def provision_environment(site_id, site_name, dns_name, customer_name, customer_email):
+    def provision_environment(site_id, site_name, dns_name, customer_name, customer_email, progress=None):
         """
         Setup a new environment for the provided site_id, with the given
         name and dns_name. We expect this is invoked on the machine that
-        will host the containers
+        will host the containers. If given, progress is called with a
+        description of each step as provisioning reaches it.
         """
 
 class IProvisionEnvironmentTask(IApplicationTask):
@@ -108,6 +109,56 @@ class IProvisionEnvironmentTask(IApplicationTask):
         site_id, site_name, and dns_name.
         """
 
+class IVolumePool(interface.Interface):
+    """
+    A host local pool of formatted data volumes, already seeded with
+    the dataserver, ready to be claimed by new environments.
+    """
+
+    def depth():
+        """
+        The number of volumes ready to be claimed.
+        """
+
+    def claim(target):
+        """
+        Move a ready volume to the path `target`, returning whether
+        there was one to claim.
+        """
+
+    def needs_refill():
+        """
+        Whether the pool has dropped below its low watermark.
+        """
+
+    def refill():
+        """
+        Build volumes until the pool is full, returning how many
+        were built.
+        """
+
+class IRefillVolumePoolTask(IApplicationTask):
+    """
+    A task that refills the IVolumePool of the host that runs it.
+    """
+
+    def __call__(host=None):
+        """
+        Dispatch the refill, to the given host if provided.
+        """
+
+class IPlacementPolicy(interface.Interface):
+    """
+    Chooses the host a new environment is provisioned on.
+    """
+
+    def choose(reports):
+        """
+        Given a sequence of host capacity reports, dictionaries as
+        produced by `placement.capacity_report`, return the report of
+        the host to use or None if no host is suitable.
+        """
+
 class IHaproxyBackendTask(IApplicationTask):
     """
     Sets up the new haproxy backend and configures
@@ -131,6 +182,18 @@ class IHaproxyReloadTask(IApplicationTask):
         """
 
 
+class IHaproxyRemoveBackendTask(IApplicationTask):
+    """
+    Removes the haproxy backend and mappings of a deleted site
+    """
+
+    def __call__(site_id):
+        """
+        Dispatch a task that removes the tier1 haproxy backend
+        and mappings for site_id.
+        """
+
+
 class IHaproxyConfigurator(interface.Interface):
     """
     An object capable of configuring haproxy
@@ -139,7 +202,20 @@ class IHaproxyConfigurator(interface.Interface):
     def add_backend(site_id, dns_name):
         """
         Configures an haproxy backend for the given site_id
-        and sets up an appropriate backend mapping
+        and sets up an appropriate backend mapping. Returns True
+        if the backend and mapping are live without a reload.
+        """
+
+    def add_mapping(site_id, dns_name):
+        """
+        Maps dns_name to the backend for site_id. Returns True
+        if the mapping is live without a reload.
+        """
+
+    def remove_backend(site_id):
+        """
+        Removes the haproxy backend and mappings for the given
+        site_id. Returns True if they are gone without a reload.
         """
 
     def reload_config():
@@ -181,6 +257,8 @@ class IInitializedSiteInfo(interface.Interface):
 
     ds_site_id = interface.Attribute('The dataserver site id/name that was created')
 
+    phase_timings = interface.Attribute('A dictionary of the seconds spent in each phase of the setup')
+
 class ISetupEnvironmentTask(IApplicationTask):
     """
     A composite task that creates and configures an environment.
@@ -194,6 +272,28 @@ class ISetupEnvironmentTask(IApplicationTask):
         group and returns a ISetupEnvironmentResult
         """
 
+    def stage_signatures(site_id, site_name, dns_name, name, email):
+        """
+        The signatures of the dns, haproxy and provisioning tasks for
+        a site, which a setup runs as a group.
+        """
+
+    def pipeline_signatures(step_options=None):
+        """
+        The signatures of the steps that follow the join of the group.
+        """
+
+class ISiteVerificationTask(IApplicationTask):
+    """
+    A task that verifies a batch of sites are accessible.
+    """
+
+    def __call__(site_infos, **options):
+        """
+        Dispatch a task that concurrently verifies each of the
+        IInitializedSiteInfo objects in site_infos.
+        """
+
 class ISettings(interface.Interface):
     """
     A dictionary like object providing configuration
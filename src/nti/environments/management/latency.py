@@ -0,0 +1,294 @@
+"""
+In process tracking of task latency.
+
+`TimerStore` holds the start times of running tasks' timers for the
+statsd signal handlers. `LatencyHistograms` keeps rolling histograms of
+each task's queue wait and runtime, so tail latency can be seen with
+the `latency` remote control command without going through statsd.
+
+Histograms are kept by the process that runs the task. With the
+threads, solo or gevent pools that is the worker process that answers
+remote control commands. Prefork children keep their own, which they
+add to the snapshots they write to `[monitoring] metrics_dir` (see
+`prometheus`), and the command merges those with the worker's own.
+Without a metrics directory only the worker's own are reported.
+"""
+
+import math
+import os
+import threading
+import time
+import weakref
+
+from collections import Counter
+from collections import OrderedDict
+from collections import deque
+
+from celery.worker.control import inspect_command
+
+from .prometheus import metrics_registry
+
+logger = __import__('logging').getLogger(__name__)
+
+_DEFAULT_MAX_TIMERS = 10000
+_DEFAULT_TIMER_TTL = 6 * 60 * 60 # seconds
+
+_DEFAULT_WINDOW = 300 # seconds
+_DEFAULT_WINDOW_SLOTS = 5
+_DEFAULT_PRECISION = 0.01
+
+#: The smallest latency a histogram distinguishes, in seconds
+_MIN_LATENCY = 1e-6
+
+#: The percentiles the latency command reports
+_REPORTED_QUANTILES = (('p50', 0.5), ('p95', 0.95), ('p99', 0.99))
+
+
+class TimerStore(object):
+    """
+    Start times of timers keyed by e.g. `(timer_name, task_name, task_id)`,
+    shared by all threads. A timer that is never stopped, because the
+    task was revoked or its worker killed, is evicted after `ttl`
+    seconds, and if more than `max_size` timers are running the oldest
+    are evicted.
+    """
+
+    def __init__(self, max_size=_DEFAULT_MAX_TIMERS, ttl=_DEFAULT_TIMER_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._timers = OrderedDict()
+
+    def __len__(self):
+        return len(self._timers)
+
+    def start(self, key, now=None):
+        """
+        Start the timer for key, returning how many timers were
+        evicted to make room for it.
+        """
+        now = time.monotonic() if now is None else now
+        evicted = 0
+        with self._lock:
+            self._timers.pop(key, None)
+            self._timers[key] = now
+            # Timers are in the order they started
+            while self._timers:
+                oldest_key, started = next(iter(self._timers.items()))
+                if len(self._timers) <= self.max_size and now - started < self.ttl:
+                    break
+                del self._timers[oldest_key]
+                evicted += 1
+        if evicted:
+            logger.debug('Evicted %i timer(s) that were never stopped', evicted)
+        return evicted
+
+    def stop(self, key, now=None):
+        """
+        Stop the timer for key, returning the elapsed seconds, or None
+        if it wasn't started or has been evicted.
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            started = self._timers.pop(key, None)
+        if started is None:
+            return None
+        return now - started
+
+
+class RollingHistogram(object):
+    """
+    A histogram of latencies recorded in the last `window` seconds.
+
+    Like an HDR histogram, values are counted in logarithmic buckets so
+    any percentile is reported to within `precision` of the recorded
+    value, using constant memory however many values are recorded. The
+    window is divided into `slots`, the oldest of which is dropped as
+    time moves on.
+    """
+
+    def __init__(self, window=_DEFAULT_WINDOW, slots=_DEFAULT_WINDOW_SLOTS,
+                 precision=_DEFAULT_PRECISION):
+        self.slots = slots
+        self._slot_seconds = window / slots
+        # Buckets are twice the precision wide, we report their middle
+        self._log_base = math.log1p(2 * precision)
+        self._counts = deque()
+
+    def _bucket(self, value):
+        if value <= _MIN_LATENCY:
+            return 0
+        return int(math.log(value / _MIN_LATENCY) / self._log_base) + 1
+
+    def _value(self, bucket):
+        if bucket == 0:
+            return 0.0
+        return _MIN_LATENCY * math.exp((bucket - 0.5) * self._log_base)
+
+    def _expire(self, now):
+        current = int(now // self._slot_seconds)
+        while self._counts and self._counts[0][0] <= current - self.slots:
+            self._counts.popleft()
+        return current
+
+    def record(self, value, now=None):
+        current = self._expire(time.monotonic() if now is None else now)
+        if not self._counts or self._counts[-1][0] != current:
+            self._counts.append((current, Counter()))
+        self._counts[-1][1][self._bucket(value)] += 1
+
+    def snapshot(self):
+        """
+        Returns the counts of each slot in the window as a json
+        compatible list, for `merge` in another process. Slots are
+        numbered by time.monotonic, which all processes share.
+        """
+        return [[slot, sorted(counts.items())] for slot, counts in self._counts]
+
+    def merge(self, snapshot):
+        """
+        Add the counts of a snapshot from another histogram with the
+        same window and precision.
+        """
+        slots = dict(self._counts)
+        for slot, counts in snapshot:
+            slots.setdefault(slot, Counter()).update(dict(counts))
+        self._counts = deque(sorted(slots.items()))
+
+    def _merged(self, now):
+        self._expire(time.monotonic() if now is None else now)
+        merged = Counter()
+        for _, counts in self._counts:
+            merged.update(counts)
+        return merged
+
+    def count(self, now=None):
+        return sum(self._merged(now).values())
+
+    def percentiles(self, quantiles, now=None):
+        """
+        Returns the value at each of quantiles, a sequence of
+        fractions, or Nones if nothing was recorded in the window.
+        """
+        merged = self._merged(now)
+        total = sum(merged.values())
+        if not total:
+            return [None for _ in quantiles]
+
+        buckets = sorted(merged.items())
+        results = []
+        for quantile in quantiles:
+            rank = max(math.ceil(quantile * total), 1)
+            seen = 0
+            for bucket, count in buckets:
+                seen += count
+                if seen >= rank:
+                    results.append(self._value(bucket))
+                    break
+        return results
+
+
+class LatencyHistograms(object):
+    """
+    A `RollingHistogram` for each task and kind of latency, e.g.
+    `runtime` or `queue_wait`.
+    """
+
+    def __init__(self, factory=RollingHistogram):
+        self.factory = factory
+        self._reset()
+        _all_histograms.add(self)
+
+    def _reset(self):
+        # Also called in a forked child, which starts from nothing
+        self._lock = threading.Lock()
+        self._histograms = {}
+
+    def _histogram(self, task_name, kind):
+        # Called with the lock held
+        try:
+            return self._histograms[(task_name, kind)]
+        except KeyError:
+            histogram = self._histograms[(task_name, kind)] = self.factory()
+            return histogram
+
+    def record(self, task_name, kind, seconds, now=None):
+        with self._lock:
+            self._histogram(task_name, kind).record(seconds, now)
+
+    def snapshot(self):
+        """
+        Returns our histograms as a json compatible list, see
+        RollingHistogram.snapshot.
+        """
+        with self._lock:
+            return [[task_name, kind, histogram.snapshot()]
+                    for (task_name, kind), histogram in self._histograms.items()]
+
+    def merge(self, snapshot):
+        with self._lock:
+            for task_name, kind, counts in snapshot:
+                self._histogram(task_name, kind).merge(counts)
+
+    def summary(self, now=None):
+        """
+        Returns `{task_name: {kind: {'count': n, 'p50': s, 'p95': s, 'p99': s}}}`
+        with latencies in seconds, for everything recorded in the window.
+        """
+        summary = {}
+        with self._lock:
+            for (task_name, kind), histogram in self._histograms.items():
+                count = histogram.count(now)
+                if not count:
+                    continue
+                values = histogram.percentiles([q for _, q in _REPORTED_QUANTILES], now)
+                report = {'count': count}
+                report.update(zip([name for name, _ in _REPORTED_QUANTILES], values))
+                summary.setdefault(task_name, {})[kind] = report
+        return summary
+
+    def clear(self):
+        with self._lock:
+            self._histograms.clear()
+
+
+_all_histograms = weakref.WeakSet()
+
+
+def _after_fork_in_child():
+    for each in list(_all_histograms):
+        each._reset()
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+#: The histograms of the tasks run by this process
+histograms = LatencyHistograms()
+
+#: The key our histograms are kept under in metrics snapshots
+SNAPSHOT_KEY = 'latency'
+
+
+def worker_histograms():
+    """
+    Returns LatencyHistograms of the tasks run by this process and,
+    if they write metrics snapshots, by the other processes of the
+    worker.
+    """
+    registry = metrics_registry()
+    if registry is None:
+        return histograms
+
+    merged = LatencyHistograms()
+    for snapshot, _ in registry.snapshots():
+        merged.merge(snapshot.get(SNAPSHOT_KEY, ()))
+    return merged
+
+
+@inspect_command()
+def latency(state):
+    """
+    Report the p50, p95 and p99 queue wait and runtime of each task
+    run recently by the worker, see LatencyHistograms.summary.
+    """
+    return worker_histograms().summary()
@@ -0,0 +1,207 @@
+"""
+Buffered statsd emission.
+
+Our signal handlers emit several metrics for every task, each of which
+the perfmetrics client sends as its own UDP packet. A
+`BufferedStatsdClient` gathers them in memory instead and sends them
+as multi-metric packets, whenever a packet is full and every
+`flush_interval` seconds.
+"""
+
+import fnmatch
+import os
+import threading
+import weakref
+
+from perfmetrics.interfaces import IStatsdClient
+from perfmetrics.statsd import statsd_client_from_uri
+
+from zope import interface
+
+logger = __import__('logging').getLogger(__name__)
+
+#: Fits in a single ethernet frame with room for the IP and UDP headers
+_DEFAULT_PACKET_SIZE = 1400
+_DEFAULT_FLUSH_INTERVAL = 1.0 # seconds
+
+_clients = weakref.WeakSet()
+
+
+def _after_fork_in_child():
+    for client in list(_clients):
+        client._reset()
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+def parse_sample_rates(value):
+    """
+    Parses lines of `<metric pattern> <rate>`, where the pattern may use
+    shell style wildcards, into a list of `(pattern, rate)`.
+    """
+    rates = []
+    for line in (value or '').splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        pattern, rate = line.rsplit(None, 1)
+        rate = float(rate)
+        if not 0 < rate <= 1:
+            raise ValueError('Sample rate for %s must be in (0, 1]: %s' % (pattern, rate))
+        rates.append((pattern, rate))
+    return rates
+
+
+@interface.implementer(IStatsdClient)
+class BufferedStatsdClient(object):
+    """
+    Wraps a `perfmetrics.statsd.StatsdClient`, buffering what it would
+    send and sending up to `packet_size` bytes of metrics per packet.
+
+    `sample_rates` is a sequence of `(pattern, rate)`, the first of
+    which whose pattern matches a metric's name sets the rate that
+    metric is sampled at unless the caller gives one.
+
+    A background thread flushes the buffer every `flush_interval`
+    seconds. Anything still buffered when the process exits is lost,
+    so call `flush` or `close` when shutting down.
+    """
+
+    def __init__(self, client, packet_size=_DEFAULT_PACKET_SIZE,
+                 flush_interval=_DEFAULT_FLUSH_INTERVAL, sample_rates=()):
+        self.client = client
+        self.packet_size = packet_size
+        self.flush_interval = flush_interval
+        self.sample_rates = list(sample_rates)
+        self._rates = {}
+        self._reset()
+        _clients.add(self)
+
+    def _reset(self):
+        # Also called in a forked child, where neither the parent's
+        # flush thread nor whoever held the lock exist. What the
+        # parent had buffered is the parent's to send.
+        self._lock = threading.Lock()
+        self._buf = []
+        self._size = 0
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _rate(self, stat, rate):
+        if rate != 1 or not self.sample_rates:
+            return rate
+        try:
+            return self._rates[stat]
+        except KeyError:
+            pass
+        for pattern, configured in self.sample_rates:
+            if fnmatch.fnmatchcase(stat, pattern):
+                rate = configured
+                break
+        self._rates[stat] = rate
+        return rate
+
+    def _emit(self, method, stat, value, rate, rate_applied):
+        lines = []
+        method(stat, value, rate=self._rate(stat, rate), buf=lines, rate_applied=rate_applied)
+        if not lines:
+            # Not sampled
+            return
+
+        line = lines[0]
+        with self._lock:
+            if self._thread is None:
+                self._start()
+            # Each line after the first costs a newline
+            if self._buf and self._size + 1 + len(line) > self.packet_size:
+                self._send()
+            self._buf.append(line)
+            self._size += len(line) + (1 if self._size else 0)
+
+    def _start(self):
+        self._thread = threading.Thread(target=self._run, name='statsd-flush', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stopped.wait(self.flush_interval):
+            self.flush()
+
+    def _send(self):
+        # Called with the lock held
+        buf, self._buf, self._size = self._buf, [], 0
+        self.client.sendbuf(buf)
+
+    def flush(self):
+        """
+        Send anything buffered now.
+        """
+        with self._lock:
+            if self._buf:
+                self._send()
+
+    def timing(self, stat, value, rate=1, buf=None, rate_applied=False):
+        if buf is not None:
+            self.client.timing(stat, value, self._rate(stat, rate), buf, rate_applied)
+            return
+        self._emit(self.client.timing, stat, value, rate, rate_applied)
+
+    def gauge(self, stat, value, rate=1, buf=None, rate_applied=False):
+        if buf is not None:
+            self.client.gauge(stat, value, self._rate(stat, rate), buf, rate_applied)
+            return
+        self._emit(self.client.gauge, stat, value, rate, rate_applied)
+
+    def incr(self, stat, count=1, rate=1, buf=None, rate_applied=False):
+        if buf is not None:
+            self.client.incr(stat, count, self._rate(stat, rate), buf, rate_applied)
+            return
+        self._emit(self.client.incr, stat, count, rate, rate_applied)
+
+    def decr(self, stat, count=1, rate=1, buf=None, rate_applied=False):
+        self.incr(stat, -count, rate=rate, buf=buf, rate_applied=rate_applied)
+
+    def set_add(self, stat, value, rate=1, buf=None, rate_applied=False):
+        if buf is not None:
+            self.client.set_add(stat, value, self._rate(stat, rate), buf, rate_applied)
+            return
+        self._emit(self.client.set_add, stat, value, rate, rate_applied)
+
+    def sendbuf(self, buf):
+        # The caller batched these itself, keep them in order with ours
+        self.flush()
+        self.client.sendbuf(buf)
+
+    def close(self):
+        """
+        Stop the flush thread, send anything buffered and close the
+        wrapped client.
+        """
+        self._stopped.set()
+        thread = self._thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+        self.flush()
+        self.client.close()
+
+
+def statsd_client_from_settings(settings):
+    """
+    Returns the statsd client configured by the `[statsd]` section of
+    settings, or None if there is no `statsd_uri`. If `packet_size` is
+    set the client is a `BufferedStatsdClient`.
+    """
+    if not settings.has_option('statsd', 'statsd_uri'):
+        return None
+
+    client = statsd_client_from_uri(settings.get('statsd', 'statsd_uri'))
+
+    packet_size = settings.getint('statsd', 'packet_size', fallback=0)
+    if packet_size <= 0:
+        return client
+
+    return BufferedStatsdClient(client,
+                                packet_size=packet_size,
+                                flush_interval=settings.getfloat('statsd', 'flush_interval',
+                                                                 fallback=_DEFAULT_FLUSH_INTERVAL),
+                                sample_rates=parse_sample_rates(settings.get('statsd', 'sample_rates',
+                                                                             fallback='')))
@@ -0,0 +1,359 @@
+"""
+Capacity aware placement of new environments on host systems.
+
+Every worker that consumes the any_host queue also consumes a queue of
+its own, see `host_queue`. When placement is enabled each such worker
+publishes a report of its host's load to the result backend every
+`report_interval` seconds, see `CapacityPublisher`. The setup task
+reads the published reports, rereading them in the background once
+they are `report_ttl` seconds old, and an IPlacementPolicy picks the
+host the provisioning task is routed to. If there are no recent
+reports, or no host is suitable, provisioning falls back to the shared
+any_host queue.
+
+Hosts also answer the `capacity` remote control command with their
+report, for people rather than for placement.
+"""
+
+import os
+import time
+import threading
+
+from celery import states
+
+from celery.signals import celeryd_after_setup
+
+from celery.worker.control import inspect_command
+
+from kombu import Exchange
+from kombu import Queue
+
+from perfmetrics import statsd_client
+
+from zope import component
+from zope import interface
+
+from .config import settings_sections
+
+from .interfaces import ISettings
+from .interfaces import IPlacementPolicy
+
+from .timing import hostname
+from .timing import _metric_safe
+
+logger = __import__('logging').getLogger(__name__)
+
+_HOST_QUEUE_PREFIX = 'host.'
+
+_DEFAULT_REPORT_INTERVAL = 5 # seconds
+_DEFAULT_REPORT_TTL = 10 # seconds
+_DEFAULT_REPORT_MAX_AGE = 30 # seconds
+_DEFAULT_MAX_PODS = 50
+_DEFAULT_MIN_FREE_MEMORY = 4 # GB
+_DEFAULT_MIN_FREE_DISK = 20 # GB
+
+
+def host_queue(host):
+    """
+    The queue only the workers on host consume.
+    """
+    name = _HOST_QUEUE_PREFIX + host
+    return Queue(name, Exchange('default', type='direct'), routing_key=name)
+
+
+def _available_memory():
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def _pod_count(root_dir):
+    try:
+        return sum(1 for entry in os.scandir(root_dir) if entry.is_dir() and entry.name.startswith('S'))
+    except OSError:
+        return 0
+
+
+def capacity_report(settings=None):
+    """
+    Describe the capacity of this host. Memory and disk are in bytes,
+    load is the one minute load average.
+    """
+    if settings is None:
+        settings = component.getUtility(ISettings)['pods']
+
+    host = hostname()
+    volumes = settings.get('volumes_dir', '/opt/volumes')
+    try:
+        st = os.statvfs(volumes)
+        disk_free = st.f_bavail * st.f_frsize
+    except OSError:
+        disk_free = None
+
+    return {'host': host,
+            'queue': host_queue(host).name,
+            'pods': _pod_count(settings['root_dir']),
+            'memory_free': _available_memory(),
+            'disk_free': disk_free,
+            'load': os.getloadavg()[0],
+            'cpus': os.cpu_count() or 1,
+            'reported_at': time.time()}
+
+
+@inspect_command()
+def capacity(state):
+    """
+    Report this host's capacity, see capacity_report.
+    """
+    return capacity_report()
+
+
+@celeryd_after_setup.connect
+def consume_host_queue(sender, instance, **kwargs):
+    """
+    Workers that can host environments also consume their own queue.
+    """
+    queues = instance.app.amqp.queues
+    if 'any_host' in queues.consume_from:
+        queue = host_queue(hostname())
+        logger.info('Consuming from host queue %s', queue.name)
+        queues.select_add(queue)
+
+
+@interface.implementer(IPlacementPolicy)
+class CapacityPlacementPolicy(object):
+    """
+    Excludes hosts that have `max_pods` environments, or less than
+    `min_free_memory` or `min_free_disk` GB free, and picks the host
+    with the lowest score: the fraction of `max_pods` in use plus the
+    load per cpu.
+    """
+
+    def __init__(self, max_pods=_DEFAULT_MAX_PODS,
+                 min_free_memory=_DEFAULT_MIN_FREE_MEMORY,
+                 min_free_disk=_DEFAULT_MIN_FREE_DISK):
+        self.max_pods = max_pods
+        self.min_free_memory = min_free_memory * 1024 ** 3
+        self.min_free_disk = min_free_disk * 1024 ** 3
+
+    def eligible(self, report):
+        if report['pods'] >= self.max_pods:
+            return False
+        if report.get('memory_free') is not None and report['memory_free'] < self.min_free_memory:
+            return False
+        if report.get('disk_free') is not None and report['disk_free'] < self.min_free_disk:
+            return False
+        return True
+
+    def score(self, report):
+        return report['pods'] / self.max_pods + report['load'] / max(report.get('cpus') or 1, 1)
+
+    def choose(self, reports):
+        candidates = [report for report in reports if self.eligible(report)]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda report: (self.score(report), report['host']))
+
+
+@settings_sections('placement')
+def _placement_policy_factory():
+    settings = component.getUtility(ISettings)
+    return CapacityPlacementPolicy(settings.getint('placement', 'max_pods', fallback=_DEFAULT_MAX_PODS),
+                                   settings.getfloat('placement', 'min_free_memory',
+                                                     fallback=_DEFAULT_MIN_FREE_MEMORY),
+                                   settings.getfloat('placement', 'min_free_disk',
+                                                     fallback=_DEFAULT_MIN_FREE_DISK))
+
+
+#: Where the result backend holds the hosts that have published a report
+_HOSTS_KEY = 'nti.capacity.hosts'
+
+
+def _report_key(host):
+    return 'nti.capacity.%s' % host
+
+
+def _stored(backend, key):
+    # Stored results are ready, so the backend would cache them forever
+    meta = backend.get_task_meta(key, cache=False)
+    return meta.get('result') if meta.get('status') == states.SUCCESS else None
+
+
+class CapacityPublisher(object):
+    """
+    Periodically stores this host's capacity report in the app's
+    result backend, where CapacityReports finds it. `settings` is
+    passed to capacity_report.
+    """
+
+    def __init__(self, app, interval, settings=None):
+        self.app = app
+        self.interval = interval
+        self.settings = settings
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def publish(self):
+        report = capacity_report(self.settings)
+        backend = self.app.backend
+        backend.store_result(_report_key(report['host']), report, states.SUCCESS)
+        # Hosts joining at once may lose each other's update of the
+        # list, but each adds itself back the next time it publishes.
+        hosts = _stored(backend, _HOSTS_KEY) or []
+        if report['host'] not in hosts:
+            backend.store_result(_HOSTS_KEY, sorted(set(hosts) | {report['host']}), states.SUCCESS)
+        return report
+
+    def _run(self):
+        while True:
+            try:
+                self.publish()
+            except Exception: # pylint: disable=broad-except
+                logger.exception('Unable to publish capacity report')
+            if self._stopped.wait(self.interval):
+                return
+
+    def start(self):
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name='capacity-publisher', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+def capacity_publisher(app, settings):
+    """
+    Returns a CapacityPublisher for app if placement is enabled,
+    otherwise None.
+    """
+    if not settings.getboolean('placement', 'enabled', fallback=False):
+        return None
+    return CapacityPublisher(app, settings.getfloat('placement', 'report_interval',
+                                                    fallback=_DEFAULT_REPORT_INTERVAL))
+
+
+class CapacityReports(object):
+    """
+    The capacity reports the hosts have published in the last
+    `max_age` seconds.
+
+    Asking for the reports never waits on the result backend. They are
+    read in the background the first time they are asked for and again
+    once they are `ttl` seconds old; until then we answer with what we
+    have, which may be nothing.
+    """
+
+    def __init__(self, ttl=_DEFAULT_REPORT_TTL, max_age=_DEFAULT_REPORT_MAX_AGE):
+        self.ttl = ttl
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._reports = []
+        self._fetched_at = None
+        self._refreshing = None
+
+    def reports(self, app):
+        with self._lock:
+            stale = self._fetched_at is None or time.monotonic() - self._fetched_at > self.ttl
+            if stale and self._refreshing is None:
+                self._refreshing = threading.Thread(target=self._refresh, args=(app,),
+                                                    name='capacity-reports', daemon=True)
+                self._refreshing.start()
+            return list(self._reports)
+
+    def _refresh(self, app):
+        try:
+            reports = self._fetch(app)
+        except Exception: # pylint: disable=broad-except
+            logger.exception('Unable to read host capacity reports')
+            reports = None
+        with self._lock:
+            if reports is not None:
+                self._reports = reports
+            # Wait out the ttl before trying again either way
+            self._fetched_at = time.monotonic()
+            self._refreshing = None
+
+    def _fetch(self, app):
+        backend = app.backend
+        now = time.time()
+        reports = []
+        for host in _stored(backend, _HOSTS_KEY) or ():
+            report = _stored(backend, _report_key(host))
+            if not isinstance(report, dict):
+                continue
+            if now - report.get('reported_at', 0) > self.max_age:
+                logger.debug('Ignoring stale capacity report from %s', host)
+                continue
+            reports.append(report)
+        logger.debug('Read capacity reports from %s', sorted(r['host'] for r in reports))
+        return reports
+
+    def placed(self, report):
+        """
+        Note that we placed an environment on the host of report, so
+        we don't put everything on one host until the reports refresh.
+        """
+        with self._lock:
+            report['pods'] += 1
+
+
+_capacity_reports = None
+_capacity_reports_settings = None
+
+def capacity_reports():
+    """
+    The process wide CapacityReports, configured from [placement]. A
+    new one is made when the settings are reloaded.
+    """
+    global _capacity_reports, _capacity_reports_settings
+    settings = component.getUtility(ISettings)
+    if settings is not _capacity_reports_settings:
+        _capacity_reports = CapacityReports(settings.getfloat('placement', 'report_ttl',
+                                                              fallback=_DEFAULT_REPORT_TTL),
+                                            settings.getfloat('placement', 'report_max_age',
+                                                              fallback=_DEFAULT_REPORT_MAX_AGE))
+        _capacity_reports_settings = settings
+    return _capacity_reports
+
+
+def placement_enabled():
+    settings = component.queryUtility(ISettings)
+    return settings is not None \
+        and settings.has_section('placement') \
+        and settings['placement'].getboolean('enabled', fallback=False)
+
+
+def choose_host_queue(app):
+    """
+    Returns the queue of the host a new environment should be
+    provisioned on, or None to let any host take it.
+    """
+    reports = capacity_reports()
+    try:
+        candidates = reports.reports(app)
+    except Exception: # pylint: disable=broad-except
+        logger.exception('Unable to collect host capacity reports')
+        return None
+
+    choice = component.getUtility(IPlacementPolicy).choose(candidates)
+    statsd = statsd_client()
+    if choice is None:
+        logger.warning('No suitable host among %i capacity report(s)', len(candidates))
+        if statsd is not None:
+            statsd.incr('environments.placement.unplaced')
+        return None
+
+    reports.placed(choice)
+    logger.info('Placing environment on %s', choice['host'])
+    if statsd is not None:
+        statsd.incr('environments.placement.placed.%s' % _metric_safe(choice['host']))
+    return host_queue(choice['host'])
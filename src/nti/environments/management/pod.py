@@ -1,23 +1,76 @@
 import os
+import re
+import hmac
 import json
 import time
+import base64
+import ctypes
+import ctypes.util
+import select
+import shlex
+import shutil
+import socket
+import hashlib
+import datetime
+import tempfile
+import threading
 
 import subprocess
 
+from collections import deque
+
+from contextlib import contextmanager
+
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+
+from http.client import HTTPException
+
+import boto3
+
 from zope import component
 from zope import interface
 
+from .config import settings_sections
+
 from .interfaces import IEnvironmentProvisioner
 from .interfaces import IProvisionEnvironmentTask
 from .interfaces import ISettings
+from .interfaces import IVolumePool
+from .interfaces import IRefillVolumePoolTask
+
+from .prometheus import metrics_registry
 
+from .aws import AWSClientPool
+
+from .tasks import SiteInfo
 from .tasks import AbstractTask
 from .tasks import mock_task
+from .tasks import verify_site_socket
+from .tasks import _UnixSocketHTTPConnection
+
+from .timing import PhaseTimer
+from .timing import hostname
 
 logger = __import__('logging').getLogger(__name__)
 
 _MAX_SLEEP = 120
 
+@contextmanager
+def _timed_subprocess(command):
+    """
+    Observe how long the body, running command, takes, failed or not.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        registry = metrics_registry()
+        if registry is not None:
+            registry.observe('nti_provisioning_subprocess_seconds', time.perf_counter() - start,
+                             command=os.path.basename(command))
+
 def _mock_init_pod_env(task, site_id, site_name, dns_name, customer_name, customer_email):
     """
     A mock task that simulates an environment pod being spun up.
@@ -53,31 +106,100 @@ def _mock_init_pod_env(task, site_id, site_name, dns_name, customer_name, custom
     return result
 
 
+def _progress_reporter(task, site_id):
+    """
+    Returns a callable that publishes provisioning progress as the
+    task's state, so callers can watch it with AsyncResult.info.
+    """
+    def _report(step):
+        logger.info('Provisioning site=(%s) progress: %s', site_id, step)
+        if task.request.id is None:
+            return
+        task.update_state(state=PROVISIONING_STATE, meta={'site_id': site_id, 'step': step})
+    return _report
+
 def _init_pod_env(task, site_id, site_name, dns_name, customer_name, customer_email):
     provisioner = component.getUtility(IEnvironmentProvisioner)
-    result = provisioner.provision_environment(site_id, site_name, dns_name, customer_name, customer_email)
+    timer = PhaseTimer()
+    with timer.phase('provision'):
+        result = provisioner.provision_environment(site_id, site_name, dns_name, customer_name, customer_email,
+                                                   progress=_progress_reporter(task, site_id))
+
+    if component.getUtility(ISettings)['pods'].getboolean('verify_socket', fallback=False):
+        # We're on the host, so verify the dataserver directly rather
+        # than waiting on public dns to propagate.
+        site_info = SiteInfo(site_id, dns_name)
+        with timer.phase('socket_verify'):
+            verify_site_socket(site_info, _pod_dataserver_socket(site_id))
+        result['socket_verified'] = True
+        result['ds_site_id'] = site_info.ds_site_id
+
+    pool = component.queryUtility(IVolumePool)
+    if pool is not None and pool.needs_refill():
+        logger.info('Volume pool is below its low watermark. Dispatching refill')
+        IRefillVolumePoolTask(task._get_app())(hostname())
+
+    result['timings'] = timer.as_dict()
     return result
 
 def _pod_root_init_log(podid):
     settings = component.getUtility(ISettings)['pods']
     return os.path.join(settings['root_dir'], podid, settings['pod_logs_dir'], 'init.log')
 
+def _pod_dataserver_socket(podid):
+    settings = component.getUtility(ISettings)['pods']
+    return os.path.join(settings['root_dir'], podid,
+                        settings.get('dataserver_socket', 'dataserver/run/dataserver.sock'))
+
+
+#: The celery state reported while provisioning is under way
+PROVISIONING_STATE = 'PROVISIONING'
+
+#: Lines on the provisioning script's stderr starting with this are
+#: reported as progress. bin/init_pod_environment marks the start of
+#: each step, named as in default_provisioning_steps.
+PROGRESS_MARKER = 'PROGRESS:'
+
+_DEFAULT_OUTPUT_TAIL = 200
 
 @interface.implementer(IEnvironmentProvisioner)
 class EnvironmentProvisioner(object):
+    """
+    Provisions environments by running `script_name`. The script logs
+    to stderr, which we save as the pod's init.log, and writes a json
+    object describing the environment to stdout.
+
+    By default the script's output is collected once it exits. With
+    `stream` enabled, stderr is instead written to the log file and
+    our logger line by line while the script runs, only the last
+    `output_tail` lines are kept in memory, and lines starting with
+    PROGRESS_MARKER are reported as progress.
+    """
 
-    def __init__(self, script_name):
+    def __init__(self, script_name, stream=False, output_tail=_DEFAULT_OUTPUT_TAIL):
         self.script_name = script_name
+        self.stream = stream
+        self.output_tail = output_tail
 
-    def provision_environment(self, site_id, site_name, dns_name, customer_name, customer_email):
+    def provision_environment(self, site_id, site_name, dns_name, customer_name, customer_email, progress=None):
         logger.info('Provisioning environment using %s for site=(%s) name=(%s) dns_name=(%s)',
                     self.script_name, site_id, site_name, dns_name)
-        completed_process = subprocess.run([self.script_name, site_id, site_name, dns_name, customer_name, customer_email],
-                                           check=False,
-                                           stderr=subprocess.PIPE,
-                                           stdout=subprocess.PIPE,
-                                           encoding='utf-8',
-                                           shell=False)
+        args = [self.script_name, site_id, site_name, dns_name, customer_name, customer_email]
+        if self.stream:
+            stdout = self._stream_provisioning(args, site_id, progress)
+        else:
+            stdout = self._run_provisioning(args, site_id)
+        assert stdout is not None
+        return dict(json.loads(stdout))
+
+    def _run_provisioning(self, args, site_id):
+        with _timed_subprocess(self.script_name):
+            completed_process = subprocess.run(args,
+                                               check=False,
+                                               stderr=subprocess.PIPE,
+                                               stdout=subprocess.PIPE,
+                                               encoding='utf-8',
+                                               shell=False)
 
         logger.info('Provisioning environment for site=(%s) completed with code=(%i)',
                     site_id, completed_process.returncode)
@@ -99,13 +221,737 @@ class EnvironmentProvisioner(object):
         # Check out return code which will raise if things failed
         completed_process.check_returncode()
 
-        stdout = completed_process.stdout
-        assert stdout is not None
-        return dict(json.loads(stdout))
+        return completed_process.stdout
+
+    def _stream_provisioning(self, args, site_id, progress):
+        log_location = _pod_root_init_log(site_id)
+        try:
+            log = open(log_location, 'x')
+        except OSError:
+            logger.exception('Unable to write log file to %s.', log_location)
+            raise
+
+        tail = deque(maxlen=self.output_tail)
+        with log, _timed_subprocess(self.script_name), \
+             subprocess.Popen(args,
+                              stderr=subprocess.PIPE,
+                              stdout=subprocess.PIPE,
+                              encoding='utf-8',
+                              shell=False) as process:
+            # Drain stdout alongside stderr so a chatty script can't
+            # block on a full pipe.
+            stdout = []
+            reader = threading.Thread(target=lambda: stdout.append(process.stdout.read()),
+                                      name='provisioner-stdout-%s' % site_id)
+            reader.daemon = True
+            reader.start()
+
+            for line in process.stderr:
+                log.write(line)
+                log.flush()
+                line = line.rstrip('\n')
+                tail.append(line)
+                logger.debug('%s for site=(%s) produced output: %s', self.script_name, site_id, line)
+                if progress is not None and line.startswith(PROGRESS_MARKER):
+                    progress(line[len(PROGRESS_MARKER):].strip())
+
+            reader.join()
+            returncode = process.wait()
+
+        logger.info('Provisioning environment for site=(%s) completed with code=(%i)',
+                    site_id, returncode)
+
+        if returncode:
+            raise subprocess.CalledProcessError(returncode, args,
+                                                output=stdout[0] if stdout else None,
+                                                stderr='\n'.join(tail))
+        return stdout[0] if stdout else None
+
+#: Where the native provisioner finds things on the host by default
+_DEFAULT_VOLUMES_DIR = '/opt/volumes'
+_DEFAULT_SKELETON = '/usr/local/share/nti/dataserver'
+_DEFAULT_CREDENTIALS_DIR = '/root/pods'
+_DEFAULT_CONTAINER_ENV = ('/etc/nti/container_versions',
+                          '/usr/local/lib/nti/nti-container-functions')
+_DEFAULT_IAM_PROFILE = 'legacy'
+_DEFAULT_IAM_POLICIES = ('arn:aws:iam::569451255149:policy/NTI-SQS-ReadWriteAccess',
+                         'arn:aws:iam::569451255149:policy/NTISesSendingAccess')
+_DEFAULT_SMTP_SERVER = 'email-smtp.us-east-1.amazonaws.com'
+_DEFAULT_SES_REGION = 'us-east-1'
+_DEFAULT_VOLUME_SIZE = 20 # GB
+_DEFAULT_SOCKET_WAIT = 300 # seconds
+_DEFAULT_PROVISION_WORKERS = 4
+
+_SELINUX_CONTAINER_LABEL = 'system_u:object_r:container_file_t:s0'
+
+_INVITATION_MIMETYPE = 'application/vnd.nextthought.siteadmininvitation'
+
+# From <sys/inotify.h>
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+
+_libc = None
+
+def _load_libc():
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    return _libc
+
+
+class _INotify(object):
+    """
+    A minimal inotify watch on a directory, through ctypes. Raises
+    OSError if inotify isn't available.
+    """
+
+    def __init__(self, directory, mask=_IN_CREATE | _IN_MOVED_TO):
+        try:
+            libc = _load_libc()
+            init, add_watch = libc.inotify_init1, libc.inotify_add_watch
+        except (OSError, AttributeError) as e:
+            raise OSError('inotify unavailable: %s' % e)
+
+        # IN_NONBLOCK and IN_CLOEXEC share their values with the O_ flags
+        self.fd = init(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        if add_watch(self.fd, os.fsencode(directory), mask) < 0:
+            err = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(err, 'inotify_add_watch failed', directory)
+
+    def wait(self, timeout):
+        """
+        Wait up to timeout seconds for events, discarding them. Returns
+        whether any arrived.
+        """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return False
+        try:
+            while os.read(self.fd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+        return True
+
+    def close(self):
+        os.close(self.fd)
+
+
+def wait_for_path(path, timeout, poll_interval=1):
+    """
+    Wait for path to exist, returning False if it doesn't within
+    timeout seconds. We're woken by inotify when something is created
+    in path's directory, falling back to checking every poll_interval
+    seconds if we can't watch it, for example because the directory
+    doesn't exist yet.
+    """
+    deadline = time.monotonic() + timeout
+    try:
+        watch = _INotify(os.path.dirname(path) or '.')
+    except OSError as e:
+        logger.debug('Polling for %s. %s', path, e)
+        watch = None
+
+    try:
+        while not os.path.exists(path):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            if watch is not None:
+                watch.wait(min(remaining, poll_interval))
+            else:
+                time.sleep(min(remaining, poll_interval))
+        return True
+    finally:
+        if watch is not None:
+            watch.close()
+
+
+def ses_smtp_password(secret_access_key, region):
+    """
+    Derive the SES smtp password for an IAM secret access key, like
+    bin/computeSEScreds.
+    """
+    def _sign(key, msg):
+        return hmac.new(key, msg.encode('utf-8'), hashlib.sha256).digest()
+
+    signature = ('AWS4' + secret_access_key).encode('utf-8')
+    for msg in ('11111111', region, 'ses', 'aws4_request', 'SendRawEmail'):
+        signature = _sign(signature, msg)
+    return base64.b64encode(bytes([0x04]) + signature).decode('utf-8')
+
+
+_XML_ESCAPES = {'&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', "'": '&#39;'}
+
+def _xml_escape(value):
+    return ''.join(_XML_ESCAPES.get(c, c) for c in value)
+
+
+def render_template(source, target, values):
+    """
+    Write source to target replacing each `$NAME` for the keys of values.
+    Anything else that looks like a variable is left alone.
+    """
+    pattern = re.compile(r'\$(%s)' % '|'.join(sorted(map(re.escape, values), key=len, reverse=True)))
+    with open(source) as f:
+        rendered = pattern.sub(lambda m: values[m.group(1)], f.read())
+    with open(target, 'w') as f:
+        f.write(rendered)
+
+
+def _copy_tree(source, target):
+    """
+    Copy source into target preserving modes, times and ownership, like
+    `rsync --archive`.
+    """
+    for dirpath, dirnames, filenames in os.walk(source):
+        dest = os.path.join(target, os.path.relpath(dirpath, source))
+        os.makedirs(dest, exist_ok=True)
+        for name in dirnames + filenames:
+            src = os.path.join(dirpath, name)
+            dst = os.path.join(dest, name)
+            if os.path.islink(src):
+                os.symlink(os.readlink(src), dst)
+            elif os.path.isfile(src):
+                shutil.copy2(src, dst)
+            else:
+                continue
+            st = os.lstat(src)
+            os.chown(dst, st.st_uid, st.st_gid, follow_symlinks=False)
+        shutil.copystat(dirpath, dest)
+        st = os.stat(dirpath)
+        os.chown(dest, st.st_uid, st.st_gid)
+
+
+def _socket_response(socket_path, method, path, host, timeout, headers=None, body=None):
+    """
+    Make an http request to the server listening on socket_path,
+    returning the response status and body.
+    """
+    conn = _UnixSocketHTTPConnection(socket_path, host, timeout)
+    try:
+        conn.request(method, path, body=body, headers=headers or {})
+        resp = conn.getresponse()
+        return resp.status, resp.read()
+    finally:
+        conn.close()
+
+
+def _socket_request(socket_path, method, path, host, timeout, headers=None, body=None):
+    """
+    Make an http request to the server listening on socket_path,
+    returning the decoded json response.
+    """
+    status, data = _socket_response(socket_path, method, path, host, timeout,
+                                    headers=headers, body=body)
+    if status >= 400:
+        raise ProvisioningError('%s %s returned %i' % (method, path, status))
+    return json.loads(data) if data else None
+
+
+class ProvisioningError(Exception):
+    """
+    A provisioning step failed.
+    """
+
+
+class ProvisioningContext(object):
+    """
+    The state shared by the steps provisioning one environment. Steps
+    add what they learn as attributes and build up `result`, which is
+    what the provisioner returns.
+    """
+
+    access_key_id = None
+    secret_access_key = None
+    #: Whether the data volume already contains the dataserver
+    seeded = False
+
+    def __init__(self, site_id, site_name, dns_name, customer_name, customer_email,
+                 pod_root, volume):
+        self.site_id = site_id
+        self.ds_site_id = site_id.lower()
+        self.site_name = site_name
+        self.dns_name = dns_name
+        self.customer_name = customer_name
+        self.customer_email = customer_email
+        self.pod_root = pod_root
+        self.volume = volume
+        self.new_volume = not os.path.exists(volume)
+        self.result = {}
+        # The log ends up in the pod, which isn't mounted yet
+        self.log = tempfile.TemporaryFile('w+')
+        self._log_lock = threading.Lock()
+
+    @property
+    def dataserver_root(self):
+        return os.path.join(self.pod_root, 'dataserver')
+
+    def info(self, msg, *args):
+        logger.info('site=(%s) ' + msg, self.site_id, *args)
+        with self._log_lock:
+            self.log.write('%s: %s\n' % (datetime.datetime.now().ctime(), msg % args))
+            self.log.flush()
 
+    def run(self, *args, name=None):
+        """
+        Run a command, sending its output to our log. Its duration is
+        recorded under name, which defaults to the command's.
+        """
+        logger.debug('site=(%s) Running %s', self.site_id, args)
+        with self._log_lock:
+            self.log.flush()
+        with _timed_subprocess(name or args[0]):
+            subprocess.run(args, check=True, stdout=self.log, stderr=subprocess.STDOUT, shell=False)
+
+
+class ProvisioningStep(object):
+    """
+    A named unit of provisioning work. Steps are called with the
+    ProvisioningContext. A step that raises is tried again, up to
+    `tries` times in total, `retry_delay` seconds later. Steps with
+    `only_new` set only run when we are creating a new data volume.
+
+    `requires` names the steps that must complete before this one
+    starts. Steps that aren't run are treated as complete. If it is
+    None the step requires the step before it, so steps that don't say
+    otherwise run in order.
+    """
+
+    name = None
+    only_new = True
+    requires = None
+
+    def __init__(self, tries=1, retry_delay=1, requires=None):
+        self.tries = tries
+        self.retry_delay = retry_delay
+        if requires is not None:
+            self.requires = tuple(requires)
+
+    def __call__(self, context):
+        raise NotImplementedError()
+
+
+class ContainerFunctionStep(ProvisioningStep):
+    """
+    Runs one of the shell functions from the host's container
+    environment, passing the pod id and any extra arguments.
+    """
+
+    def __init__(self, name, function, args_factory=lambda context: (context.site_id,),
+                 container_env=_DEFAULT_CONTAINER_ENV, only_new=True, **kwargs):
+        super(ContainerFunctionStep, self).__init__(**kwargs)
+        self.name = name
+        self.function = function
+        self.args_factory = args_factory
+        self.container_env = container_env
+        self.only_new = only_new
+
+    def __call__(self, context):
+        script = ' && '.join(['source %s' % shlex.quote(f) for f in self.container_env] + ['"$@"'])
+        context.run('bash', '-c', script, 'bash', self.function, *self.args_factory(context),
+                    name=self.function)
+
+
+class IAMCredentialsStep(ProvisioningStep):
+    """
+    Ensures the pod has an IAM user with an access key, saved in
+    `credentials_dir`, and attaches `policies` to new users.
+    """
+
+    name = 'iam_credentials'
+    only_new = False
+
+    def __init__(self, credentials_dir=_DEFAULT_CREDENTIALS_DIR, policies=_DEFAULT_IAM_POLICIES,
+                 clients=None, **kwargs):
+        super(IAMCredentialsStep, self).__init__(**kwargs)
+        self.credentials_dir = credentials_dir
+        self.policies = policies
+        self.clients = clients if clients is not None else AWSClientPool()
+
+    def _create_access_key(self, client, user):
+        try:
+            client.get_user(UserName=user)
+        except client.exceptions.NoSuchEntityException:
+            client.create_user(UserName=user)
+        key = client.create_access_key(UserName=user)
+        for policy in self.policies:
+            client.attach_user_policy(UserName=user, PolicyArn=policy)
+        return key
+
+    def __call__(self, context):
+        path = os.path.join(self.credentials_dir, context.site_id + '.json')
+        if not os.path.exists(path):
+            context.info('Creating access key for IAM user %s', context.site_id)
+            key = self.clients.invoke('iam', self._create_access_key, context.site_id)
+            os.makedirs(self.credentials_dir, exist_ok=True)
+            with open(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), 'w') as f:
+                json.dump({'AccessKey': key['AccessKey']}, f, default=str)
+
+        with open(path) as f:
+            key = json.load(f)['AccessKey']
+        context.access_key_id = key['AccessKeyId']
+        context.secret_access_key = key['SecretAccessKey']
+
+
+class AllocateVolumeStep(ProvisioningStep):
+    """
+    Creates the pod's sparse data volume and formats it, unless we can
+    claim a seeded volume from `pool`, an IVolumePool.
+    """
+
+    name = 'allocate_volume'
+
+    def __init__(self, size=_DEFAULT_VOLUME_SIZE, pool=None, **kwargs):
+        super(AllocateVolumeStep, self).__init__(**kwargs)
+        self.size = size
+        self.pool = pool
+
+    def __call__(self, context):
+        if self.pool is not None and self.pool.claim(context.volume):
+            context.info('Claimed a warm data volume for pod %s', context.site_id)
+            context.seeded = True
+            return
+
+        context.info('Creating and initializing data volume for pod %s', context.site_id)
+        with open(context.volume, 'x') as f:
+            f.truncate(self.size * 1024 ** 3)
+        context.run('mkfs.xfs', context.volume)
+
+
+class SeedDataserverStep(ProvisioningStep):
+    """
+    Copies the dataserver skeleton into the pod.
+    """
+
+    name = 'seed_dataserver'
+
+    def __init__(self, skeleton=_DEFAULT_SKELETON, **kwargs):
+        super(SeedDataserverStep, self).__init__(**kwargs)
+        self.skeleton = skeleton
+
+    def __call__(self, context):
+        if context.seeded:
+            return
+        _copy_tree(self.skeleton, context.dataserver_root)
+
+
+class RenderTemplatesStep(ProvisioningStep):
+    """
+    Renders the site specific dataserver configuration from the `.in`
+    templates in the skeleton, then labels the pod for container access.
+    """
+
+    name = 'render_templates'
+
+    def __init__(self, skeleton=_DEFAULT_SKELETON, smtp_server=_DEFAULT_SMTP_SERVER,
+                 ses_region=_DEFAULT_SES_REGION, solr_host='', label=True, **kwargs):
+        super(RenderTemplatesStep, self).__init__(**kwargs)
+        self.skeleton = skeleton
+        self.smtp_server = smtp_server
+        self.ses_region = ses_region
+        self.solr_host = solr_host
+        self.label = label
+
+    def _templates(self, context):
+        return (('.boto', {'ACCESS_KEY_ID': context.access_key_id,
+                           'SECRET_ACCESS_KEY': context.secret_access_key}),
+                ('etc/pserve.ini', {'SMTP_SERVER': self.smtp_server,
+                                    'SMTP_USER': context.access_key_id,
+                                    'SMTP_PASSWORD': ses_smtp_password(context.secret_access_key,
+                                                                       self.ses_region)}),
+                ('etc/package-includes/777-nti.app.analytics.zcml', {'SITE_ID': context.ds_site_id,
+                                                                     'SITE_NAME': _xml_escape(context.site_name),
+                                                                     'SITE_HOSTNAME': context.dns_name}),
+                ('etc/package-includes/785-nti.app.solr.zcml', {'SOLR_HOST': self.solr_host}))
+
+    def __call__(self, context):
+        for name, values in self._templates(context):
+            render_template(os.path.join(self.skeleton, name + '.in'),
+                            os.path.join(context.dataserver_root, name),
+                            values)
+        if self.label:
+            context.run('chcon', '-R', _SELINUX_CONTAINER_LABEL, context.pod_root)
+
+
+class StartPodStep(ProvisioningStep):
+    """
+    Starts the pod's containers, initializing them if the volume is new.
+    """
+
+    name = 'start_pod'
+    only_new = False
+
+    def __init__(self, command='start_pod_environment', **kwargs):
+        super(StartPodStep, self).__init__(**kwargs)
+        self.command = command
+
+    def __call__(self, context):
+        context.run(self.command, context.site_id, 'init' if context.new_volume else 'normal')
+
+
+class AwaitDataserverStep(ProvisioningStep):
+    """
+    Waits for the dataserver socket to appear and the dataserver to
+    answer a ping on it successfully, asking again every
+    `poll_interval` seconds until `timeout`. Only the status of the
+    ping matters, not what it says.
+    """
+
+    name = 'await_dataserver'
+
+    def __init__(self, socket_name='dataserver/run/dataserver.sock', timeout=_DEFAULT_SOCKET_WAIT,
+                 poll_interval=1, **kwargs):
+        super(AwaitDataserverStep, self).__init__(**kwargs)
+        self.socket_name = socket_name
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+
+    def __call__(self, context):
+        socket_path = context.socket_path = os.path.join(context.pod_root, self.socket_name)
+        context.info('Waiting for dataserver socket')
+        deadline = time.monotonic() + self.timeout
+        if not wait_for_path(socket_path, self.timeout):
+            raise ProvisioningError('Dataserver socket %s never appeared' % socket_path)
+        context.info('Dataserver socket available. Checking if the dataserver is up.')
+        while True:
+            remaining = deadline - time.monotonic()
+            try:
+                status, _ = _socket_response(socket_path, 'GET', '/_ops/ping', 'localhost',
+                                             timeout=max(remaining, self.poll_interval))
+            except (OSError, HTTPException) as e:
+                # Including the socket refusing connections while it starts
+                problem = str(e)
+            else:
+                if status < 400:
+                    break
+                problem = 'ping returned %i' % status
+            if remaining <= self.poll_interval:
+                raise ProvisioningError('Dataserver failed to start: %s' % problem)
+            context.info('Dataserver not ready (%s). Checking again.' % problem)
+            time.sleep(self.poll_interval)
+        context.info('The dataserver is accepting requests.')
+
+
+class CreateInviteStep(ProvisioningStep):
+    """
+    Creates the site admin invitation using the dataserver's admin key,
+    and records the other environments running on this host.
+    """
+
+    name = 'create_invite'
+
+    def __init__(self, socket_name='dataserver/run/dataserver.sock', timeout=60, **kwargs):
+        super(CreateInviteStep, self).__init__(**kwargs)
+        self.socket_name = socket_name
+        self.timeout = timeout
+
+    def _peer_environments(self):
+        output = subprocess.run(['podman', 'pod', 'ps', '--format', 'json'], check=True,
+                                stdout=subprocess.PIPE, encoding='utf-8').stdout
+        names = [pod.get('name', pod.get('Name')) for pod in json.loads(output or '[]')]
+        return [name for name in names if name and re.search('S[a-f0-9]?', name)] or None
+
+    def __call__(self, context):
+        context.info('Creating admin invite.')
+        with open(os.path.join(context.dataserver_root, 'data', '.admin.key')) as f:
+            admin_key = f.read().strip()
+
+        body = json.dumps({'invitations': [{'receiver': context.customer_email,
+                                            'receiver_name': context.customer_name}],
+                           'MimeType': _INVITATION_MIMETYPE})
+        invite = _socket_request(os.path.join(context.pod_root, self.socket_name),
+                                 'POST', '/dataserver2/Invitations/@@create-site-invitation',
+                                 context.ds_site_id,
+                                 timeout=self.timeout,
+                                 headers={'Authorization': 'Bearer ' + admin_key,
+                                          'X-Requested-With': 'XMLHttpRequest',
+                                          'Content-Type': 'application/json'},
+                                 body=body)
+        item = invite['Items'][0]
+        context.result['admin_invitation'] = next(link['href'] for link in item['Links']
+                                                  if link.get('rel') == 'redeem')
+        context.result['admin_invitation_code'] = item['Code']
+        context.result['peer_environments'] = self._peer_environments()
+
+
+def default_provisioning_steps(settings, pool=None):
+    """
+    The steps bin/init_pod_environment performs, configured from the
+    [pods] settings. If given, volumes are claimed from the IVolumePool.
+    """
+    skeleton = settings.get('dataserver_skeleton', _DEFAULT_SKELETON)
+    container_env = tuple(settings.get('container_env', '\n'.join(_DEFAULT_CONTAINER_ENV)).split())
+    socket_name = settings.get('dataserver_socket', 'dataserver/run/dataserver.sock')
+    profile = settings.get('iam_profile', _DEFAULT_IAM_PROFILE)
+
+    def _iam_client(service_name):
+        return boto3.session.Session(profile_name=profile).client(service_name)
+
+    def _mount_args(context):
+        return (context.site_id, context.pod_root)
+
+    # Creating the pod, the IAM credentials and the data volume don't
+    # depend on each other. Everything comes together to render the
+    # templates, and from there on things happen in order.
+    return (ContainerFunctionStep('create_pod', 'create_pod', container_env=container_env, only_new=False,
+                                  requires=()),
+            IAMCredentialsStep(settings.get('credentials_dir', _DEFAULT_CREDENTIALS_DIR),
+                               tuple(settings.get('iam_policies', '\n'.join(_DEFAULT_IAM_POLICIES)).split()),
+                               clients=AWSClientPool(_iam_client),
+                               requires=()),
+            AllocateVolumeStep(settings.getint('volume_size', fallback=_DEFAULT_VOLUME_SIZE),
+                               pool=pool,
+                               requires=()),
+            # mount_pod mounts the volume in the pod's directory, which create_pod makes
+            ContainerFunctionStep('mount_volume', 'mount_pod', _mount_args, container_env=container_env,
+                                  requires=('create_pod', 'allocate_volume')),
+            SeedDataserverStep(skeleton),
+            RenderTemplatesStep(skeleton,
+                                settings.get('smtp_server', _DEFAULT_SMTP_SERVER),
+                                settings.get('ses_region', _DEFAULT_SES_REGION),
+                                settings.get('solr_host', ''),
+                                requires=('seed_dataserver', 'iam_credentials')),
+            StartPodStep(requires=('create_pod', 'iam_credentials', 'render_templates')),
+            AwaitDataserverStep(socket_name, settings.getint('socket_wait', fallback=_DEFAULT_SOCKET_WAIT)),
+            CreateInviteStep(socket_name),
+            ContainerFunctionStep('start_aux_processes', 'start_dataserver_aux_processes',
+                                  container_env=container_env))
+
+
+@interface.implementer(IEnvironmentProvisioner)
+class NativeEnvironmentProvisioner(object):
+    """
+    Provisions environments like bin/init_pod_environment but does the
+    work in process. `steps` form a dependency graph, see
+    ProvisioningStep.requires, and up to `max_workers` steps whose
+    requirements are met run at the same time. The time each step
+    takes is recorded as a `provision.<step>` phase.
+
+    If a step fails no further steps are started. Those already
+    running are allowed to finish before the failure is raised.
+
+    The pod's containers are still managed by the host's container
+    scripts, which the corresponding steps run.
+    """
+
+    def __init__(self, steps, root_dir, volumes_dir=_DEFAULT_VOLUMES_DIR, max_workers=_DEFAULT_PROVISION_WORKERS):
+        self.steps = steps
+        self.root_dir = root_dir
+        self.volumes_dir = volumes_dir
+        self.max_workers = max_workers
+
+    def provision_environment(self, site_id, site_name, dns_name, customer_name, customer_email, progress=None):
+        logger.info('Provisioning environment natively for site=(%s) name=(%s) dns_name=(%s)',
+                    site_id, site_name, dns_name)
+        context = ProvisioningContext(site_id, site_name, dns_name, customer_name, customer_email,
+                                      os.path.join(self.root_dir, site_id),
+                                      os.path.join(self.volumes_dir, site_id + '.img'))
+        timer = PhaseTimer()
+        context.info('Initializing %s environment', site_id)
+        try:
+            self._run_steps(self._step_graph(context), context, timer, progress)
+        finally:
+            self._save_log(context)
+
+        context.result['host_system'] = socket.gethostname()
+        return context.result
+
+    def _step_graph(self, context):
+        """
+        Returns an ordered mapping of the steps to run to the names of
+        the steps they are waiting on.
+        """
+        steps = [step for step in self.steps if context.new_volume or not step.only_new]
+        names = {step.name for step in steps}
+        graph = {}
+        previous = None
+        for step in self.steps:
+            requires = step.requires
+            if requires is None:
+                requires = () if previous is None else (previous.name,)
+            previous = step
+            if step in steps:
+                graph[step] = {name for name in requires if name in names}
+        return graph
+
+    def _run_steps(self, graph, context, timer, progress):
+        done = set()
+        running = {}
+        failure = None
+        with ThreadPoolExecutor(max_workers=self.max_workers,
+                                thread_name_prefix='provision-%s' % context.site_id) as pool:
+            while graph or running:
+                if failure is None:
+                    for step in [s for s, requires in graph.items() if requires <= done]:
+                        del graph[step]
+                        if progress is not None:
+                            progress(step.name)
+                        running[pool.submit(self._run_step, step, context, timer)] = step
+
+                if not running:
+                    if failure is None:
+                        raise ProvisioningError('Provisioning steps %s have unmet requirements'
+                                                % sorted(step.name for step in graph))
+                    break
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    step = running.pop(future)
+                    try:
+                        future.result()
+                    except Exception as e: # pylint: disable=broad-except
+                        context.info('ABORT! %s failed. %s', step.name, e)
+                        failure = failure or e
+                    else:
+                        done.add(step.name)
+
+        if failure is not None:
+            raise failure
+
+    def _run_step(self, step, context, timer):
+        for attempt in range(1, step.tries + 1):
+            try:
+                start = time.perf_counter()
+                with timer.phase('provision.' + step.name):
+                    step(context)
+                context.info('%s completed in %.2f seconds', step.name, time.perf_counter() - start)
+                return
+            except Exception as e: # pylint: disable=broad-except
+                if attempt >= step.tries:
+                    raise
+                logger.warning('Provisioning step %s for site=(%s) failed. Trying again in %s seconds. %s',
+                               step.name, context.site_id, step.retry_delay, e)
+                time.sleep(step.retry_delay)
+
+    def _save_log(self, context):
+        log_location = _pod_root_init_log(context.site_id)
+        try:
+            context.log.seek(0)
+            with open(log_location, 'x') as f:
+                shutil.copyfileobj(context.log, f)
+        except OSError:
+            logger.exception('Unable to write log file to %s.', log_location)
+        finally:
+            context.log.close()
+
+
+# The native provisioner claims volumes from the IVolumePool
+@settings_sections('pods', 'volume_pool')
 def _provisioner_factory():
-    settings = component.getUtility(ISettings)
-    return EnvironmentProvisioner('init_pod_environment')
+    settings = component.getUtility(ISettings)['pods']
+    if settings.get('provisioner', 'script') == 'native':
+        return NativeEnvironmentProvisioner(default_provisioning_steps(settings,
+                                                                       component.queryUtility(IVolumePool)),
+                                            settings['root_dir'],
+                                            settings.get('volumes_dir', _DEFAULT_VOLUMES_DIR),
+                                            settings.getint('provision_workers', fallback=_DEFAULT_PROVISION_WORKERS))
+    return EnvironmentProvisioner('init_pod_environment',
+                                  stream=settings.getboolean('stream_output', fallback=False),
+                                  output_tail=settings.getint('output_tail', fallback=_DEFAULT_OUTPUT_TAIL))
 
 @interface.implementer(IProvisionEnvironmentTask)
 class ProvisionEnvironmentTask(AbstractTask):
@@ -0,0 +1,331 @@
+"""
+Sampled profiling of task runs.
+
+The `[profiling]` section of our settings picks which tasks to profile
+and what fraction of their runs. Our task_prerun and task_postrun
+handlers start and stop a profile for each chosen run, which is saved
+to `<directory>/<task name>/`, keeping only the latest `keep` of each
+task's profiles.
+
+In `cprofile` mode each run is saved as a `.prof` file that can be
+read with pstats. In `sample` mode the stack of the thread running the
+task is sampled every `sample_interval` seconds and saved as
+`.collapsed` stacks. Sampling costs less and shows where time went
+waiting on subprocesses and sockets, which is most of a setup.
+
+    python -m nti.environments.management.profiling <directory> > setup.collapsed
+
+turns either kind into collapsed stacks weighted in microseconds, as
+read by flamegraph.pl or speedscope.
+"""
+
+import argparse
+import cProfile
+import os
+import pstats
+import random
+import sys
+import threading
+import time
+
+from collections import Counter
+from collections import defaultdict
+
+from fnmatch import fnmatchcase
+
+from zope import component
+
+from .interfaces import ISettings
+
+from .metrics import parse_sample_rates
+
+logger = __import__('logging').getLogger(__name__)
+
+CPROFILE = 'cprofile'
+SAMPLE = 'sample'
+
+_EXTENSIONS = {CPROFILE: '.prof', SAMPLE: '.collapsed'}
+
+_DEFAULT_SAMPLE_INTERVAL = 0.01 # seconds
+_DEFAULT_KEEP = 50
+
+#: Stacks that account for less than this, in microseconds, are dropped
+#: when collapsing a cProfile profile
+_MIN_WEIGHT = 1
+
+
+def _frame_name(funcname, filename):
+    # cProfile reports builtins with a filename of ~
+    if filename == '~':
+        return funcname
+    return '%s (%s)' % (funcname, filename)
+
+
+class _CProfileRun(object):
+
+    def __init__(self):
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+
+    def finish(self, path):
+        self.profile.disable()
+        self.profile.dump_stats(path)
+
+
+class _SampledRun(object):
+    """
+    Samples the stack of the calling thread from a background thread.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.stacks = Counter()
+        self._thread_id = threading.get_ident()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='task-profiler', daemon=True)
+        self._thread.start()
+
+    def _sample(self):
+        frame = sys._current_frames().get(self._thread_id) # pylint: disable=protected-access
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(_frame_name(code.co_name, code.co_filename))
+            frame = frame.f_back
+        if stack:
+            self.stacks[';'.join(reversed(stack))] += 1
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self._sample()
+
+    def finish(self, path):
+        self._stopped.set()
+        self._thread.join()
+        weight = self.interval * 1e6
+        with open(path, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write('%s %i\n' % (stack, round(count * weight)))
+
+
+class TaskProfiler(object):
+    """
+    Profiles the runs of the tasks matching `rates`, a sequence of
+    `(task name pattern, rate)`, saving them under directory.
+    """
+
+    def __init__(self, directory, rates, mode=SAMPLE,
+                 sample_interval=_DEFAULT_SAMPLE_INTERVAL, keep=_DEFAULT_KEEP):
+        if mode not in _EXTENSIONS:
+            raise ValueError('Unknown profiling mode %s' % mode)
+        self.directory = directory
+        self.rates = list(rates)
+        self.mode = mode
+        self.sample_interval = sample_interval
+        self.keep = keep
+        self.random = random.random # Testing hook
+
+    def rate(self, task_name):
+        for pattern, rate in self.rates:
+            if fnmatchcase(task_name, pattern):
+                return rate
+        return 0
+
+    def sampled(self, task_name):
+        rate = self.rate(task_name)
+        return rate >= 1 or (rate > 0 and self.random() < rate)
+
+    def begin(self):
+        """
+        Start profiling the calling thread.
+        """
+        if self.mode == CPROFILE:
+            return _CProfileRun()
+        return _SampledRun(self.sample_interval)
+
+    def save(self, run, task_name, task_id):
+        """
+        Save the profile of run, returning its path.
+        """
+        folder = os.path.join(self.directory, task_name)
+        os.makedirs(folder, exist_ok=True)
+        path = os.path.join(folder, '%i-%s%s' % (time.time() * 1000, task_id, _EXTENSIONS[self.mode]))
+        run.finish(path)
+        self._rotate(folder)
+        return path
+
+    def _rotate(self, folder):
+        profiles = [entry for entry in os.scandir(folder)
+                    if entry.name.endswith(tuple(_EXTENSIONS.values()))]
+        if len(profiles) <= self.keep:
+            return
+        profiles.sort(key=lambda entry: entry.stat().st_mtime)
+        for entry in profiles[:len(profiles) - self.keep]:
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+
+
+def profiler_from_settings(settings):
+    """
+    Returns a TaskProfiler configured by the `[profiling]` section of
+    settings, or None if no tasks are to be profiled.
+    """
+    rates = parse_sample_rates(settings.get('profiling', 'tasks', fallback=''))
+    if not rates:
+        return None
+    return TaskProfiler(settings.get('profiling', 'directory'),
+                        rates,
+                        mode=settings.get('profiling', 'mode', fallback=SAMPLE),
+                        sample_interval=settings.getfloat('profiling', 'sample_interval',
+                                                          fallback=_DEFAULT_SAMPLE_INTERVAL),
+                        keep=settings.getint('profiling', 'keep', fallback=_DEFAULT_KEEP))
+
+
+_profiler = None
+_profiler_settings = None
+
+#: The profiles being taken, by task id, with the profiler that took them
+_runs = {}
+_runs_lock = threading.Lock()
+
+
+def task_profiler():
+    """
+    Returns the TaskProfiler for the current settings, or None. Settings
+    can be reloaded while we run, so they are looked up each time.
+    """
+    global _profiler, _profiler_settings
+    settings = component.queryUtility(ISettings)
+    if settings is not _profiler_settings:
+        _profiler = profiler_from_settings(settings) if settings is not None else None
+        _profiler_settings = settings
+    return _profiler
+
+
+def start_profiling(task_id, task_name):
+    """
+    Start profiling the calling thread's run of task_id if its task is
+    configured to be profiled and this run is sampled.
+    """
+    profiler = task_profiler()
+    if profiler is None or not profiler.sampled(task_name):
+        return False
+    try:
+        run = profiler.begin()
+    except ValueError:
+        # Another profiler is active, e.g. cProfile in another thread
+        # on a python using sys.monitoring
+        logger.debug('Unable to profile %s[%s]', task_name, task_id, exc_info=True)
+        return False
+    with _runs_lock:
+        _runs[task_id] = (profiler, run)
+    return True
+
+
+def stop_profiling(task_id, task_name):
+    """
+    Stop profiling task_id and save its profile, returning its path or
+    None if it wasn't being profiled.
+    """
+    with _runs_lock:
+        profiler, run = _runs.pop(task_id, (None, None))
+    if profiler is None:
+        return None
+    try:
+        return profiler.save(run, task_name, task_id)
+    except OSError:
+        logger.exception('Unable to save profile of %s[%s]', task_name, task_id)
+        return None
+
+
+def _collapse_pstats(path, root):
+    """
+    Approximates collapsed stacks from a cProfile profile, which only
+    records the time each function spent called by each of its callers,
+    by dividing a function's time among the stacks of its callers in
+    proportion to the time each caller gave it.
+    """
+    stats = pstats.Stats(path).stats # pylint: disable=no-member
+    callees = defaultdict(dict)
+    for func, (_, _, _, _, callers) in stats.items():
+        for caller, edge in callers.items():
+            callees[caller][func] = edge[3]
+
+    stacks = Counter()
+
+    def walk(func, names, funcs, weight):
+        _, _, own, cumulative, _ = stats[func]
+        names = names + (_frame_name(func[2], func[0]),)
+        if cumulative:
+            stacks[';'.join(names)] += own * 1e6 * weight / cumulative
+        for callee, edge in callees[func].items():
+            if callee in funcs or not stats[callee][3]:
+                continue
+            callee_weight = weight * edge / cumulative if cumulative else 0
+            if callee_weight * 1e6 >= _MIN_WEIGHT:
+                walk(callee, names, funcs | {callee}, callee_weight)
+
+    for func, (_, _, _, cumulative, callers) in stats.items():
+        if not callers:
+            walk(func, (root,), frozenset([func]), cumulative)
+    return stacks
+
+
+def _collapse_file(path, root):
+    stacks = Counter()
+    with open(path) as f:
+        for line in f:
+            stack, _, weight = line.rstrip('\n').rpartition(' ')
+            if stack:
+                stacks['%s;%s' % (root, stack)] += int(weight)
+    return stacks
+
+
+def collapse(paths, tasks=()):
+    """
+    Adds up the profiles found at paths, files or profiling
+    directories, into collapsed stacks rooted at their task's name and
+    weighted in microseconds. With tasks, only profiles of those tasks
+    are included.
+    """
+    stacks = Counter()
+    for path, task_name in _profiles(paths):
+        if tasks and task_name not in tasks:
+            continue
+        if path.endswith(_EXTENSIONS[CPROFILE]):
+            stacks.update(_collapse_pstats(path, task_name))
+        else:
+            stacks.update(_collapse_file(path, task_name))
+    return stacks
+
+
+def _profiles(paths):
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path, os.path.basename(os.path.dirname(os.path.abspath(path)))
+            continue
+        for folder, _, filenames in os.walk(path):
+            for filename in sorted(filenames):
+                if filename.endswith(tuple(_EXTENSIONS.values())):
+                    yield os.path.join(folder, filename), os.path.basename(folder)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Collapse task profiles into flamegraph stacks')
+    parser.add_argument('paths', nargs='+',
+                        help='Profiles, or profiling directories to search for them')
+    parser.add_argument('--task', action='append', default=[],
+                        help='Only include profiles of this task, may be repeated')
+    args = parser.parse_args(args)
+
+    for stack, weight in sorted(collapse(args.paths, args.task).items()):
+        weight = round(weight)
+        if weight:
+            print('%s %i' % (stack, weight))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,427 @@
+"""
+A Prometheus style metrics endpoint for the worker.
+
+When `[monitoring] metrics_port` is set the worker keeps a
+`MetricsRegistry` of its task counts, runtimes and queue waits,
+haproxy reload outcomes and provisioning subprocess durations, and
+serves them in the Prometheus text format at `/metrics`.
+
+Tasks run in the prefork pool's children, while the endpoint is served
+by the worker's main process. Each process periodically writes a
+snapshot of its registry to `metrics_dir`, and the endpoint adds them
+all up. When a child has exited, or its pid has been reused, the
+counters and histograms it left are folded into a running total of
+exited processes and its file is removed. Its gauges are dropped.
+"""
+
+import json
+import math
+import os
+import tempfile
+import threading
+import time
+import weakref
+
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+
+logger = __import__('logging').getLogger(__name__)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+_DEFAULT_WRITE_INTERVAL = 1.0 # seconds
+
+#: Upper bounds, in seconds, of the histogram buckets. Tasks range
+#: from milliseconds to a provisioning run of several minutes.
+_DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                    30, 60, 120, 300, 600, math.inf)
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+HISTOGRAM = 'histogram'
+
+#: The metrics we know how to describe, by name
+METRICS = {
+    'nti_celery_tasks_started_total': (COUNTER, 'Tasks started'),
+    'nti_celery_tasks_finished_total': (COUNTER, 'Tasks finished, by outcome'),
+    'nti_celery_tasks_in_flight': (GAUGE, 'Tasks running now'),
+    'nti_celery_task_runtime_seconds': (HISTOGRAM, 'Time spent running tasks'),
+    'nti_celery_task_queue_wait_seconds': (HISTOGRAM, 'Time tasks waited in the queue'),
+    'nti_haproxy_reloads_total': (COUNTER, 'Haproxy reloads, by what show proc said afterwards'),
+    'nti_provisioning_subprocess_seconds': (HISTOGRAM, 'Time spent running provisioning commands'),
+}
+
+_registry = None
+
+_registries = weakref.WeakSet()
+
+
+def _after_fork_in_child():
+    for registry in list(_registries):
+        registry._reset()
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+def metrics_registry():
+    """
+    Returns the process wide MetricsRegistry, or None if metrics
+    aren't being collected.
+    """
+    return _registry
+
+
+def set_metrics_registry(registry):
+    global _registry
+    _registry = registry
+
+
+def _labels(labels):
+    return tuple(sorted(labels.items())) if labels else ()
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class MetricsRegistry(object):
+    """
+    Counters, gauges and histograms by metric name and labels.
+
+    If `directory` is given a background thread writes a snapshot of
+    the registry to `<directory>/<pid>.json` every `write_interval`
+    seconds that anything changed.
+    """
+
+    def __init__(self, directory=None, write_interval=_DEFAULT_WRITE_INTERVAL,
+                 buckets=_DEFAULT_BUCKETS):
+        self.directory = directory
+        self.write_interval = write_interval
+        self.buckets = tuple(buckets)
+        #: Callables whose json compatible results are added to our
+        #: snapshots, by key, for data that isn't a metric
+        self.extras = {}
+        self._reset()
+        _registries.add(self)
+
+    def _reset(self):
+        # Also called in a forked child, which starts from nothing
+        # rather than counting the parent's metrics again.
+        self._lock = threading.Lock()
+        self._started = time.time()
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        # What processes that have exited left behind, and the last
+        # snapshot of each live process, to notice its pid being reused
+        self._exited = {}
+        self._exited_histograms = {}
+        self._seen = {}
+        self._changed = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _updated(self):
+        # Called with the lock held
+        if self.directory is None:
+            return
+        self._changed.set()
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='metrics-writer', daemon=True)
+            self._thread.start()
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, _labels(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+            self._updated()
+
+    def add(self, name, amount, **labels):
+        """
+        Add amount, which may be negative, to a gauge.
+        """
+        key = (name, _labels(labels))
+        with self._lock:
+            self._gauges[key] = self._gauges.get(key, 0) + amount
+            self._updated()
+
+    def observe(self, name, value, **labels):
+        key = (name, _labels(labels))
+        with self._lock:
+            try:
+                histogram = self._histograms[key]
+            except KeyError:
+                histogram = self._histograms[key] = [[0] * len(self.buckets), 0, 0]
+            counts = histogram[0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            histogram[1] += value
+            histogram[2] += 1
+            self._updated()
+
+    def snapshot(self):
+        """
+        Returns the registry's state as a json compatible dict.
+        """
+        with self._lock:
+            snapshot = {
+                'started': self._started,
+                COUNTER: [[name, labels, value] for (name, labels), value in self._counters.items()],
+                GAUGE: [[name, labels, value] for (name, labels), value in self._gauges.items()],
+                HISTOGRAM: [[name, labels, list(counts), total, count]
+                            for (name, labels), (counts, total, count) in self._histograms.items()],
+            }
+        for key, extra in self.extras.items():
+            snapshot[key] = extra()
+        return snapshot
+
+    def _run(self):
+        while not self._stopped.wait(self.write_interval):
+            if self._changed.is_set():
+                self.write()
+
+    def write(self):
+        """
+        Write a snapshot to our file in directory.
+        """
+        self._changed.clear()
+        path = os.path.join(self.directory, '%i.json' % os.getpid())
+        tmp = path + '.tmp'
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(self.snapshot(), f)
+            os.replace(tmp, path)
+        except OSError:
+            logger.exception('Unable to write metrics to %s', path)
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+            self._thread = None
+        if self.directory is not None:
+            self.write()
+
+    def snapshots(self):
+        """
+        Yields `(snapshot, alive)` of this process, of the processes
+        that have exited, and of the other live processes writing to
+        directory.
+        """
+        yield self.snapshot(), True
+        if self.directory is None:
+            return
+
+        ours = '%i.json' % os.getpid()
+        live = []
+        for filename in os.listdir(self.directory):
+            if not filename.endswith('.json') or filename == ours:
+                continue
+            path = os.path.join(self.directory, filename)
+            try:
+                pid = int(filename[:-len('.json')])
+                with open(path) as f:
+                    snapshot = json.load(f)
+            except (OSError, ValueError):
+                logger.exception('Unable to read metrics from %s', filename)
+                continue
+            alive = _alive(pid)
+            with self._lock:
+                seen = self._seen.pop(pid, None)
+                if seen is not None and seen.get('started') != snapshot.get('started'):
+                    # The pid was reused, keep what its last owner counted
+                    self._fold(seen)
+                if alive:
+                    self._seen[pid] = snapshot
+                    live.append(snapshot)
+                    continue
+                self._fold(snapshot)
+            try:
+                os.remove(path)
+            except OSError:
+                logger.exception('Unable to remove metrics of exited process %s', filename)
+
+        with self._lock:
+            exited = {
+                COUNTER: [[name, labels, value] for (name, labels), value in self._exited.items()],
+                GAUGE: [],
+                HISTOGRAM: [[name, labels, list(counts), total, count]
+                            for (name, labels), (counts, total, count)
+                            in self._exited_histograms.items()],
+            }
+        yield exited, False
+        for snapshot in live:
+            yield snapshot, True
+
+    def _fold(self, snapshot):
+        # Called with the lock held
+        for name, labels, value in snapshot.get(COUNTER, ()):
+            key = (name, tuple(map(tuple, labels)))
+            self._exited[key] = self._exited.get(key, 0) + value
+        for name, labels, counts, total, count in snapshot.get(HISTOGRAM, ()):
+            key = (name, tuple(map(tuple, labels)))
+            _merge_histogram(self._exited_histograms, key, counts, total, count)
+
+    def collect(self):
+        """
+        Returns `({(name, labels): value}, {(name, labels): (bucket_counts, sum, count)})`
+        of the counters and gauges and of the histograms,
+        adding up our metrics and those of the other processes writing
+        to directory.
+        """
+        scalars = {}
+        histograms = {}
+        for snapshot, alive in self.snapshots():
+            for kind in (COUNTER, GAUGE):
+                if kind == GAUGE and not alive:
+                    continue
+                for name, labels, value in snapshot[kind]:
+                    key = (name, tuple(map(tuple, labels)))
+                    scalars[key] = scalars.get(key, 0) + value
+            for name, labels, counts, total, count in snapshot[HISTOGRAM]:
+                key = (name, tuple(map(tuple, labels)))
+                _merge_histogram(histograms, key, counts, total, count)
+        return scalars, histograms
+
+    def render(self):
+        """
+        Returns the collected metrics in the Prometheus text format.
+        """
+        scalars, histograms = self.collect()
+        by_name = {}
+        for (name, labels), value in scalars.items():
+            by_name.setdefault(name, []).append((labels, value))
+        for (name, labels), value in histograms.items():
+            by_name.setdefault(name, []).append((labels, value))
+
+        lines = []
+        for name in sorted(by_name):
+            kind, description = METRICS.get(name, (GAUGE, name))
+            lines.append('# HELP %s %s' % (name, description))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for labels, value in sorted(by_name[name]):
+                if kind != HISTOGRAM:
+                    lines.append('%s%s %s' % (name, _format_labels(labels), _format_value(value)))
+                    continue
+                counts, total, count = value
+                cumulative = 0
+                for bound, bucket in zip(self.buckets, counts):
+                    cumulative += bucket
+                    le = labels + (('le', '+Inf' if bound == math.inf else repr(float(bound))),)
+                    lines.append('%s_bucket%s %i' % (name, _format_labels(le), cumulative))
+                lines.append('%s_sum%s %s' % (name, _format_labels(labels), _format_value(total)))
+                lines.append('%s_count%s %i' % (name, _format_labels(labels), count))
+        return '\n'.join(lines) + '\n'
+
+
+def _merge_histogram(histograms, key, counts, total, count):
+    if key in histograms:
+        merged = histograms[key]
+        counts = [a + b for a, b in zip(merged[0], counts)]
+        total += merged[1]
+        count += merged[2]
+    histograms[key] = (counts, total, count)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (key, _escape(value)) for key, value in labels)
+
+
+def _format_value(value):
+    return repr(float(value))
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    registry = None
+
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+
+        body = self.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args): # pylint: disable=redefined-builtin
+        logger.debug('%s - ' + format, self.address_string(), *args)
+
+
+class MetricsServer(object):
+    """
+    Serves registry at `http://<address>:<port>/metrics` from a
+    background thread.
+    """
+
+    def __init__(self, registry, port, address=''):
+        self.registry = registry
+        self.port = port
+        self.address = address
+        self._server = None
+        self._thread = None
+
+    def start(self):
+        handler = type('MetricsHandler', (_MetricsHandler,), {'registry': self.registry})
+        self._server = ThreadingHTTPServer((self.address, self.port), handler)
+        self._server.daemon_threads = True
+        # With port 0 we were given one
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        name='metrics-server', daemon=True)
+        self._thread.start()
+        logger.info('Serving metrics on port %i', self.port)
+
+    def stop(self):
+        if self._server is None:
+            return
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+        self._server = self._thread = None
+
+
+def metrics_server(settings):
+    """
+    If `[monitoring] metrics_port` is set, registers a MetricsRegistry
+    as the process wide registry and returns a MetricsServer for it,
+    otherwise returns None.
+
+    Processes write their snapshots to `metrics_dir`, by default a
+    directory in the system's temporary directory named for this
+    process. Any snapshots left there by a previous worker are removed.
+    """
+    port = settings.getint('monitoring', 'metrics_port', fallback=0)
+    if port <= 0:
+        return None
+
+    directory = settings.get('monitoring', 'metrics_dir', fallback='') \
+        or os.path.join(tempfile.gettempdir(), 'nti-metrics-%i' % os.getpid())
+    os.makedirs(directory, exist_ok=True)
+    for filename in os.listdir(directory):
+        if filename.endswith(('.json', '.json.tmp')):
+            os.remove(os.path.join(directory, filename))
+
+    registry = MetricsRegistry(directory,
+                               write_interval=settings.getfloat('monitoring', 'metrics_write_interval',
+                                                                fallback=_DEFAULT_WRITE_INTERVAL))
+    set_metrics_registry(registry)
+    return MetricsServer(registry, port,
+                         address=settings.get('monitoring', 'metrics_address', fallback=''))
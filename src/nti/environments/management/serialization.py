@@ -0,0 +1,96 @@
+"""
+A compact msgpack serializer for task arguments and results.
+
+Unlike pickle, only plain data and the few types we explicitly know how
+to encode can cross the wire, and payloads can be read by anything that
+speaks msgpack. The non native types are msgpack extension types:
+
+* `EXT_DATETIME` the UTF-8 ISO 8601 string, naive datetimes stay naive
+* `EXT_SITE_INFO` a msgpack map of the `SITE_INFO_FIELDS` set on a `SiteInfo`
+"""
+
+import datetime
+
+from kombu.serialization import register
+
+import msgpack
+
+from .tasks import SiteInfo
+
+logger = __import__('logging').getLogger(__name__)
+
+#: The name the serializer is registered with kombu as
+SERIALIZER = 'nti-msgpack'
+
+CONTENT_TYPE = 'application/x-nti-msgpack'
+
+EXT_DATETIME = 1
+EXT_SITE_INFO = 2
+
+#: The SiteInfo attributes that are serialized. Anything else set on
+#: a SiteInfo is dropped.
+SITE_INFO_FIELDS = ('site_id',
+                    'dns_name',
+                    'start_time',
+                    'end_time',
+                    'task_result_dict',
+                    'ds_site_id',
+                    'reload_task',
+                    'reload_requested_at',
+                    'public_verified',
+                    'phase_timings',
+                    'verify_attempts')
+
+
+def _encode_site_info(site_info):
+    state = vars(site_info)
+    return {field: state[field] for field in SITE_INFO_FIELDS if field in state}
+
+
+def _decode_site_info(state):
+    site_info = SiteInfo(state.pop('site_id'), state.pop('dns_name'))
+    for field, value in state.items():
+        if field in SITE_INFO_FIELDS:
+            setattr(site_info, field, value)
+    return site_info
+
+
+def _default(obj):
+    if isinstance(obj, datetime.datetime):
+        # Not packed itself, nesting packers is surprisingly expensive
+        return msgpack.ExtType(EXT_DATETIME, obj.isoformat().encode('utf-8'))
+    if isinstance(obj, SiteInfo):
+        return msgpack.ExtType(EXT_SITE_INFO, _pack(_encode_site_info(obj)))
+    raise TypeError('Unable to serialize object of type %s' % type(obj).__name__)
+
+
+def _ext_hook(code, data):
+    if code == EXT_DATETIME:
+        return datetime.datetime.fromisoformat(data.decode('utf-8'))
+    if code == EXT_SITE_INFO:
+        return _decode_site_info(_unpack(data))
+    return msgpack.ExtType(code, data)
+
+
+def _pack(obj):
+    return msgpack.packb(obj, default=_default, use_bin_type=True)
+
+
+def _unpack(data):
+    return msgpack.unpackb(data, ext_hook=_ext_hook, raw=False, strict_map_key=False)
+
+
+def dumps(obj):
+    return _pack(obj)
+
+
+def loads(data):
+    if isinstance(data, str):
+        data = data.encode('latin-1')
+    return _unpack(data)
+
+
+def register_serializer():
+    register(SERIALIZER, dumps, loads,
+             content_type=CONTENT_TYPE,
+             content_encoding='binary')
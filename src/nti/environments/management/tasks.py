@@ -6,15 +6,20 @@ entry point.
 import argparse
 import os
 import time
+import socket
 import subprocess
 import json
 import datetime
+import functools
+
+import http.client
 
 import requests
 
 from requests.exceptions import ConnectionError
 from requests.exceptions import HTTPError
 
+from celery import chain
 from celery import group
 
 from celery.result import result_from_tuple
@@ -28,6 +33,11 @@ from .interfaces import IInitializedSiteInfo
 from .interfaces import ISetupEnvironmentTask
 from .interfaces import IProvisionEnvironmentTask
 
+from .placement import choose_host_queue
+from .placement import placement_enabled
+
+from .timing import emit_phase_timing
+
 logger = __import__('logging').getLogger(__name__)
 
 
@@ -124,99 +134,286 @@ def _ping_url(site_info):
     return 'https://%s/dataserver2/logon.ping' % site_info.dns_name
 
 
-def _do_verify_site(site_info, timeout=2, tries=30, wait=2):
+class _UnixSocketHTTPConnection(http.client.HTTPConnection):
+    """
+    An HTTPConnection to a server listening on a unix socket.
+    """
+
+    def __init__(self, socket_path, host, timeout):
+        super(_UnixSocketHTTPConnection, self).__init__(host, timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.socket_path)
+        except OSError:
+            sock.close()
+            raise
+        self.sock = sock
+
+
+def _do_ping_site_socket(socket_path, site_id, timeout=1, host=None):
+    """
+    Like _do_ping_site, but talks directly to the dataserver listening
+    on socket_path, sending `host` as the Host header. Failures are
+    raised as the same requests exceptions so they can be handled alike.
+    """
+    conn = _UnixSocketHTTPConnection(socket_path, host or site_id, timeout)
+    try:
+        conn.request('GET', '/dataserver2/logon.ping')
+        resp = conn.getresponse()
+        body = resp.read()
+    except (OSError, http.client.HTTPException) as e:
+        raise ConnectionError('Unable to ping %s. %s' % (socket_path, e))
+    finally:
+        conn.close()
+
+    if resp.status >= 400:
+        response = requests.Response()
+        response.status_code = resp.status
+        raise HTTPError('%s returned %i' % (socket_path, resp.status), response=response)
+
+    pong = json.loads(body)
+
+    pinged_site = pong.get('Site', None)
+    if pinged_site != site_id.lower():
+        raise SiteVerificationException('Site verification error. Expected site %s but found %s' % (site_id, pinged_site))
+
+    return pong
+
+
+def _verify_site_attempt(site_info, url, timeout=2, ping=None):
+    """
+    Make a single attempt to verify the site. Returns a tuple of whether
+    the site was verified and, if it wasn't, the retriable exception we
+    encountered. Raises a SiteVerificationException if the site can't be
+    verified and we shouldn't try again.
+    """
+    ping = ping or _do_ping_site
+    try:
+        pong = ping(url, site_info.site_id, timeout=timeout)
+        if pong:
+            site_info.ds_site_id = pong['Site']
+            return True, None
+    except ConnectionError as e:
+        # A retriable error, we couldn't connect to the site.
+        # Possibly dns hasn't propogated
+        logger.debug('ConnectionError when verifying site. %s', e)
+        return False, e
+    except HTTPError as e:
+        # Some HTTPErrors we want to catch and retry on
+        # for example a 503, that's likely indicative of a backend
+        # that isn't up.
+        # TODO the environment spin up is waiting on this currently
+        # so if we still are getting this here we may not want to retry.
+        code = e.response.status_code
+
+        logger.debug('HTTPError when verifying site. %s', e)
+        if code == 503 or code == 404:
+            return False, e
+        logger.exception('An error occurred when verifying site')
+        raise SiteVerificationException('Unable to verify site. %s' % e)
+    return False, None
+
+
+def _verification_failure(last_exception):
+    if last_exception is not None:
+        return SiteVerificationException('Unable to verify site. %s' % last_exception)
+    return SiteVerificationTimeout()
+
+
+def _do_verify_site(site_info, timeout=2, tries=30, wait=2, url=None, ping=None):
     """
     Verify the created site is accessible.
     """
     attempts = 0
-    verified = False
     last_exception = None
-    site_id = site_info.site_id
-    url = _ping_url(site_info)
+    url = url or _ping_url(site_info)
     while attempts < tries:
-        try:
-            pong = _do_ping_site(url, site_id, timeout=timeout)
-            if pong:
-                site_info.ds_site_id = pong['Site']
-                verified = True
-                break
-        except ConnectionError as e:
-            # A retriable error, we couldn't connect to the site.
-            # Possibly dns hasn't propogated
-            last_exception = e
-            logger.debug('ConnectionError when verifying site. %s', e)
-        except HTTPError as e:
-            # Some HTTPErrors we want to catch and retry on
-            # for example a 503, that's likely indicative of a backend
-            # that isn't up.
-            # TODO the environment spin up is waiting on this currently
-            # so if we still are getting this here we may not want to retry.
-            last_exception = e
-            code = e.response.status_code
-
-            logger.debug('HTTPError when verifying site. %s', e)
-            if code == 503 or code == 404:
-                pass
-            else:
-                logger.exception('An error occurred when verifying site')
-                raise SiteVerificationException('Unable to verify site. %s' % e)
+        verified, error = _verify_site_attempt(site_info, url, timeout=timeout, ping=ping)
+        if verified:
+            return True
+        last_exception = error or last_exception
 
         attempts += 1
         time.sleep(wait)
 
-    if not verified:
-        if last_exception is not None:
-            raise SiteVerificationException('Unable to verify site. %s' % last_exception)
-        raise SiteVerificationTimeout()
+    raise _verification_failure(last_exception)
+
 
-    return True
+def verify_site_socket(site_info, socket_path, timeout=2, tries=60, wait=1):
+    """
+    Verify the dataserver for site_info is up by pinging it over the
+    unix socket at socket_path. This has to run on the host system, but
+    doesn't depend on public dns or tier1. This is the first stage of
+    staged verification; see verify_setup_site for the second.
+    """
+    logger.info('Verifying site %s using %s', site_info.site_id, socket_path)
+    return _do_verify_site(site_info,
+                           timeout=timeout,
+                           tries=tries,
+                           wait=wait,
+                           url=socket_path,
+                           ping=functools.partial(_do_ping_site_socket, host=site_info.dns_name))
 
 
-def join_setup_environment_task(task, group_result, site_info, verify_site=True):
+def join_setup_environment_task(task, group_result, site_info):
     """
     Given a group result for a site setup, complete the site_info object
-    and return it. This tasks acts as a chord callback for the group
+    and return it. This tasks acts as a chord callback for the group and
+    is the first step in the setup pipeline.
+
+    If the backend task couldn't make the site live, with or without a
+    reload, we dispatch another haproxy reload and, rather than wait on
+    it, record it on the site_info for await_setup_reload.
     """
+    # Currently the only task in our group that has output we care about is
+    # the provision task. It's the last child in the group.
+    # TODO how can we reduce the coupling to the group structure.
+    pod_result_dict = group_result[-1]
+    site_info.task_result_dict = pod_result_dict
+    logger.info('Site %s spinup complete.', site_info.site_id)
+
+    queued_at = site_info.start_timestamp
+    for (queue_phase, countdown), result in zip(_GROUP_QUEUE_PHASES, group_result):
+        if isinstance(result, dict) and result.get('timings'):
+            site_info.merge_timings(result['timings'], queue_phase,
+                                    queued_at + countdown if queued_at else None)
+
+    backend_result = group_result[1]
+    if isinstance(backend_result, dict) and backend_result.get('live'):
+        logger.info('Haproxy backend for site %s is live. Skipping reload', site_info.site_id)
+        return site_info
+    if isinstance(backend_result, dict) and backend_result.get('reloaded'):
+        logger.info('Haproxy reloaded with the backend for site %s. Skipping reload',
+                    site_info.site_id)
+        return site_info
+
+    app = task._get_app()
+    ha = IHaproxyReloadTask(app)
+    logger.info('Spawning haproxy reload job')
+    site_info.reload_requested_at = time.time()
+    site_info.reload_task = ha.save_task(ha())
+    return site_info
+
 
+def await_setup_reload(task, site_info, poll_interval=1, timeout=20):
+    """
+    A setup pipeline step that waits for the haproxy reload dispatched
+    by join_setup_environment_task. Instead of blocking a worker we check
+    the reload and, if it isn't done, re-enqueue ourselves to check again
+    in `poll_interval` seconds, giving up after `timeout`.
+    """
+    if site_info.reload_task is not None:
+        res = result_from_tuple(site_info.reload_task, app=task._get_app())
+        if not res.ready():
+            raise task.retry(countdown=poll_interval,
+                             max_retries=int(timeout / poll_interval))
+        # Like the reload task itself, a failed reload doesn't fail the setup
+        logger.info('Haproxy job completed with %s', res.result)
+        if isinstance(res.result, dict) and res.result.get('timings'):
+            site_info.merge_timings(res.result['timings'], 'queue_wait.reload',
+                                    site_info.reload_requested_at)
+    return site_info
+
+
+def verify_setup_site(task, site_info, verify_site=True, timeout=2, tries=30, wait=2):
+    """
+    A setup pipeline step that verifies the site is accessible. Each
+    execution makes a single attempt. If the site isn't ready yet we
+    re-enqueue ourselves to try again in `wait` seconds, up to `tries`
+    attempts in total.
+    """
+    if not verify_site:
+        logger.warn('Bypassing site verification. Devmode?')
+        return site_info
+
+    if site_info.socket_verified:
+        return _verify_staged_site(site_info, timeout)
+
+    logger.info('Performing site verification for site %s (attempt %i)',
+                site_info.site_id, task.request.retries + 1)
     try:
-        app = task._get_app()
-        ha = IHaproxyReloadTask(app)
-        logger.info('Spawning haproxy reload job')
-        res = ha()
-        # By default celery doesn't want us running tasks synchronously from other
-        # tasks http://docs.celeryq.org/en/latest/userguide/tasks.html#task-synchronous-subtasks.
-        # Rightfully so as we could very very easily deadlock ourselves.
-        rval = res.get(timeout=20, disable_sync_subtasks=False, propagate=False)
-        logger.info('Haproxy job completed with %s', rval)
-
-        # Currently the only task in our group that has output we care about is
-        # the provision task. It's the last child in the group.
-        # TODO how can we reduce the coupling to the group structure.
-        pod_result_dict = group_result[-1]
-        site_info.task_result_dict = pod_result_dict
-        logger.info('Site %s spinup complete.', site_info.site_id)
-
-        if verify_site:
-            logger.info('Performing site verification for site %s', site_info.site_id)
-            try:
-                valid = _do_verify_site(site_info)
-                if valid:
-                    logger.info('Site verification for site %s completed successfully',
-                                site_info.site_id)
-            except SiteVerificationException:
-                logger.exception('Site verification failed')
-                raise
-        else:
-            logger.warn('Bypassing site verification. Devmode?')
+        verified, error = _timed_verify_attempt(site_info, timeout)
+    except SiteVerificationException:
+        logger.exception('Site verification failed')
+        raise
+
+    if not verified:
+        # Retry with our site_info, not the one we were called with,
+        # so the timings of each attempt are carried along.
+        raise task.retry(args=(site_info,),
+                         countdown=wait,
+                         max_retries=tries - 1,
+                         exc=_verification_failure(error))
+
+    logger.info('Site verification for site %s completed successfully',
+                site_info.site_id)
+    return site_info
+
+
+def _timed_verify_attempt(site_info, timeout):
+    start = time.perf_counter()
+    try:
+        return _verify_site_attempt(site_info, _ping_url(site_info), timeout=timeout)
     finally:
-        site_info.end_time = datetime.datetime.utcnow()
-        logger.info('Setup of site %s complete in %.2f seconds',
-                    site_info.site_id, site_info.elapsed_time or -1)
+        site_info.record_verify_attempt(time.perf_counter() - start)
+
+
+def _verify_staged_site(site_info, timeout):
+    """
+    The second stage of staged verification. The provisioning task has
+    already verified the dataserver over its unix socket, so we probe
+    the public url just once. Failing to connect because dns hasn't
+    propagated yet doesn't fail the setup, it's only a matter of time.
+    """
+    site_info.ds_site_id = site_info._get_result_val('ds_site_id')
+    logger.info('Site %s verified on host. Probing public url once', site_info.site_id)
+    try:
+        verified, error = _timed_verify_attempt(site_info, timeout)
+    except SiteVerificationException:
+        logger.exception('Site verification failed')
+        raise
+
+    site_info.public_verified = verified
+    if not verified:
+        logger.warn('Site %s not yet publicly accessible. %s', site_info.site_id, error)
+    return site_info
+
+
+def finalize_setup_environment(task, site_info):
+    """
+    The final setup pipeline step.
+    """
+    site_info.end_time = datetime.datetime.utcnow()
+    logger.info('Setup of site %s complete in %.2f seconds',
+                site_info.site_id, site_info.elapsed_time or -1)
+    if site_info.elapsed_time is not None:
+        site_info.record_phase('total', site_info.elapsed_time, emit=True)
+    logger.info('Setup of site %s phase timings %s', site_info.site_id, site_info.phase_timings)
 
     assert site_info.ds_site_id
     return site_info
 
 
+#: How long the haproxy backend task is delayed after the setup starts
+_HAPROXY_COUNTDOWN = 10
+
+#: For each task in the setup group, the phase its time spent waiting
+#: in the queue is recorded as, and how long it was told to wait.
+_GROUP_QUEUE_PHASES = (('queue_wait.dns', 0),
+                       ('queue_wait.haproxy', _HAPROXY_COUNTDOWN),
+                       ('queue_wait.provision', 0))
+
+#: The steps, in order, that follow the setup group
+_SETUP_PIPELINE = (join_setup_environment_task,
+                   await_setup_reload,
+                   verify_setup_site,
+                   finalize_setup_environment)
+
+
 @interface.implementer(IInitializedSiteInfo)
 class SiteInfo(object):
 
@@ -226,6 +423,11 @@ class SiteInfo(object):
     end_time = None
     task_result_dict = None
     ds_site_id = None
+    reload_task = None
+    reload_requested_at = None
+    public_verified = None
+    phase_timings = None
+    verify_attempts = ()
 
     def __init__(self, site_id, dns_name):
         self.site_id = site_id
@@ -237,6 +439,44 @@ class SiteInfo(object):
             return None
         return (self.end_time - self.start_time).total_seconds()
 
+    @property
+    def start_timestamp(self):
+        if not self.start_time:
+            return None
+        return self.start_time.replace(tzinfo=datetime.timezone.utc).timestamp()
+
+    def record_phase(self, phase, seconds, host=None, emit=False):
+        """
+        Add `seconds` to the time spent in `phase`, optionally emitting
+        it to statsd. Phases measured by another task have already been
+        emitted by that task.
+        """
+        if self.phase_timings is None:
+            self.phase_timings = {}
+        self.phase_timings[phase] = self.phase_timings.get(phase, 0) + seconds
+        if emit:
+            emit_phase_timing(phase, seconds, host)
+
+    def merge_timings(self, timings, queue_phase=None, queued_at=None):
+        """
+        Merge the timings returned by a task, as produced by
+        `PhaseTimer.as_dict`. If queued_at is given the time between it
+        and when the task started is recorded as queue_phase.
+        """
+        for phase, seconds in timings['phases'].items():
+            self.record_phase(phase, seconds)
+
+        if queue_phase and queued_at is not None:
+            # Clocks on different hosts don't agree exactly, don't
+            # let that make for a negative wait.
+            waited = max(timings['started_at'] - queued_at, 0)
+            self.record_phase(queue_phase, waited, host=timings['host'], emit=True)
+
+    def record_verify_attempt(self, seconds):
+        self.verify_attempts = tuple(self.verify_attempts) + (seconds,)
+        self.record_phase('verify', seconds)
+        emit_phase_timing('verify_attempt', seconds)
+
     def _get_result_val(self, key, default=None):
         """
         Get the value defined in the result dict, returning the `default`if
@@ -263,6 +503,13 @@ class SiteInfo(object):
     def host(self):
         return self._get_result_val('host_system')
 
+    @property
+    def socket_verified(self):
+        """
+        Whether provisioning verified the dataserver over its unix socket.
+        """
+        return bool(self._get_result_val('socket_verified'))
+
     @property
     def peer_environments(self):
         """
@@ -278,47 +525,77 @@ class SiteInfo(object):
 
 @interface.implementer(ISetupEnvironmentTask)
 class SetupEnvironmentTask(AbstractTask):
+    """
+    Sets up an environment by running the provisioning, dns, and haproxy
+    tasks as a group, followed by a chain of pipeline steps: the haproxy
+    reload, site verification, and finalization. None of the steps
+    block waiting on something else. A step that has to wait re-enqueues
+    itself with a countdown, so a single worker can move many setups
+    along at once.
+    """
 
     def __init__(self, app):
         self.app = app
 
     @classmethod
     def bind(cls, app):
-        app.task(bind=True, name=join_setup_environment_task.__name__)(join_setup_environment_task)
+        for step in _SETUP_PIPELINE:
+            app.task(bind=True, name=step.__name__)(step)
 
     @property
     def join_task(self):
         return self.app.tasks[join_setup_environment_task.__name__]
 
-    def __call__(self, site_id, site_name, dns_name, name, email):
+    def stage_signatures(self, site_id, site_name, dns_name, name, email):
+        """
+        Returns the signatures of the dns, haproxy and provisioning
+        tasks that make up the setup group, in that order.
+        """
         dns_name = dns_name.lower()
 
         ha = IHaproxyBackendTask(self.app).task
         dns = IDNSMappingTask(self.app).task
         prov = IProvisionEnvironmentTask(self.app).task
 
-        ha = ha.s(site_id, dns_name).set(countdown=10)
+        ha = ha.s(site_id, dns_name).set(countdown=_HAPROXY_COUNTDOWN)
 
         dns = dns.s(dns_name)
         prov = prov.s(site_id, site_name, dns_name, name, email)
+        if placement_enabled():
+            queue = choose_host_queue(self.app)
+            if queue is not None:
+                prov = prov.set(queue=queue)
+        return dns, ha, prov
 
-        info = SiteInfo(site_id, dns_name)
+    def pipeline_signatures(self, step_options=None):
+        """
+        Returns the signatures of the steps that follow the join.
+        step_options maps step names to the keyword arguments to give them.
+        """
+        step_options = step_options or {}
+        return [self.app.tasks[step.__name__].s(**step_options.get(step.__name__, {}))
+                for step in _SETUP_PIPELINE[1:]]
+
+    def __call__(self, site_id, site_name, dns_name, name, email):
+        dns, ha, prov = self.stage_signatures(site_id, site_name, dns_name, name, email)
+
+        info = SiteInfo(site_id, dns_name.lower())
         info.start_time = datetime.datetime.utcnow()
 
         g1 = group(dns, ha, prov)
 
-        c = ( g1 | self.join_task.s(info))
+        c = chain(g1, self.join_task.s(info), *self.pipeline_signatures())
         return c()
 
 
 def main():
-    from .worker import app
-
     parser = argparse.ArgumentParser()
     parser.add_argument("--host", required=False)
     args = parser.parse_args()
 
-    task = ISetupEnvironmentTask(app)
+    from .worker import get_app
+
+    task = ISetupEnvironmentTask(get_app())
 
     result = task('foo', 'bar', 'baz.nextthought.io')
 
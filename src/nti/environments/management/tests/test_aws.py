@@ -0,0 +1,64 @@
+from hamcrest import assert_that
+from hamcrest import calling
+from hamcrest import is_
+from hamcrest import is_not
+from hamcrest import raises
+from hamcrest import same_instance
+
+from botocore.exceptions import ClientError
+
+import fudge
+
+import unittest
+
+from ..aws import AWSClientPool
+
+
+def _client_error(code):
+    return ClientError({'Error': {'Code': code, 'Message': code}}, 'Operation')
+
+
+class TestAWSClientPool(unittest.TestCase):
+
+    def setUp(self):
+        self.created = []
+        self.pool = AWSClientPool(self._factory)
+
+    def _factory(self, service_name):
+        client = object()
+        self.created.append((service_name, client))
+        return client
+
+    def test_clients_are_reused(self):
+        client = self.pool.client('route53')
+        assert_that(self.pool.client('route53'), is_(same_instance(client)))
+        assert_that(self.pool.client('iam'), is_not(same_instance(client)))
+        assert_that(len(self.created), is_(2))
+
+    @fudge.patch('os.getpid')
+    def test_reset_after_fork(self, mock_getpid):
+        mock_getpid.is_callable().returns(1)
+        pool = AWSClientPool(self._factory)
+        client = pool.client('route53')
+
+        mock_getpid.is_callable().returns(2)
+        assert_that(pool.client('route53'), is_not(same_instance(client)))
+
+    def test_rebuilt_on_expired_credentials(self):
+        seen = []
+        def _call(client):
+            seen.append(client)
+            if len(seen) == 1:
+                raise _client_error('ExpiredToken')
+            return 'done'
+
+        assert_that(self.pool.invoke('route53', _call), is_('done'))
+        assert_that(seen[0], is_not(same_instance(seen[1])))
+
+    def test_other_errors_raise(self):
+        def _call(client):
+            raise _client_error('AccessDenied')
+
+        assert_that(calling(self.pool.invoke).with_args('route53', _call),
+                    raises(ClientError))
+        assert_that(len(self.created), is_(1))
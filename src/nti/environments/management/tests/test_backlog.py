@@ -0,0 +1,78 @@
+from hamcrest import assert_that
+from hamcrest import close_to
+from hamcrest import has_entries
+from hamcrest import has_item
+from hamcrest import is_
+
+from perfmetrics import set_statsd_client
+
+from perfmetrics.testing import FakeStatsDClient
+
+from perfmetrics.testing.matchers import is_gauge
+
+import time
+import unittest
+
+from ..backlog import BacklogSampler
+
+from ..celery import configure_celery
+
+
+class TestBacklogSampler(unittest.TestCase):
+
+    def setUp(self):
+        self.statsd = FakeStatsDClient()
+        set_statsd_client(self.statsd)
+
+        self.app = configure_celery(settings={'celery.broker_url': 'memory://',
+                                              'celery.backend_url': 'cache+memory://'})
+
+        @self.app.task(name='sampled')
+        def sampled():
+            pass
+        self.task = sampled
+
+        self.app.finalize()
+        self._purge()
+
+    def tearDown(self):
+        self._purge()
+        set_statsd_client(None)
+
+    def _purge(self):
+        # The memory transport's queues are shared by the whole process
+        with self.app.connection_for_write() as connection:
+            for queue in self.app.conf.task_queues:
+                queue(connection.default_channel).declare()
+                queue(connection.default_channel).purge()
+
+    def test_sample(self):
+        self.task.apply_async()
+        time.sleep(0.2)
+        self.task.apply_async()
+
+        samples = BacklogSampler(self.app, 60).sample()
+
+        depth, oldest_age = samples['default']
+        assert_that(depth, is_(2))
+        assert_that(oldest_age, close_to(0.2, 0.15))
+        assert_that(samples, has_entries('any_host', (0, None)))
+        assert_that(self.statsd, has_item(is_gauge('celery.queue.default.depth', '2')))
+        assert_that(self.statsd, has_item(is_gauge('celery.queue.any_host.depth', '0')))
+        assert_that(self.statsd, has_item(is_gauge('celery.queue.any_host.oldest_age', '0')))
+
+    def test_thread(self):
+        self.task.apply_async()
+
+        sampler = BacklogSampler(self.app, 0.01)
+        sampler.start()
+        try:
+            deadline = time.time() + 5
+            while not any(m.name == 'celery.queue.default.depth' for m in self.statsd.observations) \
+                  and time.time() < deadline:
+                time.sleep(0.01)
+        finally:
+            sampler.stop()
+
+        assert_that(sampler._thread, is_(None))
+        assert_that(self.statsd, has_item(is_gauge('celery.queue.default.depth', '1')))
@@ -0,0 +1,228 @@
+from hamcrest import assert_that
+from hamcrest import contains_inanyorder
+from hamcrest import has_entries
+from hamcrest import has_length
+from hamcrest import instance_of
+from hamcrest import is_
+
+import fudge
+
+import contextlib
+
+import io
+
+import os
+
+import tempfile
+
+import threading
+
+import time
+
+import unittest
+
+from requests.exceptions import ConnectionError
+
+from ..bulk import BulkSetup
+from ..bulk import Checkpoint
+from ..bulk import InvalidSiteSpec
+from ..bulk import SiteSpec
+from ..bulk import read_site_specs
+
+from ..celery import configure_celery
+
+from ..tasks import SetupEnvironmentTask
+
+
+class TestReadSiteSpecs(unittest.TestCase):
+
+    def test_csv(self):
+        stream = io.StringIO('site_id,site_name,dns_name,name,email\n'
+                             'S1,Site One,one.nextthot.com,Larry Bird,larry@nextthought.com\n')
+
+        assert_that(list(read_site_specs(stream)),
+                    is_([SiteSpec('S1', 'Site One', 'one.nextthot.com', 'Larry Bird', 'larry@nextthought.com')]))
+
+    def test_jsonl(self):
+        stream = io.StringIO('{"site_id": "S1", "site_name": "Site One", "dns_name": "one.nextthot.com", '
+                             '"name": "Larry Bird", "email": "larry@nextthought.com", "extra": 1}\n'
+                             '\n')
+
+        assert_that(list(read_site_specs(stream)),
+                    is_([SiteSpec('S1', 'Site One', 'one.nextthot.com', 'Larry Bird', 'larry@nextthought.com')]))
+
+    def test_missing_field(self):
+        stream = io.StringIO('{"site_id": "S1"}\n')
+
+        specs = list(read_site_specs(stream, 'jsonl'))
+        assert_that(specs, has_length(1))
+        assert_that(specs[0], instance_of(InvalidSiteSpec))
+        assert_that(specs[0].site_id, is_('S1'))
+
+    def test_invalid_rows(self):
+        stream = io.StringIO('{"site_id": "S1", "site_name": "Site One", "dns_name": "one.nextthot.com", '
+                             '"name": "Larry Bird", "email": "larry@nextthought.com"}\n'
+                             '{"site_id": "S2", \n'
+                             '["S3"]\n'
+                             '{"site_id": "S4", "site_name": "Site Four", "dns_name": "four.nextthot.com", '
+                             '"name": "Larry Bird", "email": "larry@nextthought.com"}\n')
+
+        specs = list(read_site_specs(stream))
+        assert_that([type(spec) for spec in specs],
+                    is_([SiteSpec, InvalidSiteSpec, InvalidSiteSpec, SiteSpec]))
+        assert_that([spec.line for spec in specs[1:3]], is_([2, 3]))
+
+
+class _Concurrency(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.current = 0
+        self.peak = 0
+
+    def __enter__(self):
+        with self.lock:
+            self.current += 1
+            self.peak = max(self.peak, self.current)
+
+    def __exit__(self, *args):
+        with self.lock:
+            self.current -= 1
+
+
+class _FakeSetup(SetupEnvironmentTask):
+
+    def __init__(self, app, provisioning):
+        super(_FakeSetup, self).__init__(app)
+        self.provisioned = []
+
+        @app.task(name='fake_dns', shared=False)
+        def fake_dns(dns_name):
+            return None
+
+        @app.task(name='fake_haproxy', shared=False)
+        def fake_haproxy(site_id, dns_name):
+            return {'live': True}
+
+        @app.task(name='fake_provision', shared=False)
+        def fake_provision(site_id, site_name, dns_name, name, email):
+            with provisioning:
+                time.sleep(0.05)
+            if 'error' in dns_name:
+                raise ValueError('Provisioning failed')
+            self.provisioned.append(site_id)
+            return {'host_system': 'host1', 'admin_invitation': '/invite',
+                    'socket_verified': True, 'ds_site_id': site_id.lower()}
+
+        self.tasks = (fake_dns, fake_haproxy, fake_provision)
+
+    def stage_signatures(self, site_id, site_name, dns_name, name, email):
+        dns, ha, prov = self.tasks
+        return dns.s(dns_name), ha.s(site_id, dns_name), prov.s(site_id, site_name, dns_name, name, email)
+
+
+def _spec(i, dns_name=None):
+    return SiteSpec('S%i' % i, 'Site %i' % i, dns_name or 'site%i.nextthot.com' % i,
+                    'Larry Bird', 'larry@nextthought.com')
+
+
+class TestBulkSetup(unittest.TestCase):
+
+    def setUp(self):
+        self.app = configure_celery(settings={'celery.broker_url': 'memory://',
+                                              'celery.backend_url': 'cache+memory://'})
+        self.app.conf.task_always_eager = True
+        SetupEnvironmentTask.bind(self.app)
+        self.provisioning = _Concurrency()
+        self.setup = _FakeSetup(self.app, self.provisioning)
+        self.app.finalize()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        # Eager tasks deny joins with a process wide flag they save and
+        # restore, which goes wrong when applied from concurrent threads.
+        self.join_patch = fudge.patch_object('celery.app.task', 'denied_join_result',
+                                             contextlib.nullcontext)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+        self.join_patch.restore()
+
+    def _bulk(self, **kwargs):
+        return BulkSetup(self.app, setup=self.setup, **kwargs)
+
+    @fudge.patch('nti.environments.management.tasks._do_ping_site')
+    def test_limits(self, mock_ping):
+        mock_ping.is_callable().raises(ConnectionError())
+
+        results = list(self._bulk(limits={'provision': 2}, max_sites=4).run(_spec(i) for i in range(8)))
+
+        assert_that(self.provisioning.peak, is_(2))
+        assert_that([r['site_id'] for r in results], contains_inanyorder(*['S%i' % i for i in range(8)]))
+        assert_that(results[0], has_entries('status', 'ok',
+                                            'host', 'host1',
+                                            'admin_invitation', '/invite'))
+
+    @fudge.patch('nti.environments.management.tasks._do_ping_site')
+    def test_resume(self, mock_ping):
+        mock_ping.is_callable().raises(ConnectionError())
+        path = os.path.join(self.tmpdir.name, 'checkpoint.jsonl')
+        specs = [_spec(1), _spec(2, 'error.nextthot.com'), _spec(3)]
+
+        results = list(self._bulk(checkpoint=Checkpoint(path)).run(specs))
+
+        assert_that(sorted((r['site_id'], r['status']) for r in results),
+                    is_([('S1', 'ok'), ('S2', 'error'), ('S3', 'ok')]))
+        assert_that(sorted(self.setup.provisioned), is_(['S1', 'S3']))
+
+        # An interrupted write is ignored
+        with open(path, 'a') as f:
+            f.write('{"site_id": "S')
+
+        # Only the failed site is tried again
+        results = list(self._bulk(checkpoint=Checkpoint(path)).run(specs))
+        assert_that([(r['site_id'], r['status']) for r in results], is_([('S2', 'error')]))
+        assert_that(sorted(self.setup.provisioned), is_(['S1', 'S3']))
+
+    @fudge.patch('nti.environments.management.tasks._do_ping_site')
+    def test_invalid_spec_recorded(self, mock_ping):
+        mock_ping.is_callable().raises(ConnectionError())
+        path = os.path.join(self.tmpdir.name, 'checkpoint.jsonl')
+        specs = [_spec(1), InvalidSiteSpec(2, 'S2', 'Invalid site spec'), _spec(3)]
+
+        results = list(self._bulk(checkpoint=Checkpoint(path)).run(specs))
+
+        assert_that(sorted((r['site_id'], r['status']) for r in results),
+                    is_([('S1', 'ok'), ('S2', 'error'), ('S3', 'ok')]))
+        with open(path) as f:
+            assert_that(f.readlines(), has_length(3))
+
+    @fudge.patch('nti.environments.management.tasks._do_ping_site')
+    def test_interrupted(self, mock_ping):
+        mock_ping.is_callable().raises(ConnectionError())
+        path = os.path.join(self.tmpdir.name, 'checkpoint.jsonl')
+
+        def specs():
+            yield _spec(1)
+            yield _spec(2)
+            raise KeyboardInterrupt()
+
+        with self.assertRaises(KeyboardInterrupt):
+            list(self._bulk(checkpoint=Checkpoint(path)).run(specs()))
+
+        # The sites started before the interrupt are recorded and not repeated
+        assert_that(Checkpoint(path).completed, is_({'S1', 'S2'}))
+        results = list(self._bulk(checkpoint=Checkpoint(path)).run([_spec(1), _spec(2)]))
+        assert_that(results, is_([]))
+        assert_that(sorted(self.setup.provisioned), is_(['S1', 'S2']))
+
+    @fudge.patch('nti.environments.management.tasks._do_ping_site')
+    def test_closed(self, mock_ping):
+        mock_ping.is_callable().raises(ConnectionError())
+        path = os.path.join(self.tmpdir.name, 'checkpoint.jsonl')
+
+        results = self._bulk(checkpoint=Checkpoint(path), max_sites=2).run(_spec(i) for i in range(4))
+        next(results)
+        results.close()
+
+        # Everything in flight when we stopped listening was recorded
+        assert_that(Checkpoint(path).completed, is_(set(self.setup.provisioned)))
+        assert_that(len(self.setup.provisioned) >= 2, is_(True))
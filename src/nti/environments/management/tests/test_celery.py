@@ -1,4 +1,6 @@
 from hamcrest import assert_that
+from hamcrest import close_to
+from hamcrest import has_item
 from hamcrest import is_
 from hamcrest import contains_inanyorder
 
@@ -9,14 +11,23 @@ from perfmetrics.testing import FakeStatsDClient
 
 from perfmetrics import set_statsd_client
 
+import datetime
+import time
 import uuid
 import unittest
 
+from ..celery import PUBLISHED_AT_HEADER
+from ..celery import _queue_wait
+from ..celery import task_publish_handler
 from ..celery import task_prerun_handler
 from ..celery import task_postrun_handler
 from ..celery import task_success_handler
 from ..celery import task_failure_handler
 
+class MockRequest(object):
+
+    eta = None
+
 class MockTask(object):
 
     name = None
@@ -25,6 +36,7 @@ class MockTask(object):
     def __init__(self, name):
         self.name = name
         self.id = uuid.uuid4().hex
+        self.request = MockRequest()
 
 class TestCeleryStats(unittest.TestCase):
 
@@ -72,3 +84,34 @@ class TestCeleryStats(unittest.TestCase):
                                                      is_counter('celery.task.mytask.failure'),
                                                      is_timer('celery.task.mytask.t')))
         
+
+    def test_queue_wait(self):
+        task = MockTask('mytask')
+        setattr(task.request, PUBLISHED_AT_HEADER, time.time() - 2)
+        task_prerun_handler(task.id, task)
+
+        assert_that(self.statsd, has_item(is_timer('celery.task.mytask.queue_wait')))
+        timer = [m for m in self.statsd.observations if m.name == 'celery.task.mytask.queue_wait'][0]
+        assert_that(float(timer.value), close_to(2000, 100))
+
+
+class TestQueueWait(unittest.TestCase):
+
+    def test_publish_stamps_headers(self):
+        headers = {PUBLISHED_AT_HEADER: 0}
+        task_publish_handler(headers=headers)
+        assert_that(headers[PUBLISHED_AT_HEADER], close_to(time.time(), 1))
+
+    def test_unstamped(self):
+        assert_that(_queue_wait(MockRequest()), is_(None))
+
+    def test_eta(self):
+        # Waiting for an eta doesn't count
+        request = MockRequest()
+        setattr(request, PUBLISHED_AT_HEADER, time.time() - 60)
+        eta = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=5)
+        request.eta = eta.isoformat()
+        assert_that(_queue_wait(request), close_to(5, 1))
+
+        request.eta = eta + datetime.timedelta(seconds=10)
+        assert_that(_queue_wait(request), is_(0))
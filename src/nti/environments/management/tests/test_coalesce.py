@@ -0,0 +1,70 @@
+from hamcrest import assert_that
+from hamcrest import calling
+from hamcrest import contains_inanyorder
+from hamcrest import has_length
+from hamcrest import is_
+from hamcrest import raises
+
+import threading
+
+import unittest
+
+from ..coalesce import Coalescer
+
+
+class TestCoalescer(unittest.TestCase):
+
+    def setUp(self):
+        self.batches = []
+
+    def _handler(self, items):
+        self.batches.append(items)
+        return [item * 2 if item >= 0 else ValueError(item) for item in items]
+
+    def _submit_concurrently(self, coalescer, items):
+        results = {}
+        def _submit(item):
+            try:
+                results[item] = coalescer.submit(item)
+            except Exception as e: # pylint: disable=broad-except
+                results[item] = e
+        threads = [threading.Thread(target=_submit, args=(item,)) for item in items]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return results
+
+    def test_single_submit(self):
+        coalescer = Coalescer(self._handler, 0, 10)
+        assert_that(coalescer.submit(2), is_(4))
+        assert_that(self.batches, is_([[2]]))
+
+    def test_concurrent_submits_coalesce(self):
+        coalescer = Coalescer(self._handler, 5, 4)
+        results = self._submit_concurrently(coalescer, [1, 2, 3, 4])
+
+        # The batch fills before the window elapses
+        assert_that(self.batches, has_length(1))
+        assert_that(self.batches[0], contains_inanyorder(1, 2, 3, 4))
+        assert_that(results, is_({1: 2, 2: 4, 3: 6, 4: 8}))
+
+    def test_max_size_splits_batches(self):
+        coalescer = Coalescer(self._handler, 0.5, 2)
+        results = self._submit_concurrently(coalescer, [1, 2, 3, 4, 5])
+
+        assert_that(results, is_({1: 2, 2: 4, 3: 6, 4: 8, 5: 10}))
+        assert_that([len(b) <= 2 for b in self.batches], is_([True] * len(self.batches)))
+
+    def test_individual_errors(self):
+        coalescer = Coalescer(self._handler, 5, 2)
+        results = self._submit_concurrently(coalescer, [1, -1])
+
+        assert_that(results[1], is_(2))
+        assert_that(results[-1], is_(ValueError))
+
+    def test_handler_error(self):
+        def _fail(items):
+            raise KeyError('boom')
+        coalescer = Coalescer(_fail, 0, 1)
+        assert_that(calling(coalescer.submit).with_args(1), raises(KeyError))
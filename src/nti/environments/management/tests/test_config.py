@@ -1,13 +1,35 @@
 from hamcrest import assert_that
+from hamcrest import contains_inanyorder
+from hamcrest import has_length
 from hamcrest import is_
+from hamcrest import same_instance
 
+from perfmetrics import set_statsd_client
 
+from perfmetrics.testing import FakeStatsDClient
+
+from perfmetrics.testing.matchers import is_counter
+from perfmetrics.testing.matchers import is_timer
+
+import os
+import tempfile
 import unittest
 
 from zope import component
+from zope import interface
+
+from zope.component.hooks import setHooks
+from zope.component.hooks import site
+
+from zope.interface.registry import Components
 
 from . import SharedConfiguringTestLayer
 
+from ..config import SettingsReloader
+from ..config import _StagingSite
+from ..config import read_settings
+from ..config import settings_sections
+
 from ..interfaces import ISettings
 
 class TestConfig(unittest.TestCase):
@@ -22,3 +44,152 @@ class TestConfig(unittest.TestCase):
         assert_that(settings['dns']['zone'], is_('nextthot.com.'))
 
         
+
+
+class IZone(interface.Interface):
+    pass
+
+
+def _zone_factory():
+    zone = component.getUtility(ISettings)['dns']['zone']
+    if not zone.endswith('.'):
+        raise ValueError('Bad zone %s' % zone)
+    return {'zone': zone}
+
+
+class IBroker(interface.Interface):
+    pass
+
+
+class IPool(interface.Interface):
+    pass
+
+
+_built = []
+
+@settings_sections('celery')
+def _broker_factory():
+    _built.append('broker')
+    return {'broker': component.getUtility(ISettings)['celery']['celery.broker_url']}
+
+@settings_sections('pool', reloadable=False)
+def _pool_factory():
+    _built.append('pool')
+    return {'size': component.getUtility(ISettings)['pool']['size']}
+
+
+_CONFIG = """
+[celery]
+celery.broker_url = memory://
+
+[dns]
+zone = %s
+
+[pool]
+size = 1
+"""
+
+
+class TestSettingsReloader(unittest.TestCase):
+
+    def setUp(self):
+        self.statsd = FakeStatsDClient()
+        set_statsd_client(self.statsd)
+
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'settings.ini')
+        self.writes = 0
+        self._write('nextthot.com.')
+
+        self.registry = Components('test', bases=(component.getGlobalSiteManager(),))
+        self.registry.registerUtility(read_settings([self.path]), ISettings)
+        setHooks()
+        with site(_StagingSite(self.registry)):
+            self.registry.registerUtility(provided=IZone, factory=_zone_factory)
+            self.registry.registerUtility(provided=IBroker, factory=_broker_factory)
+            self.registry.registerUtility(provided=IPool, factory=_pool_factory)
+        del _built[:]
+        self.reloader = SettingsReloader([self.path], 0, registry=self.registry)
+
+    def tearDown(self):
+        set_statsd_client(None)
+        self.tmpdir.cleanup()
+
+    def _write(self, zone, broker='memory://', size=1):
+        with open(self.path, 'w') as f:
+            f.write(_CONFIG.replace('memory://', broker).replace('size = 1', 'size = %i' % size) % zone)
+        # Don't depend on the filesystem's timestamp granularity
+        self.writes += 1
+        os.utime(self.path, (self.writes, self.writes))
+
+    def _zone(self):
+        return self.registry.getUtility(IZone)['zone']
+
+    def test_unchanged(self):
+        assert_that(self.reloader.check(), is_(False))
+        assert_that(self.statsd, has_length(0))
+
+    def test_reload(self):
+        self._write('nextthought.io.')
+
+        assert_that(self.reloader.check(), is_(True))
+        assert_that(self.registry.getUtility(ISettings)['dns']['zone'], is_('nextthought.io.'))
+        assert_that(self._zone(), is_('nextthought.io.'))
+        assert_that(self.statsd, contains_inanyorder(is_counter('environments.settings.reload'),
+                                                     is_timer('environments.settings.reload.t')))
+
+        # Only once per change, and still rebuilt on the next one
+        assert_that(self.reloader.check(), is_(False))
+        self._write('nextthot.com.')
+        assert_that(self.reloader.check(), is_(True))
+        assert_that(self._zone(), is_('nextthot.com.'))
+
+    def test_rejected(self):
+        self._write('nextthought.io')
+
+        assert_that(self.reloader.check(), is_(False))
+        assert_that(self.registry.getUtility(ISettings)['dns']['zone'], is_('nextthot.com.'))
+        assert_that(self._zone(), is_('nextthot.com.'))
+        assert_that(self.statsd, contains_inanyorder(is_counter('environments.settings.reload_failed')))
+
+    def test_missing_file_rejected(self):
+        os.remove(self.path)
+
+        assert_that(self.reloader.check(), is_(False))
+        assert_that(self.registry.getUtility(ISettings)['dns']['zone'], is_('nextthot.com.'))
+        assert_that(self.statsd, contains_inanyorder(is_counter('environments.settings.reload_failed')))
+
+    def test_restart_required(self):
+        self._write('nextthot.com.', broker='redis://')
+
+        assert_that(self.reloader.check(), is_(True))
+        assert_that(_built, is_(['broker']))
+        assert_that(self.statsd, contains_inanyorder(is_counter('environments.settings.restart_required'),
+                                                     is_counter('environments.settings.reload'),
+                                                     is_timer('environments.settings.reload.t')))
+
+    def test_unchanged_sections_kept(self):
+        broker = self.registry.getUtility(IBroker)
+        self._write('nextthought.io.')
+
+        assert_that(self.reloader.check(), is_(True))
+        # Only the zone, which doesn't declare its sections, is rebuilt
+        assert_that(self._zone(), is_('nextthought.io.'))
+        assert_that(_built, is_([]))
+        assert_that(self.registry.getUtility(IBroker), is_(same_instance(broker)))
+
+    def test_not_reloadable(self):
+        pool = self.registry.getUtility(IPool)
+        self._write('nextthot.com.', size=2)
+
+        assert_that(self.reloader.check(), is_(True))
+        assert_that(_built, is_([]))
+        assert_that(self.registry.getUtility(IPool), is_(same_instance(pool)))
+        assert_that(self.statsd, contains_inanyorder(is_counter('environments.settings.restart_required'),
+                                                     is_counter('environments.settings.reload'),
+                                                     is_timer('environments.settings.reload.t')))
+
+    def test_interval(self):
+        reloader = SettingsReloader([self.path], 60, registry=self.registry)
+        self._write('nextthought.io.')
+        assert_that(reloader.check(), is_(False))
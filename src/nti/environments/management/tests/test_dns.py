@@ -1,10 +1,25 @@
 from hamcrest import assert_that
+from hamcrest import contains_inanyorder
+from hamcrest import contains_string
+from hamcrest import has_key
+from hamcrest import has_length
 from hamcrest import is_
+from hamcrest import is_not
+from hamcrest import same_instance
+
+import boto3
+
+from botocore.stub import ANY
+from botocore.stub import Stubber
+
+import datetime
 
 import fudge
 
 from fudge.inspector import arg
 
+import threading
+
 import unittest
 
 from zope import component
@@ -13,6 +28,9 @@ from . import SharedConfiguringTestLayer
 
 from ..interfaces import IDNSAliasRecordCreator
 
+from ..aws import AWSClientPool
+
+from ..dns import DNSAliasAdder
 from ..dns import is_dns_name_available
 
 class TestDNS(unittest.TestCase):
@@ -33,3 +51,120 @@ class TestDNS(unittest.TestCase):
                                           alias_target='spin.nextthot.com')
         adder = component.getUtility(IDNSAliasRecordCreator)
         adder.add_alias('foo.nextthot.com')
+
+    @fudge.patch('nti.environments.management.dns.add_dns_recordset')
+    def test_client_reused(self, mock_add):
+        adder = component.getUtility(IDNSAliasRecordCreator)
+
+        clients = []
+        def _add(client, *args, **kwargs):
+            clients.append(client)
+        mock_add.is_callable().calls(_add)
+
+        adder.add_alias('foo.nextthot.com')
+        adder.add_alias('bar.nextthot.com')
+
+        assert_that(clients, has_length(2))
+        assert_that(clients[0], is_(same_instance(clients[1])))
+
+
+class TestBatchedDNS(unittest.TestCase):
+
+    def setUp(self):
+        self.client = boto3.client('route53',
+                                   region_name='us-east-1',
+                                   aws_access_key_id='test',
+                                   aws_secret_access_key='test')
+        self.stubber = Stubber(self.client)
+        self.stubber.activate()
+
+        self.submitted = []
+        def _capture(params, **kwargs):
+            self.submitted.append([c['ResourceRecordSet']['Name'] for c in params['ChangeBatch']['Changes']])
+        self.client.meta.events.register('provide-client-params.route53.ChangeResourceRecordSets', _capture)
+
+    def tearDown(self):
+        self.stubber.deactivate()
+
+    def _stub_zone(self):
+        self.stubber.add_response('list_hosted_zones_by_name',
+                                  {'HostedZones': [{'Id': '/hostedzone/Z123',
+                                                    'Name': 'nextthot.com.',
+                                                    'CallerReference': 'ref'}],
+                                   'IsTruncated': False,
+                                   'MaxItems': '1'},
+                                  {'DNSName': 'nextthot.com.', 'MaxItems': '1'})
+
+    def _stub_change(self):
+        self.stubber.add_response('change_resource_record_sets',
+                                  {'ChangeInfo': {'Id': '/change/C1',
+                                                  'Status': 'PENDING',
+                                                  'SubmittedAt': datetime.datetime.utcnow()}},
+                                  {'HostedZoneId': 'Z123', 'ChangeBatch': ANY})
+
+    def _add_concurrently(self, adder, names):
+        errors = {}
+        def _add(name):
+            try:
+                adder.add_alias(name)
+            except Exception as e: # pylint: disable=broad-except
+                errors[name] = e
+        threads = [threading.Thread(target=_add, args=(name,)) for name in names]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return errors
+
+    def _adder(self, **kwargs):
+        return DNSAliasAdder('nextthot.com.', 'spin.nextthot.com',
+                             clients=AWSClientPool(lambda name: self.client),
+                             **kwargs)
+
+    def test_coalesces_aliases(self):
+        self._stub_zone()
+        self._stub_change()
+
+        adder = self._adder(batch_window=1, batch_size=3)
+        names = ['a.nextthot.com', 'b.nextthot.com', 'c.nextthot.com']
+        errors = self._add_concurrently(adder, names)
+
+        assert_that(errors, is_({}))
+        assert_that(self.submitted, has_length(1))
+        assert_that(self.submitted[0], contains_inanyorder(*names))
+        self.stubber.assert_no_pending_responses()
+
+    def test_rejected_batch_fails_only_bad_name(self):
+        self._stub_zone()
+        self.stubber.add_client_error('change_resource_record_sets', 'InvalidChangeBatch')
+
+        adder = self._adder(batch_window=1, batch_size=2)
+
+        # Once the batch is rejected each change is submitted on its own
+        original = adder._change_record_sets
+        def _change(client, zone_id, changes):
+            if len(changes) == 1:
+                if changes[0]['ResourceRecordSet']['Name'] == 'bad.nextthot.com':
+                    self.stubber.add_client_error('change_resource_record_sets', 'InvalidChangeBatch')
+                else:
+                    self._stub_change()
+            return original(client, zone_id, changes)
+        adder._change_record_sets = _change
+
+        errors = self._add_concurrently(adder, ['good.nextthot.com', 'bad.nextthot.com'])
+
+        assert_that(errors, has_key('bad.nextthot.com'))
+        assert_that(errors, is_not(has_key('good.nextthot.com')))
+        assert_that(self.submitted, has_length(3))
+
+    def test_throttled_batch_fails_every_name(self):
+        self._stub_zone()
+        self.stubber.add_client_error('change_resource_record_sets', 'Throttling')
+
+        adder = self._adder(batch_window=1, batch_size=2)
+        errors = self._add_concurrently(adder, ['a.nextthot.com', 'b.nextthot.com'])
+
+        # Not retried one at a time
+        assert_that(errors, has_length(2))
+        assert_that(str(errors['a.nextthot.com']), contains_string('Throttling'))
+        self.stubber.assert_no_pending_responses()
@@ -1,17 +1,35 @@
 from hamcrest import assert_that
 from hamcrest import calling
+from hamcrest import contains_string
+from hamcrest import has_entries
+from hamcrest import has_item
 from hamcrest import has_length
 from hamcrest import is_
 from hamcrest import raises
 
 import fudge
 
+from perfmetrics import set_statsd_client
+
+from perfmetrics.testing import FakeStatsDClient
+
+from perfmetrics.testing.matchers import is_counter
+from perfmetrics.testing.matchers import is_gauge
+
 import unittest
 
+import json
+
 import os
 
+import socketserver
+
 import tempfile
 
+import threading
+
+import time
+
 from zope import component
 
 from . import SharedConfiguringTestLayer
@@ -21,7 +39,12 @@ from ..haproxy import backend_filename
 from ..haproxy import check_haproxy_status_output
 from ..haproxy import write_backend
 from ..haproxy import HAProxyCommandException
+from ..haproxy import HAProxyConfigurator
+from ..haproxy import HAProxyRuntimeClient
+from ..haproxy import ReloadCoordinator
+from ..haproxy import reload_coordinator
 from ..haproxy import reload_haproxy_cfg
+from ..haproxy import runtime_client
 
 from ..interfaces import IHaproxyConfigurator
 
@@ -124,6 +147,17 @@ class TestHaproxy(unittest.TestCase):
 
         assert_that(contents, is_(_EXPECTED_BACKED))
 
+    @fudge.patch('nti.environments.management.haproxy.reload_haproxy_cfg')
+    def test_reload_unchecked_by_default(self, mock_reload):
+        mock_reload.expects_call().with_args('/run/haproxy-master.sock', False)
+
+        patched = fudge.patch_object('nti.environments.management.haproxy',
+                                     '_reload_coordinator_settings', None)
+        try:
+            reload_coordinator().request_reload()
+        finally:
+            patched.restore()
+
     def test_show_proc_check(self):
         assert_that(check_haproxy_status_output(GOOD_RELOAD_OUTPUT), is_(True))
         assert_that(calling(check_haproxy_status_output).with_args(BAD_RELOAD_OUTPUT),
@@ -144,3 +178,305 @@ class TestHaproxy(unittest.TestCase):
         
         
         
+
+
+class _FakeHAProxyHandler(socketserver.StreamRequestHandler):
+    """
+    Speaks enough of the haproxy master cli to exercise our client.
+    """
+
+    def handle(self):
+        server = self.server
+        server.connections += 1
+        interactive = False
+        for line in self.rfile:
+            commands = [c.strip() for c in line.decode('utf-8').strip().split(';')]
+            server.received.append(commands)
+            output = []
+            for command in commands:
+                if command == 'prompt':
+                    interactive = True
+                elif command == 'reload':
+                    server.reloads += 1
+                    # The master re-executes, dropping every connection
+                    return
+                elif command.startswith('@1 '):
+                    output.append(server.worker_command(command[3:]))
+                else:
+                    output.append(server.responses.get(command, 'Unknown command.\n'))
+            self.wfile.write(''.join(output).encode('utf-8'))
+            if not interactive:
+                return
+            self.wfile.write(b'\nmaster> ')
+
+
+class _FakeHAProxy(socketserver.ThreadingUnixStreamServer):
+
+    daemon_threads = True
+
+    def __init__(self, path):
+        super(_FakeHAProxy, self).__init__(path, _FakeHAProxyHandler)
+        self.connections = 0
+        self.reloads = 0
+        self.received = []
+        self.responses = {'show proc': GOOD_RELOAD_OUTPUT}
+        self.maps = {}
+        self.servers = {}
+
+    def worker_command(self, command):
+        parts = command.split()
+        if parts[:2] == ['add', 'map']:
+            self.maps.setdefault(parts[2], {})[parts[3]] = parts[4]
+            return ''
+        if parts[:2] == ['set', 'server']:
+            self.servers.setdefault(parts[2], {})['addr'] = parts[4]
+            return "IP changed from '0.0.0.0' to '%s', port changed from '0' to '%s' by 'stats socket command'\n" % (parts[4], parts[6])
+        if parts[:2] == ['enable', 'server']:
+            self.servers.setdefault(parts[2], {})['enabled'] = True
+            return ''
+        if parts[:2] == ['disable', 'server']:
+            self.servers.setdefault(parts[2], {})['enabled'] = False
+            return ''
+        if parts[:2] == ['disable', 'health']:
+            self.servers.setdefault(parts[2], {})['checked'] = False
+            return ''
+        if parts[:2] == ['del', 'map']:
+            if self.maps.get(parts[2], {}).pop(parts[3], None) is None:
+                return 'Key not found.\n'
+            return ''
+        return 'Unknown command.\n'
+
+
+class TestRuntimeClient(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.socket_file = os.path.join(self.tempdir.name, 'master.sock')
+        self.mapping = os.path.join(self.tempdir.name, 'env.map')
+        with open(self.mapping, 'w') as f:
+            f.write('existing row\n')
+        self.server = _FakeHAProxy(self.socket_file)
+        threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True).start()
+        self.client = HAProxyRuntimeClient(self.socket_file)
+
+    def tearDown(self):
+        self.client.close()
+        runtime_client(self.socket_file).close()
+        self.server.shutdown()
+        self.server.server_close()
+        self.tempdir.cleanup()
+
+    def test_connection_reused(self):
+        assert_that(self.client.execute('show proc'), is_(GOOD_RELOAD_OUTPUT))
+        assert_that(self.client.execute('show proc'), is_(GOOD_RELOAD_OUTPUT))
+        assert_that(self.server.connections, is_(1))
+
+    def test_timeout_applied_to_reused_connection(self):
+        self.client.execute('show proc')
+        self.client.execute('show proc', timeout=5)
+        assert_that(self.client._sock.gettimeout(), is_(5))
+        assert_that(self.server.connections, is_(1))
+
+    def test_pipelined_commands(self):
+        self.server.responses['show info'] = 'Name: HAProxy\n'
+        output = self.client.execute('show info', 'show proc')
+        assert_that(output, is_('Name: HAProxy\n' + GOOD_RELOAD_OUTPUT))
+        assert_that(self.server.received[-1], is_(['show info', 'show proc']))
+
+    def test_large_response(self):
+        big = ''.join('line %i\n' % i for i in range(50000))
+        self.server.responses['show map'] = big
+        assert_that(self.client.execute('show map'), is_(big))
+
+    def test_reconnects_after_reload(self):
+        self.client.execute('show proc')
+        assert_that(self.client.execute('reload'), is_(''))
+        assert_that(self.client.execute('show proc'), is_(GOOD_RELOAD_OUTPUT))
+        assert_that(self.server.reloads, is_(1))
+        assert_that(self.server.connections, is_(2))
+
+    def test_reload_polls_until_ready(self):
+        reload_haproxy_cfg(self.socket_file, interval=0.01)
+        assert_that(self.server.reloads, is_(1))
+
+    def test_runtime_mapping(self):
+        configurator = HAProxyConfigurator(self.tempdir.name, self.mapping, self.socket_file,
+                                           map_updates='runtime', runtime_map='/etc/haproxy/maps/env.map')
+        # Backends haproxy has loaded
+        write_backend('S1', self.tempdir.name)
+        write_backend('S2', self.tempdir.name)
+
+        assert_that(configurator.add_mapping('S1', 'foo.nextthot.com'), is_(True))
+        assert_that(configurator.add_mapping('S2', 'foo.nextthot.com'), is_(True))
+
+        assert_that(self.server.maps, is_({'/etc/haproxy/maps/env.map': {'foo.nextthot.com': 'S2_backend'}}))
+        assert_that(self.server.reloads, is_(0))
+
+        with open(self.mapping, 'r') as f:
+            assert_that(f.read(), is_('existing row\nfoo.nextthot.com\tS2_backend\n'))
+
+    def test_runtime_mapping_waits_for_new_backend(self):
+        configurator = HAProxyConfigurator(self.tempdir.name, self.mapping, self.socket_file,
+                                           map_updates='runtime')
+
+        # Haproxy doesn't have the backend until it reloads
+        assert_that(configurator.add_backend('S1', 'foo.nextthot.com'), is_(False))
+        assert_that(self.server.maps, is_({}))
+        with open(self.mapping, 'r') as f:
+            assert_that(f.read(), is_('existing row\nfoo.nextthot.com\tS1_backend\n'))
+
+        configurator.reload_config()
+        assert_that(configurator.add_mapping('S1', 'bar.nextthot.com'), is_(True))
+        assert_that(self.server.maps, is_({self.mapping: {'bar.nextthot.com': 'S1_backend'}}))
+
+    def test_runtime_mapping_falls_back_to_file(self):
+        missing = os.path.join(self.tempdir.name, 'missing.sock')
+        configurator = HAProxyConfigurator(self.tempdir.name, self.mapping, missing,
+                                           map_updates='runtime')
+
+        # Haproxy can't be reached, but the mapping is still durable
+        assert_that(configurator.add_mapping('S1', 'foo.nextthot.com'), is_(False))
+        with open(self.mapping, 'r') as f:
+            assert_that(f.read(), is_('existing row\nfoo.nextthot.com\tS1_backend\n'))
+
+    @fudge.patch('nti.environments.management.haproxy.resolve_site_address')
+    def test_pooled_backends(self, mock_resolve):
+        mock_resolve.is_callable().returns('10.0.0.5')
+        os.mkdir(os.path.join(self.tempdir.name, 'backends'))
+        folder = os.path.join(self.tempdir.name, 'backends')
+
+        def _configurator():
+            return HAProxyConfigurator(folder, self.mapping, self.socket_file,
+                                       map_updates='runtime', backend_mode='pool',
+                                       pool_size=2, pool_flush_every=2)
+
+        # The first time through the slots get deployed, which needs a reload
+        configurator = _configurator()
+        assert_that(configurator.add_backend('S1', 'a.nextthot.com'), is_(False))
+        assert_that(os.path.exists(os.path.join(folder, '20-slots.cfg')), is_(True))
+        assert_that(os.path.exists(os.path.join(folder, '10-S1.cfg')), is_(True))
+
+        # Once deployed new sites are assigned slots without a reload
+        configurator = _configurator()
+        assert_that(configurator.add_backend('S2', 'b.nextthot.com'), is_(True))
+        # Checked with the slot's Host until a reload, so not checked at all
+        assert_that(self.server.servers['slot001_backend_static/web1'],
+                    is_({'addr': '10.0.0.5', 'enabled': True, 'checked': False}))
+        assert_that(self.server.servers['slot001_backend_node/node1'],
+                    is_({'addr': '10.0.0.5', 'enabled': True, 'checked': False}))
+        assert_that(self.server.maps[self.mapping]['b.nextthot.com'], is_('slot001_backend'))
+        with open(os.path.join(folder, 'slots.json'), 'r') as f:
+            assert_that(json.load(f), is_({}))
+
+        # Assignments are flushed to disk in batches
+        assert_that(configurator.add_backend('S3', 'c.nextthot.com'), is_(True))
+        with open(os.path.join(folder, 'slots.json'), 'r') as f:
+            assert_that(json.load(f), is_({'slot001': {'site_id': 'S2', 'dns_name': 'b.nextthot.com'},
+                                           'slot002': {'site_id': 'S3', 'dns_name': 'c.nextthot.com'}}))
+        with open(os.path.join(folder, '20-slots.cfg'), 'r') as f:
+            assert_that(f.read(), contains_string('server-template web 1 S3.nti:8085'))
+        with open(self.mapping, 'r') as f:
+            assert_that(f.read(), contains_string('c.nextthot.com\tslot002_backend\n'))
+
+        # Until we run out of slots
+        assert_that(configurator.add_backend('S4', 'd.nextthot.com'), is_(False))
+        assert_that(os.path.exists(os.path.join(folder, '10-S4.cfg')), is_(True))
+        assert_that(self.server.reloads, is_(0))
+
+    @fudge.patch('nti.environments.management.haproxy.resolve_site_address')
+    def test_release_slot(self, mock_resolve):
+        mock_resolve.is_callable().returns('10.0.0.5')
+        folder = os.path.join(self.tempdir.name, 'backends')
+        os.mkdir(folder)
+        configurator = HAProxyConfigurator(folder, self.mapping, self.socket_file,
+                                           backend_mode='pool', pool_size=1)
+        configurator.pool.flush(self.mapping)
+        configurator.pool.deployed = True
+        assert_that(configurator.add_backend('S1', 'a.nextthot.com'), is_(True))
+
+        assert_that(configurator.remove_backend('S1'), is_(True))
+        assert_that(self.server.maps[self.mapping], is_({}))
+        assert_that(self.server.servers['slot001_backend_data/data1'], has_entries('enabled', False))
+        with open(os.path.join(folder, 'slots.json'), 'r') as f:
+            assert_that(json.load(f), is_({}))
+        with open(self.mapping, 'r') as f:
+            assert_that(f.read(), is_('existing row\n'))
+
+        # The slot is free for the next site
+        assert_that(configurator.add_backend('S2', 'b.nextthot.com'), is_(True))
+        assert_that(self.server.maps[self.mapping], is_({'b.nextthot.com': 'slot001_backend'}))
+
+    def test_remove_site_backend(self):
+        configurator = HAProxyConfigurator(self.tempdir.name, self.mapping, self.socket_file)
+        configurator.add_backend('S1', 'a.nextthot.com')
+        configurator.add_mapping('S1', 'b.nextthot.com')
+
+        assert_that(configurator.remove_backend('S1'), is_(False))
+        assert_that(os.path.exists(os.path.join(self.tempdir.name, '10-S1.cfg')), is_(False))
+        with open(self.mapping, 'r') as f:
+            assert_that(f.read(), is_('existing row\n'))
+
+    def test_reload_times_out(self):
+        # The master never gives us a status
+        self.server.responses['show proc'] = ''
+        assert_that(calling(reload_haproxy_cfg).with_args(self.socket_file, timeout=0.1, interval=0.01),
+                    raises(HAProxyCommandException))
+
+
+class TestReloadCoordinator(unittest.TestCase):
+
+    def setUp(self):
+        self.statsd = FakeStatsDClient()
+        set_statsd_client(self.statsd)
+        self.reloads = []
+
+    def tearDown(self):
+        set_statsd_client(None)
+
+    def _reload(self):
+        self.reloads.append(time.time())
+
+    def test_serial_requests(self):
+        coordinator = ReloadCoordinator(self._reload)
+
+        before = time.time() - 1
+        coordinator.request_reload(before)
+        assert_that(self.reloads, has_length(1))
+
+        # Requested before that reload started, so already satisfied
+        coordinator.request_reload(before)
+        assert_that(self.reloads, has_length(1))
+
+        # Requested later, so we need another
+        coordinator.request_reload(time.time() + 1)
+        assert_that(self.reloads, has_length(2))
+
+        assert_that(coordinator.requests, is_(3))
+        assert_that(self.statsd, has_item(is_counter('haproxy.reload.coalesced')))
+        assert_that(self.statsd, has_item(is_gauge('haproxy.reload.coalesce_ratio', '1.5')))
+
+    def test_concurrent_requests_coalesce(self):
+        coordinator = ReloadCoordinator(self._reload, window=0.2)
+
+        requested_at = time.time() - 1
+        threads = [threading.Thread(target=coordinator.request_reload, args=(requested_at,))
+                   for _ in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        assert_that(self.reloads, has_length(1))
+        assert_that(coordinator.requests, is_(5))
+
+    def test_failure_shared(self):
+        def _fail():
+            raise HAProxyCommandException('Reload Failed')
+        coordinator = ReloadCoordinator(_fail)
+
+        requested_at = time.time() - 1
+        assert_that(calling(coordinator.request_reload).with_args(requested_at),
+                    raises(HAProxyCommandException))
+        assert_that(calling(coordinator.request_reload).with_args(requested_at),
+                    raises(HAProxyCommandException))
+        assert_that(coordinator.reloads, is_(1))
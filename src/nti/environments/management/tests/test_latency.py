@@ -0,0 +1,193 @@
+from hamcrest import assert_that
+from hamcrest import close_to
+from hamcrest import has_entries
+from hamcrest import has_item
+from hamcrest import has_key
+from hamcrest import is_
+from hamcrest import is_not
+
+from perfmetrics import set_statsd_client
+
+from perfmetrics.testing import FakeStatsDClient
+
+from perfmetrics.testing.matchers import is_counter
+
+import fudge
+
+import json
+import os
+import random
+import tempfile
+import threading
+import unittest
+
+from celery.worker.control import Panel
+
+from ..celery import task_prerun_handler
+from ..celery import task_postrun_handler
+
+from ..latency import SNAPSHOT_KEY
+from ..latency import LatencyHistograms
+from ..latency import RollingHistogram
+from ..latency import TimerStore
+from ..latency import histograms
+
+from ..prometheus import MetricsRegistry
+from ..prometheus import set_metrics_registry
+
+from .test_celery import MockTask
+
+
+class TestTimerStore(unittest.TestCase):
+
+    def test_stop(self):
+        store = TimerStore()
+        store.start('a', now=10)
+        assert_that(store.stop('a', now=12.5), is_(2.5))
+        assert_that(store.stop('a', now=13), is_(None))
+        assert_that(len(store), is_(0))
+
+    def test_other_thread(self):
+        store = TimerStore()
+        store.start('a')
+        elapsed = []
+        thread = threading.Thread(target=lambda: elapsed.append(store.stop('a')))
+        thread.start()
+        thread.join()
+        assert_that(elapsed[0], is_not(None))
+
+    def test_ttl(self):
+        store = TimerStore(ttl=60)
+        store.start('revoked', now=0)
+        store.start('running', now=30)
+        assert_that(store.start('new', now=65), is_(1))
+        assert_that(store.stop('revoked'), is_(None))
+        assert_that(store.stop('running', now=70), is_(40))
+
+    def test_max_size(self):
+        store = TimerStore(max_size=2)
+        store.start('a', now=0)
+        store.start('b', now=1)
+        assert_that(store.start('c', now=2), is_(1))
+        assert_that(len(store), is_(2))
+        assert_that(store.stop('a'), is_(None))
+
+    def test_restart(self):
+        store = TimerStore(max_size=2)
+        store.start('a', now=0)
+        store.start('b', now=1)
+        store.start('a', now=2)
+        assert_that(store.start('c', now=3), is_(1))
+        assert_that(store.stop('b'), is_(None))
+        assert_that(store.stop('a', now=4), is_(2))
+
+
+class TestRollingHistogram(unittest.TestCase):
+
+    def test_percentiles(self):
+        histogram = RollingHistogram(precision=0.01)
+        values = [random.uniform(0.001, 10) for _ in range(10000)]
+        for value in values:
+            histogram.record(value, now=0)
+        values.sort()
+
+        p50, p99 = histogram.percentiles([0.5, 0.99], now=0)
+        assert_that(p50, close_to(values[4999], values[4999] * 0.01))
+        assert_that(p99, close_to(values[9899], values[9899] * 0.01))
+        assert_that(histogram.count(now=0), is_(10000))
+
+    def test_window(self):
+        histogram = RollingHistogram(window=60, slots=6)
+        histogram.record(100, now=0)
+        histogram.record(1, now=30)
+        assert_that(histogram.percentiles([0.99], now=59)[0], close_to(100, 1))
+        assert_that(histogram.percentiles([0.99], now=61)[0], close_to(1, 0.01))
+        assert_that(histogram.percentiles([0.5], now=100), is_([None]))
+
+    def test_merge(self):
+        histogram = RollingHistogram(window=60, slots=6)
+        histogram.record(1, now=0)
+        other = RollingHistogram(window=60, slots=6)
+        other.record(100, now=0)
+        other.record(100, now=15)
+
+        histogram.merge(json.loads(json.dumps(other.snapshot())))
+        assert_that(histogram.count(now=15), is_(3))
+        assert_that(histogram.percentiles([0.99], now=15)[0], close_to(100, 1))
+        # The merged slots still expire
+        assert_that(histogram.count(now=61), is_(1))
+
+    def test_zero(self):
+        histogram = RollingHistogram()
+        histogram.record(0, now=0)
+        assert_that(histogram.percentiles([0.5], now=0), is_([0.0]))
+
+
+class TestLatencyHistograms(unittest.TestCase):
+
+    def setUp(self):
+        self.statsd = FakeStatsDClient()
+        set_statsd_client(self.statsd)
+        histograms.clear()
+
+    def tearDown(self):
+        set_statsd_client(None)
+        histograms.clear()
+
+    def test_summary(self):
+        latencies = LatencyHistograms()
+        for i in range(1, 101):
+            latencies.record('provision_env', 'runtime', i, now=0)
+        latencies.record('provision_env', 'queue_wait', 2, now=0)
+
+        summary = latencies.summary(now=0)
+        assert_that(summary['provision_env']['runtime'], has_entries('count', 100,
+                                                                     'p50', close_to(50, 1),
+                                                                     'p95', close_to(95, 1),
+                                                                     'p99', close_to(99, 1)))
+        assert_that(summary['provision_env']['queue_wait'], has_entries('count', 1,
+                                                                        'p50', close_to(2, 0.02)))
+
+    def test_signal_handlers(self):
+        task = MockTask('mytask')
+        task_prerun_handler(task.id, task)
+        task_postrun_handler(task.id, task)
+
+        assert_that(histograms.summary(), has_key('mytask'))
+        assert_that(histograms.summary()['mytask'], has_entries('runtime', has_entries('count', 1)))
+
+    def test_evictions_counted(self):
+        task = MockTask('mytask')
+        patched = fudge.patch_object('nti.environments.management.celery', '_timers', TimerStore(ttl=0))
+        try:
+            task_prerun_handler(task.id, task)
+            task_prerun_handler('another', task)
+        finally:
+            patched.restore()
+        assert_that(self.statsd, has_item(is_counter('celery.task.timers.evicted')))
+
+    def test_remote_control(self):
+        histograms.record('mytask', 'runtime', 1)
+        assert_that(Panel.data['latency'](None), has_key('mytask'))
+
+    def test_remote_control_prefork(self):
+        with tempfile.TemporaryDirectory() as directory:
+            registry = MetricsRegistry(directory)
+            registry.extras[SNAPSHOT_KEY] = histograms.snapshot
+            set_metrics_registry(registry)
+            try:
+                # A pool child's histograms, as written to its snapshot
+                child = LatencyHistograms()
+                child.record('provision_env', 'runtime', 60)
+                with open(os.path.join(directory, '%i.json' % os.getppid()), 'w') as f:
+                    json.dump({SNAPSHOT_KEY: child.snapshot(), 'counter': [], 'gauge': [],
+                               'histogram': []}, f)
+                histograms.record('mytask', 'runtime', 1)
+
+                summary = Panel.data['latency'](None)
+            finally:
+                set_metrics_registry(None)
+                registry.stop()
+
+        assert_that(summary, has_entries('mytask', has_key('runtime'),
+                                         'provision_env', has_entries('runtime', has_entries('count', 1))))
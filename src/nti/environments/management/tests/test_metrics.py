@@ -0,0 +1,121 @@
+from hamcrest import assert_that
+from hamcrest import contains_exactly
+from hamcrest import has_length
+from hamcrest import instance_of
+from hamcrest import is_
+from hamcrest import none
+
+from perfmetrics.statsd import StatsdClient
+
+from perfmetrics.testing import FakeStatsDClient
+
+import os
+import unittest
+
+from configparser import ConfigParser
+
+from ..metrics import BufferedStatsdClient
+from ..metrics import parse_sample_rates
+from ..metrics import statsd_client_from_settings
+
+
+class TestBufferedStatsdClient(unittest.TestCase):
+
+    def setUp(self):
+        self.fake = FakeStatsDClient()
+        # Long enough that only we flush
+        self.client = BufferedStatsdClient(self.fake, packet_size=60, flush_interval=60)
+
+    def tearDown(self):
+        self.client.close()
+
+    def test_buffered_until_flushed(self):
+        self.client.incr('celery.task.mytask.prerun')
+        self.client.timing('celery.task.mytask.t', 12)
+        assert_that(self.fake.packets, has_length(0))
+
+        self.client.flush()
+        assert_that(self.fake.packets, contains_exactly('celery.task.mytask.prerun:1|c\n'
+                                                        'celery.task.mytask.t:12|ms'))
+
+    def test_packet_size(self):
+        for _ in range(5):
+            self.client.incr('celery.task.mytask.prerun')
+        self.client.flush()
+
+        # 29 bytes a metric, two to a packet
+        assert_that(self.fake.packets, has_length(3))
+        assert_that([len(packet) for packet in self.fake.packets], contains_exactly(59, 59, 29))
+        assert_that(self.fake.observations, has_length(5))
+
+    def test_flush_interval(self):
+        client = BufferedStatsdClient(self.fake, flush_interval=0.01)
+        try:
+            client.incr('celery.task.mytask.prerun')
+            client._thread.join(0.1)
+            assert_that(self.fake.packets, has_length(1))
+        finally:
+            client.close()
+
+    def test_close_flushes(self):
+        # Keep what was sent when closed
+        self.fake.close = lambda: None
+        self.client.gauge('celery.queue.default.depth', 3)
+        self.client.close()
+        assert_that(self.fake.packets, contains_exactly('celery.queue.default.depth:3|g'))
+
+    def test_sample_rates(self):
+        client = BufferedStatsdClient(self.fake, sample_rates=[('celery.task.*.prerun', 0.5)])
+        self.fake.random = iter([0.9, 0.1]).__next__
+        try:
+            client.incr('celery.task.mytask.prerun')
+            client.incr('celery.task.mytask.prerun')
+            client.incr('celery.task.mytask.postrun')
+            client.flush()
+            assert_that(self.fake.packets, contains_exactly('celery.task.mytask.prerun:1|c|@0.5\n'
+                                                            'celery.task.mytask.postrun:1|c'))
+        finally:
+            client.close()
+
+    def test_fork(self):
+        self.client.incr('celery.task.mytask.prerun')
+        pid = os.fork()
+        if pid == 0: # pragma: no cover
+            # The parent's buffer is the parent's to send
+            os._exit(len(self.client._buf))
+        _, status = os.waitpid(pid, 0)
+        assert_that(os.WEXITSTATUS(status), is_(0))
+        assert_that(self.client._buf, has_length(1))
+
+
+class TestSettings(unittest.TestCase):
+
+    def _settings(self, **statsd):
+        settings = ConfigParser()
+        settings.read_dict({'statsd': statsd})
+        return settings
+
+    def test_not_configured(self):
+        assert_that(statsd_client_from_settings(ConfigParser()), is_(none()))
+
+    def test_unbuffered(self):
+        client = statsd_client_from_settings(self._settings(statsd_uri='statsd://localhost:8125'))
+        try:
+            assert_that(client, instance_of(StatsdClient))
+        finally:
+            client.close()
+
+    def test_buffered(self):
+        client = statsd_client_from_settings(self._settings(statsd_uri='statsd://localhost:8125',
+                                                            packet_size='512',
+                                                            sample_rates='\ncelery.* 0.1'))
+        try:
+            assert_that(client, instance_of(BufferedStatsdClient))
+            assert_that(client.packet_size, is_(512))
+            assert_that(client.sample_rates, contains_exactly(('celery.*', 0.1)))
+        finally:
+            client.close()
+
+    def test_bad_rate(self):
+        with self.assertRaises(ValueError):
+            parse_sample_rates('celery.* 2')
@@ -0,0 +1,232 @@
+from hamcrest import assert_that
+from hamcrest import has_entries
+from hamcrest import has_key
+from hamcrest import has_length
+from hamcrest import is_
+from hamcrest import none
+from hamcrest import same_instance
+
+import fudge
+
+import os
+
+import tempfile
+import time
+import unittest
+
+from configparser import ConfigParser
+
+from zope import component
+from zope import interface
+
+from ..interfaces import ISettings
+
+from ..placement import CapacityPlacementPolicy
+from ..placement import CapacityPublisher
+from ..placement import CapacityReports
+from ..placement import capacity_report
+from ..placement import capacity_reports
+from ..placement import consume_host_queue
+from ..placement import host_queue
+
+from ..timing import hostname
+
+_GB = 1024 ** 3
+
+
+def _report(host, pods=0, load=0.0, cpus=4, memory_free=64 * _GB, disk_free=500 * _GB,
+            reported_at=None):
+    report = {'host': host, 'queue': host_queue(host).name, 'pods': pods, 'load': load,
+              'cpus': cpus, 'memory_free': memory_free, 'disk_free': disk_free}
+    if reported_at is not None:
+        report['reported_at'] = reported_at
+    return report
+
+
+class TestCapacityPlacementPolicy(unittest.TestCase):
+
+    def setUp(self):
+        self.policy = CapacityPlacementPolicy(max_pods=10, min_free_memory=4, min_free_disk=20)
+
+    def test_least_loaded(self):
+        reports = [_report('host1', pods=5, load=1.0),
+                   _report('host2', pods=2, load=3.0),
+                   _report('host3', pods=2, load=1.0)]
+
+        assert_that(self.policy.choose(reports)['host'], is_('host3'))
+
+    def test_ineligible(self):
+        reports = [_report('full', pods=10),
+                   _report('low_memory', memory_free=2 * _GB),
+                   _report('low_disk', disk_free=10 * _GB),
+                   _report('busy', pods=9, load=8.0)]
+
+        assert_that(self.policy.choose(reports)['host'], is_('busy'))
+        assert_that(self.policy.choose(reports[:3]), is_(none()))
+        assert_that(self.policy.choose([]), is_(none()))
+
+
+class _FakeBackend(object):
+
+    def __init__(self):
+        self.results = {}
+        self.reads = 0
+
+    def store_result(self, task_id, result, state):
+        self.results[task_id] = {'status': state, 'result': result}
+
+    def get_task_meta(self, task_id, cache=True):
+        assert_that(cache, is_(False))
+        self.reads += 1
+        return self.results.get(task_id, {'status': 'PENDING', 'result': None})
+
+
+class _FakeApp(object):
+
+    def __init__(self):
+        self.backend = _FakeBackend()
+
+
+class TestCapacityPublisher(unittest.TestCase):
+
+    def test_publish(self):
+        app = _FakeApp()
+        with tempfile.TemporaryDirectory() as root:
+            publisher = CapacityPublisher(app, 60, {'root_dir': root, 'volumes_dir': root})
+            publisher.publish()
+            publisher.publish()
+
+        results = app.backend.results
+        assert_that(results['nti.capacity.hosts']['result'], is_([hostname()]))
+        assert_that(results['nti.capacity.' + hostname()]['result'],
+                    has_entries('host', hostname(), 'pods', 0))
+
+    def test_thread(self):
+        app = _FakeApp()
+        with tempfile.TemporaryDirectory() as root:
+            publisher = CapacityPublisher(app, 60, {'root_dir': root, 'volumes_dir': root})
+            publisher.start()
+            publisher.stop()
+
+        assert_that(app.backend.results, has_key('nti.capacity.' + hostname()))
+
+
+class TestCapacityReports(unittest.TestCase):
+
+    def _publish(self, app, *reports):
+        backend = app.backend
+        for report in reports:
+            report.setdefault('reported_at', time.time())
+            backend.store_result('nti.capacity.' + report['host'], report, 'SUCCESS')
+        backend.store_result('nti.capacity.hosts', [r['host'] for r in reports] + ['gone'], 'SUCCESS')
+
+    def _wait(self, reports):
+        # Let the background read finish
+        thread = reports._refreshing
+        if thread is not None:
+            thread.join()
+
+    def test_cached(self):
+        app = _FakeApp()
+        self._publish(app, _report('host1'), _report('host2'),
+                      _report('stale', reported_at=time.time() - 120))
+        reports = CapacityReports(ttl=60, max_age=30)
+
+        # The first ask doesn't wait for the reports
+        assert_that(reports.reports(app), is_([]))
+        self._wait(reports)
+        assert_that(sorted(r['host'] for r in reports.reports(app)), is_(['host1', 'host2']))
+        reads = app.backend.reads
+        reports.reports(app)
+        assert_that(app.backend.reads, is_(reads))
+
+    def test_refresh(self):
+        app = _FakeApp()
+        self._publish(app, _report('host1'))
+        reports = CapacityReports(ttl=0)
+        reports.reports(app)
+        self._wait(reports)
+
+        self._publish(app, _report('host1'), _report('host2'))
+        assert_that(reports.reports(app), has_length(1))
+        self._wait(reports)
+        assert_that(reports.reports(app), has_length(2))
+        self._wait(reports)
+
+    def test_placed(self):
+        app = _FakeApp()
+        self._publish(app, _report('host1', pods=1))
+        reports = CapacityReports(ttl=60)
+        reports.reports(app)
+        self._wait(reports)
+
+        reports.placed(reports.reports(app)[0])
+
+        assert_that(reports.reports(app)[0]['pods'], is_(2))
+
+    def test_nothing_published(self):
+        app = _FakeApp()
+        reports = CapacityReports(ttl=0)
+        reports.reports(app)
+        self._wait(reports)
+
+        assert_that(reports.reports(app), is_([]))
+        self._wait(reports)
+
+
+class TestCapacityReportsSettings(unittest.TestCase):
+
+    def _register(self, ttl):
+        settings = ConfigParser()
+        settings.read_dict({'placement': {'report_ttl': ttl}})
+        interface.alsoProvides(settings, ISettings)
+        component.getGlobalSiteManager().registerUtility(settings, ISettings)
+        self.addCleanup(component.getGlobalSiteManager().unregisterUtility, settings, ISettings)
+
+    def test_settings_reloaded(self):
+        self._register('5')
+        reports = capacity_reports()
+        assert_that(capacity_reports(), is_(same_instance(reports)))
+        assert_that(reports.ttl, is_(5))
+
+        self._register('20')
+        assert_that(capacity_reports().ttl, is_(20))
+
+
+class TestCapacityReport(unittest.TestCase):
+
+    def test_report(self):
+        with tempfile.TemporaryDirectory() as root:
+            os.mkdir(os.path.join(root, 'S1'))
+            os.mkdir(os.path.join(root, 'S2'))
+            os.mkdir(os.path.join(root, 'logs'))
+
+            report = capacity_report({'root_dir': root, 'volumes_dir': root})
+
+        assert_that(report, has_entries('host', hostname(),
+                                        'queue', 'host.' + hostname(),
+                                        'pods', 2))
+        assert_that(report['disk_free'] > 0, is_(True))
+
+
+class TestHostQueue(unittest.TestCase):
+
+    def _instance(self, consume_from):
+        instance = fudge.Fake('worker')
+        queues = fudge.Fake('queues').has_attr(consume_from=consume_from)
+        instance.has_attr(app=fudge.Fake('app').has_attr(amqp=fudge.Fake('amqp').has_attr(queues=queues)))
+        return instance, queues
+
+    def test_host_worker_consumes_host_queue(self):
+        instance, queues = self._instance({'any_host': None})
+        added = []
+        queues.provides('select_add').calls(added.append)
+
+        consume_host_queue(None, instance)
+
+        assert_that([q.name for q in added], is_(['host.' + hostname()]))
+
+    def test_other_workers_dont(self):
+        instance, queues = self._instance({'tier1': None})
+
+        consume_host_queue(None, instance)
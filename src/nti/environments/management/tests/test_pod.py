@@ -1,24 +1,60 @@
 from hamcrest import assert_that
 from hamcrest import calling
+from hamcrest import contains_string
+from hamcrest import has_entries
 from hamcrest import raises
 from hamcrest import is_
 
+import boto3
+
+from botocore.stub import Stubber
+
+import datetime
+
 import fudge
 
+import json
+
 import os
 
 import subprocess
 
+import sys
+
 import tempfile
 
+import threading
+
+import time
+
 import unittest
 
+from configparser import ConfigParser
+
+from http.server import BaseHTTPRequestHandler
+
+from socketserver import ThreadingUnixStreamServer
+
 from zope import component
 
 from . import SharedConfiguringTestLayer
 
 from ..interfaces import IEnvironmentProvisioner
 
+from ..aws import AWSClientPool
+
+from ..pod import AwaitDataserverStep
+from ..pod import CreateInviteStep
+from ..pod import EnvironmentProvisioner
+from ..pod import PROGRESS_MARKER
+from ..pod import IAMCredentialsStep
+from ..pod import NativeEnvironmentProvisioner
+from ..pod import ProvisioningContext
+from ..pod import ProvisioningStep
+from ..pod import default_provisioning_steps
+from ..pod import render_template
+from ..pod import ses_smtp_password
+from ..pod import wait_for_path
 from ..pod import _pod_root_init_log
 from ..pod import _provisioner_factory
 
@@ -120,3 +156,437 @@ class TestDNS(unittest.TestCase):
         
 
         
+
+
+_SCRIPT = """#!/bin/sh
+echo "starting $1" >&2
+echo "PROGRESS: volumes" >&2
+i=0
+while [ $i -lt 50 ]; do echo "line $i" >&2; i=$((i+1)); done
+echo "PROGRESS: containers" >&2
+echo '{"admin_invitation": "foo", "host_system": "bar"}'
+exit ${EXIT_CODE:-0}
+"""
+
+
+class TestStreamingProvisioner(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.script = os.path.join(self.tmpdir.name, 'init_pod_environment')
+        with open(self.script, 'w') as f:
+            f.write(_SCRIPT)
+        os.chmod(self.script, 0o755)
+        self.logfile = os.path.join(self.tmpdir.name, 'init.log')
+
+    def tearDown(self):
+        os.environ.pop('EXIT_CODE', None)
+        self.tmpdir.cleanup()
+
+    def _provision(self, progress=None):
+        prov = EnvironmentProvisioner(self.script, stream=True, output_tail=5)
+        return prov.provision_environment('S123456', 'foo', 'bar.nextthot.com',
+                                          'Larry Bird', 'larry@nextthought.com',
+                                          progress=progress)
+
+    @fudge.patch('nti.environments.management.pod._pod_root_init_log')
+    def test_stream(self, mock_init_log):
+        mock_init_log.expects_call().with_args('S123456').returns(self.logfile)
+        steps = []
+
+        result = self._provision(steps.append)
+
+        assert_that(result, is_({"admin_invitation": "foo", "host_system": "bar"}))
+        assert_that(steps, is_(['volumes', 'containers']))
+        with open(self.logfile) as f:
+            log = f.read().splitlines()
+        assert_that(log[0], is_('starting S123456'))
+        assert_that(len(log), is_(53))
+
+    @fudge.patch('nti.environments.management.pod._pod_root_init_log')
+    def test_stream_error(self, mock_init_log):
+        mock_init_log.expects_call().with_args('S123456').returns(self.logfile)
+        os.environ['EXIT_CODE'] = '3'
+
+        with self.assertRaises(subprocess.CalledProcessError) as exc:
+            self._provision()
+
+        # Only the tail of the output is held on to
+        assert_that(exc.exception.returncode, is_(3))
+        assert_that(exc.exception.stderr.splitlines(), is_(['line 46', 'line 47', 'line 48', 'line 49',
+                                                            'PROGRESS: containers']))
+        assert_that(os.path.exists(self.logfile), is_(True))
+
+    @fudge.patch('nti.environments.management.pod._pod_root_init_log')
+    def test_init_pod_environment_progress(self, mock_init_log):
+        script = os.path.join(os.path.dirname(__file__), '..', '..', '..', '..', '..', 'bin', 'init_pod_environment')
+        if not os.path.exists(script):
+            self.skipTest('bin/init_pod_environment not available')
+        mock_init_log.expects_call().with_args('S123456').returns(self.logfile)
+
+        # Replay the script's own progress lines between its dated log lines
+        with open(script) as f:
+            markers = [line.strip() for line in f if PROGRESS_MARKER in line]
+        with open(self.script, 'w') as f:
+            f.write('#!/bin/bash\npod=$1\n')
+            for marker in markers:
+                f.write(marker + '\n')
+                f.write('echo "$(date): Initializing $pod environment" 1>&2\n')
+            f.write('echo \'{"host_system": "bar"}\'\n')
+        steps = []
+
+        self._provision(steps.append)
+
+        # Named after the native provisioner's steps, then the start of
+        # an existing environment
+        settings = ConfigParser()
+        settings.read_dict({'pods': {}})
+        native = [step.name for step in default_provisioning_steps(settings['pods'])]
+        assert_that(steps, is_(native + ['start_pod']))
+
+
+class TestWaitForPath(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'run', 'dataserver.sock')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _create_later(self, delay=0.1):
+        def _create():
+            time.sleep(delay)
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            open(self.path, 'w').close()
+        thread = threading.Thread(target=_create)
+        thread.start()
+        return thread
+
+    def test_watched(self):
+        os.makedirs(os.path.dirname(self.path))
+        thread = self._create_later()
+
+        start = time.monotonic()
+        # A long poll interval means we must have been woken by inotify
+        assert_that(wait_for_path(self.path, 5, poll_interval=5), is_(True))
+        assert_that(time.monotonic() - start < 2, is_(True))
+        thread.join()
+
+    def test_polls_missing_directory(self):
+        thread = self._create_later()
+
+        assert_that(wait_for_path(self.path, 5, poll_interval=0.05), is_(True))
+        thread.join()
+
+    def test_timeout(self):
+        os.makedirs(os.path.dirname(self.path))
+
+        assert_that(wait_for_path(self.path, 0.1), is_(False))
+
+
+class TestProvisioningHelpers(unittest.TestCase):
+
+    def test_ses_smtp_password(self):
+        script = os.path.join(os.path.dirname(__file__), '..', '..', '..', '..', '..', 'bin', 'computeSEScreds')
+        if not os.path.exists(script):
+            self.skipTest('bin/computeSEScreds not available')
+        expected = subprocess.run([sys.executable, script, '--region', 'us-east-1', '--secret', 'abc123'],
+                                  check=True, stdout=subprocess.PIPE, encoding='utf-8').stdout.strip()
+
+        assert_that(ses_smtp_password('abc123', 'us-east-1'), is_(expected))
+
+    def test_render_template(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            source = os.path.join(tmpdir, 'pserve.ini.in')
+            target = os.path.join(tmpdir, 'pserve.ini')
+            with open(source, 'w') as f:
+                f.write('site=$SITE_ID\nhost=$SITE_HOSTNAME\nother=$OTHER\n')
+
+            render_template(source, target, {'SITE_ID': 's1', 'SITE_HOSTNAME': 'foo.nextthot.com'})
+
+            with open(target) as f:
+                assert_that(f.read(), is_('site=s1\nhost=foo.nextthot.com\nother=$OTHER\n'))
+
+
+class _RecordingStep(ProvisioningStep):
+
+    def __init__(self, name, calls, only_new=True, failures=0, **kwargs):
+        super(_RecordingStep, self).__init__(**kwargs)
+        self.name = name
+        self.calls = calls
+        self.only_new = only_new
+        self.failures = failures
+
+    def __call__(self, context):
+        self.calls.append(self.name)
+        if self.failures:
+            self.failures -= 1
+            raise ValueError('%s failed' % self.name)
+        context.result[self.name] = True
+
+
+class TestNativeProvisioner(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.root = os.path.join(self.tmpdir.name, 'pods')
+        self.volumes = os.path.join(self.tmpdir.name, 'volumes')
+        os.makedirs(os.path.join(self.root, 'S1', 'logs'))
+        os.makedirs(self.volumes)
+        self.calls = []
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _provision(self, *steps, progress=None):
+        prov = NativeEnvironmentProvisioner(steps, self.root, self.volumes)
+        with fudge.patched_context('nti.environments.management.pod', '_pod_root_init_log',
+                                   lambda site_id: os.path.join(self.root, site_id, 'logs', 'init.log')):
+            return prov.provision_environment('S1', 'Site', 'site.nextthot.com',
+                                              'Larry Bird', 'larry@nextthought.com',
+                                              progress=progress)
+
+    def _log(self):
+        with open(os.path.join(self.root, 'S1', 'logs', 'init.log')) as f:
+            return f.read()
+
+    def test_steps(self):
+        progress = []
+        result = self._provision(_RecordingStep('a', self.calls),
+                                 _RecordingStep('b', self.calls),
+                                 progress=progress.append)
+
+        assert_that(self.calls, is_(['a', 'b']))
+        assert_that(progress, is_(['a', 'b']))
+        assert_that(result, has_entries('a', True, 'b', True, 'host_system', is_(str)))
+        assert_that(self._log(), contains_string('Initializing S1 environment'))
+
+    def test_default_steps(self):
+        settings = ConfigParser()
+        settings.read_dict({'pods': {}})
+        steps = {step.name: step for step in default_provisioning_steps(settings['pods'])}
+
+        # As ordered by bin/init_pod_environment
+        assert_that(steps['mount_volume'].requires, is_(('create_pod', 'allocate_volume')))
+
+    def test_existing_volume(self):
+        open(os.path.join(self.volumes, 'S1.img'), 'w').close()
+
+        self._provision(_RecordingStep('a', self.calls),
+                        _RecordingStep('start', self.calls, only_new=False))
+
+        assert_that(self.calls, is_(['start']))
+
+    def test_retries(self):
+        self._provision(_RecordingStep('a', self.calls, failures=1, tries=2, retry_delay=0))
+
+        assert_that(self.calls, is_(['a', 'a']))
+
+    def test_independent_steps_run_together(self):
+        barrier = threading.Barrier(2, timeout=5)
+
+        class _Meet(_RecordingStep):
+            def __call__(self, context):
+                barrier.wait()
+                super(_Meet, self).__call__(context)
+
+        self._provision(_Meet('iam', self.calls, requires=()),
+                        _Meet('volume', self.calls, requires=()),
+                        _RecordingStep('render', self.calls, requires=('iam', 'volume')),
+                        _RecordingStep('start', self.calls))
+
+        assert_that(sorted(self.calls[:2]), is_(['iam', 'volume']))
+        assert_that(self.calls[2:], is_(['render', 'start']))
+
+    def test_failure_stops_dependents(self):
+        slow_done = threading.Event()
+
+        class _Slow(_RecordingStep):
+            def __call__(self, context):
+                time.sleep(0.1)
+                super(_Slow, self).__call__(context)
+                slow_done.set()
+
+        steps = (_Slow('slow', self.calls, requires=()),
+                 _RecordingStep('fails', self.calls, failures=1, requires=()),
+                 _RecordingStep('after', self.calls, requires=('slow',)))
+
+        assert_that(calling(self._provision).with_args(*steps), raises(ValueError))
+        # The running step finished, but nothing new started
+        assert_that(slow_done.is_set(), is_(True))
+        assert_that(sorted(self.calls), is_(['fails', 'slow']))
+
+    def test_unmet_requirements(self):
+        steps = (_RecordingStep('a', self.calls, requires=('b',)),
+                 _RecordingStep('b', self.calls, requires=('a',)))
+
+        assert_that(calling(self._provision).with_args(*steps), raises(Exception, 'unmet requirements'))
+
+    def test_failure(self):
+        steps = (_RecordingStep('a', self.calls, failures=2, tries=2, retry_delay=0),
+                 _RecordingStep('b', self.calls))
+
+        assert_that(calling(self._provision).with_args(*steps), raises(ValueError))
+        assert_that(self.calls, is_(['a', 'a']))
+        assert_that(self._log(), contains_string('ABORT! a failed. a failed'))
+
+
+class TestIAMCredentialsStep(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.client = boto3.client('iam',
+                                   region_name='us-east-1',
+                                   aws_access_key_id='test',
+                                   aws_secret_access_key='test')
+        self.stubber = Stubber(self.client)
+        self.stubber.activate()
+        self.step = IAMCredentialsStep(self.tmpdir.name, ('arn:aws:iam::123456789012:policy/Test',),
+                                       clients=AWSClientPool(lambda name: self.client))
+        self.context = ProvisioningContext('S1', 'Site', 'site.nextthot.com', 'Larry Bird',
+                                           'larry@nextthought.com',
+                                           os.path.join(self.tmpdir.name, 'S1'),
+                                           os.path.join(self.tmpdir.name, 'S1.img'))
+
+    def tearDown(self):
+        self.stubber.deactivate()
+        self.context.log.close()
+        self.tmpdir.cleanup()
+
+    def test_new_user(self):
+        self.stubber.add_client_error('get_user', 'NoSuchEntity', http_status_code=404,
+                                      expected_params={'UserName': 'S1'})
+        self.stubber.add_response('create_user',
+                                  {'User': {'Path': '/', 'UserName': 'S1', 'UserId': 'AIDA1234567890123456',
+                                            'Arn': 'arn:aws:iam::123456789012:user/S1',
+                                            'CreateDate': datetime.datetime(2020, 1, 1)}},
+                                  {'UserName': 'S1'})
+        self.stubber.add_response('create_access_key',
+                                  {'AccessKey': {'UserName': 'S1', 'AccessKeyId': 'AKIA1234567890123456',
+                                                 'Status': 'Active', 'SecretAccessKey': 'secret',
+                                                 'CreateDate': datetime.datetime(2020, 1, 1)}},
+                                  {'UserName': 'S1'})
+        self.stubber.add_response('attach_user_policy', {},
+                                  {'UserName': 'S1', 'PolicyArn': 'arn:aws:iam::123456789012:policy/Test'})
+
+        self.step(self.context)
+
+        self.stubber.assert_no_pending_responses()
+        assert_that(self.context.access_key_id, is_('AKIA1234567890123456'))
+        assert_that(self.context.secret_access_key, is_('secret'))
+        assert_that(os.stat(os.path.join(self.tmpdir.name, 'S1.json')).st_mode & 0o777, is_(0o600))
+
+    def test_existing_key(self):
+        with open(os.path.join(self.tmpdir.name, 'S1.json'), 'w') as f:
+            json.dump({'AccessKey': {'AccessKeyId': 'AKIA', 'SecretAccessKey': 'secret'}}, f)
+
+        self.step(self.context)
+
+        assert_that(self.context.access_key_id, is_('AKIA'))
+
+
+class _DataserverHandler(BaseHTTPRequestHandler):
+
+    def _respond(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.server.pings:
+            # Still starting
+            status = self.server.pings.pop(0)
+            self.send_response(status)
+            self.send_header('Content-Length', '11')
+            self.end_headers()
+            self.wfile.write(b'Not ready\r\n')
+            return
+        self._respond(200, {})
+
+    def do_POST(self):
+        self.server.posted.append((self.headers['Host'],
+                                   self.headers['Authorization'],
+                                   json.loads(self.rfile.read(int(self.headers['Content-Length'])))))
+        self._respond(201, {'Items': [{'Code': 'code1',
+                                       'Links': [{'rel': 'edit', 'href': '/edit'},
+                                                 {'rel': 'redeem', 'href': '/redeem'}]}]})
+
+    def address_string(self):
+        return 'unix'
+
+    def log_message(self, *args):
+        pass
+
+
+class TestDataserverSteps(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.context = ProvisioningContext('S1', 'Site', 'site.nextthot.com', 'Larry Bird',
+                                           'larry@nextthought.com',
+                                           self.tmpdir.name,
+                                           os.path.join(self.tmpdir.name, 'S1.img'))
+        os.makedirs(os.path.join(self.tmpdir.name, 'dataserver', 'run'))
+        os.makedirs(os.path.join(self.tmpdir.name, 'dataserver', 'data'))
+        with open(os.path.join(self.tmpdir.name, 'dataserver', 'data', '.admin.key'), 'w') as f:
+            f.write('key\n')
+        self.server = None
+
+    def tearDown(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+        self.context.log.close()
+        self.tmpdir.cleanup()
+
+    def _serve(self):
+        self.server = ThreadingUnixStreamServer(os.path.join(self.tmpdir.name, 'dataserver', 'run', 'dataserver.sock'),
+                                                _DataserverHandler)
+        self.server.daemon_threads = True
+        self.server.posted = []
+        self.server.pings = []
+        thread = threading.Thread(target=self.server.serve_forever, args=(0.05,))
+        thread.daemon = True
+        thread.start()
+
+    def test_await_dataserver(self):
+        self._serve()
+
+        AwaitDataserverStep(timeout=1)(self.context)
+
+    def test_await_dataserver_polls(self):
+        self._serve()
+        self.server.pings = [503, 503]
+
+        AwaitDataserverStep(timeout=1, poll_interval=0.01)(self.context)
+        assert_that(self.server.pings, is_([]))
+
+    def test_await_dataserver_never_ready(self):
+        self._serve()
+        self.server.pings = [503] * 1000
+
+        assert_that(calling(AwaitDataserverStep(timeout=0.1, poll_interval=0.01)).with_args(self.context),
+                    raises(Exception, 'returned 503'))
+
+    def test_await_dataserver_timeout(self):
+        assert_that(calling(AwaitDataserverStep(timeout=0.1)).with_args(self.context),
+                    raises(Exception, 'never appeared'))
+
+    @fudge.patch('nti.environments.management.pod.CreateInviteStep._peer_environments')
+    def test_create_invite(self, mock_peers):
+        mock_peers.expects_call().returns(['S1', 'S2'])
+        self._serve()
+
+        CreateInviteStep()(self.context)
+
+        assert_that(self.context.result, is_({'admin_invitation': '/redeem',
+                                              'admin_invitation_code': 'code1',
+                                              'peer_environments': ['S1', 'S2']}))
+        host, auth, body = self.server.posted[0]
+        assert_that(host, is_('s1'))
+        assert_that(auth, is_('Bearer key'))
+        assert_that(body, has_entries('invitations', [{'receiver': 'larry@nextthought.com',
+                                                       'receiver_name': 'Larry Bird'}]))
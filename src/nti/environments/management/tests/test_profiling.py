@@ -0,0 +1,184 @@
+from hamcrest import assert_that
+from hamcrest import contains_string
+from hamcrest import ends_with
+from hamcrest import has_length
+from hamcrest import is_
+from hamcrest import none
+from hamcrest import starts_with
+
+import io
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from configparser import ConfigParser
+
+from contextlib import redirect_stdout
+
+from zope import component
+from zope import interface
+
+from ..celery import task_postrun_handler
+from ..celery import task_prerun_handler
+
+from ..interfaces import ISettings
+
+from ..profiling import CPROFILE
+from ..profiling import SAMPLE
+from ..profiling import TaskProfiler
+from ..profiling import collapse
+from ..profiling import main
+from ..profiling import start_profiling
+from ..profiling import stop_profiling
+
+from .test_celery import MockTask
+
+
+def _busy(seconds):
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        pass
+
+
+class _ProfilerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _profile(self, profiler, task_name='provision_env', task_id='abc'):
+        run = profiler.begin()
+        _busy(0.1)
+        return profiler.save(run, task_name, task_id)
+
+
+class TestTaskProfiler(_ProfilerTestCase):
+
+    def test_rates(self):
+        profiler = TaskProfiler(self.directory, [('provision_env', 0.5), ('*', 1)])
+        profiler.random = iter([0.9, 0.1]).__next__
+        assert_that(profiler.sampled('provision_env'), is_(False))
+        assert_that(profiler.sampled('provision_env'), is_(True))
+        assert_that(profiler.sampled('reload_haproxy'), is_(True))
+
+        profiler = TaskProfiler(self.directory, [('provision_env', 1)])
+        assert_that(profiler.sampled('reload_haproxy'), is_(False))
+
+    def test_sample(self):
+        profiler = TaskProfiler(self.directory, [('*', 1)], mode=SAMPLE, sample_interval=0.005)
+        path = self._profile(profiler)
+
+        assert_that(path, starts_with(os.path.join(self.directory, 'provision_env', '')))
+        with open(path) as f:
+            lines = f.read().splitlines()
+        # Weighted in microseconds, 5000 a sample
+        busy = [line for line in lines if '_busy' in line]
+        assert_that(len(busy) > 0, is_(True))
+        assert_that(busy[0], ends_with('000'))
+
+    def test_cprofile(self):
+        profiler = TaskProfiler(self.directory, [('*', 1)], mode=CPROFILE)
+        path = self._profile(profiler)
+
+        stacks = collapse([path])
+        busy = [(stack, weight) for stack, weight in stacks.items() if stack.endswith(')')
+                and '_busy' in stack.rsplit(';', 1)[-1]]
+        assert_that(busy, has_length(1))
+        assert_that(busy[0][0], starts_with('provision_env;'))
+        # The time is spent in _busy, whatever else the machine is doing
+        heaviest = max(stacks, key=stacks.get)
+        assert_that(heaviest, contains_string('_busy'))
+
+    def test_rotate(self):
+        profiler = TaskProfiler(self.directory, [('*', 1)], keep=2, sample_interval=0.005)
+        paths = []
+        for i in range(3):
+            run = profiler.begin()
+            paths.append(profiler.save(run, 'provision_env', str(i)))
+            time.sleep(0.01)
+        assert_that(sorted(os.listdir(os.path.join(self.directory, 'provision_env'))),
+                    has_length(2))
+        assert_that(os.path.exists(paths[0]), is_(False))
+
+    def test_bad_mode(self):
+        with self.assertRaises(ValueError):
+            TaskProfiler(self.directory, [], mode='perf')
+
+
+class TestCollapse(_ProfilerTestCase):
+
+    def _write(self, task_name, name, text):
+        folder = os.path.join(self.directory, task_name)
+        os.makedirs(folder, exist_ok=True)
+        with open(os.path.join(folder, name), 'w') as f:
+            f.write(text)
+
+    def test_collapse(self):
+        self._write('provision_env', '1-a.collapsed', 'main;provision 10000\nmain;wait 5000\n')
+        self._write('provision_env', '2-b.collapsed', 'main;provision 20000\n')
+        self._write('reload_haproxy', '1-c.collapsed', 'main;reload 100\n')
+
+        stacks = collapse([self.directory])
+        assert_that(stacks['provision_env;main;provision'], is_(30000))
+        assert_that(stacks['reload_haproxy;main;reload'], is_(100))
+
+        stacks = collapse([self.directory], tasks=['reload_haproxy'])
+        assert_that(list(stacks), is_(['reload_haproxy;main;reload']))
+
+    def test_main(self):
+        self._write('provision_env', '1-a.collapsed', 'main;provision 10000\n')
+        out = io.StringIO()
+        with redirect_stdout(out):
+            main([self.directory])
+        assert_that(out.getvalue(), is_('provision_env;main;provision 10000\n'))
+
+
+class TestSignalHandlers(_ProfilerTestCase):
+
+    def setUp(self):
+        super(TestSignalHandlers, self).setUp()
+        self.settings = ConfigParser()
+        self.settings.read_dict({'profiling': {'tasks': 'mytask 1',
+                                               'directory': self.directory,
+                                               'sample_interval': '0.005'}})
+        interface.alsoProvides(self.settings, ISettings)
+        component.getGlobalSiteManager().registerUtility(self.settings, ISettings)
+
+    def tearDown(self):
+        component.getGlobalSiteManager().unregisterUtility(self.settings, ISettings)
+        super(TestSignalHandlers, self).tearDown()
+
+    def test_profiled(self):
+        task = MockTask('mytask')
+        task_prerun_handler(task.id, task)
+        _busy(0.05)
+        task_postrun_handler(task.id, task)
+
+        profiles = os.listdir(os.path.join(self.directory, 'mytask'))
+        assert_that(profiles, has_length(1))
+        assert_that(profiles[0], contains_string(task.id))
+
+    def test_not_profiled(self):
+        assert_that(start_profiling('abc', 'othertask'), is_(False))
+        assert_that(stop_profiling('abc', 'othertask'), is_(none()))
+        assert_that(os.listdir(self.directory), is_([]))
+
+    def test_settings_reloaded(self):
+        assert_that(start_profiling('abc', 'mytask'), is_(True))
+
+        # Swapped for settings profiling nothing, the run still finishes
+        gsm = component.getGlobalSiteManager()
+        gsm.unregisterUtility(self.settings, ISettings)
+        reloaded = ConfigParser()
+        interface.alsoProvides(reloaded, ISettings)
+        gsm.registerUtility(reloaded, ISettings)
+        try:
+            assert_that(stop_profiling('abc', 'mytask'), contains_string('abc'))
+            assert_that(start_profiling('def', 'mytask'), is_(False))
+        finally:
+            gsm.unregisterUtility(reloaded, ISettings)
+            gsm.registerUtility(self.settings, ISettings)
@@ -0,0 +1,236 @@
+from hamcrest import assert_that
+from hamcrest import contains_string
+from hamcrest import is_
+from hamcrest import is_not
+
+import fudge
+
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from configparser import ConfigParser
+
+from urllib.error import HTTPError
+from urllib.request import urlopen
+
+from ..celery import task_postrun_handler
+from ..celery import task_prerun_handler
+from ..celery import task_success_handler
+
+from ..haproxy import HAProxyCommandException
+from ..haproxy import reload_haproxy_cfg
+
+from ..pod import ProvisioningContext
+
+from ..prometheus import CONTENT_TYPE
+from ..prometheus import MetricsRegistry
+from ..prometheus import MetricsServer
+from ..prometheus import metrics_server
+from ..prometheus import set_metrics_registry
+
+from .test_celery import MockTask
+from .test_haproxy import BAD_RELOAD_OUTPUT
+from .test_haproxy import GOOD_RELOAD_OUTPUT
+
+
+class TestMetricsRegistry(unittest.TestCase):
+
+    def test_render(self):
+        registry = MetricsRegistry(buckets=(0.1, 1, float('inf')))
+        registry.inc('nti_celery_tasks_started_total', task='provision_env')
+        registry.inc('nti_celery_tasks_started_total', task='provision_env')
+        registry.add('nti_celery_tasks_in_flight', 1, task='provision_env')
+        registry.observe('nti_celery_task_runtime_seconds', 0.5, task='provision_env')
+        registry.observe('nti_celery_task_runtime_seconds', 5, task='provision_env')
+
+        text = registry.render()
+        assert_that(text, contains_string('# TYPE nti_celery_tasks_started_total counter\n'
+                                          'nti_celery_tasks_started_total{task="provision_env"} 2.0\n'))
+        assert_that(text, contains_string('nti_celery_tasks_in_flight{task="provision_env"} 1.0\n'))
+        assert_that(text, contains_string('# TYPE nti_celery_task_runtime_seconds histogram\n'
+                                          'nti_celery_task_runtime_seconds_bucket{task="provision_env",le="0.1"} 0\n'
+                                          'nti_celery_task_runtime_seconds_bucket{task="provision_env",le="1.0"} 1\n'
+                                          'nti_celery_task_runtime_seconds_bucket{task="provision_env",le="+Inf"} 2\n'
+                                          'nti_celery_task_runtime_seconds_sum{task="provision_env"} 5.5\n'
+                                          'nti_celery_task_runtime_seconds_count{task="provision_env"} 2\n'))
+
+    def test_escaping(self):
+        registry = MetricsRegistry()
+        registry.inc('nti_haproxy_reloads_total', outcome='a "b"\n')
+        assert_that(registry.render(), contains_string('{outcome="a \\"b\\"\\n"}'))
+
+
+class TestMultiprocess(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _write(self, pid, registry):
+        with open(os.path.join(self.directory, '%i.json' % pid), 'w') as f:
+            json.dump(registry.snapshot(), f)
+
+    def _dead_pid(self):
+        pid = os.fork()
+        if pid == 0: # pragma: no cover
+            os._exit(0)
+        os.waitpid(pid, 0)
+        return pid
+
+    def test_collect(self):
+        registry = MetricsRegistry(self.directory)
+
+        alive = MetricsRegistry()
+        alive.inc('nti_celery_tasks_started_total', task='provision_env')
+        alive.add('nti_celery_tasks_in_flight', 1, task='provision_env')
+        alive.observe('nti_celery_task_runtime_seconds', 1, task='provision_env')
+        self._write(os.getppid(), alive)
+
+        exited = MetricsRegistry()
+        exited.inc('nti_celery_tasks_started_total', 2, task='provision_env')
+        exited.add('nti_celery_tasks_in_flight', 1, task='provision_env')
+        exited.observe('nti_celery_task_runtime_seconds', 3, task='provision_env')
+        self._write(self._dead_pid(), exited)
+
+        scalars, histograms = registry.collect()
+        labels = (('task', 'provision_env'),)
+        assert_that(scalars[('nti_celery_tasks_started_total', labels)], is_(3))
+        # The exited process isn't running anything
+        assert_that(scalars[('nti_celery_tasks_in_flight', labels)], is_(1))
+        _, total, count = histograms[('nti_celery_task_runtime_seconds', labels)]
+        assert_that((total, count), is_((4, 2)))
+
+        # The exited process's metrics are kept, without its file
+        assert_that(os.listdir(self.directory), is_(['%i.json' % os.getppid()]))
+        scalars, histograms = registry.collect()
+        assert_that(scalars[('nti_celery_tasks_started_total', labels)], is_(3))
+        assert_that(histograms[('nti_celery_task_runtime_seconds', labels)][2], is_(2))
+
+    def test_pid_reused(self):
+        registry = MetricsRegistry(self.directory)
+        labels = (('task', 'provision_env'),)
+
+        first = MetricsRegistry()
+        first.inc('nti_celery_tasks_started_total', 2, task='provision_env')
+        self._write(os.getppid(), first)
+        scalars, _ = registry.collect()
+        assert_that(scalars[('nti_celery_tasks_started_total', labels)], is_(2))
+
+        # Another process with the same pid overwrites the file
+        time.sleep(0.01)
+        second = MetricsRegistry()
+        second.inc('nti_celery_tasks_started_total', task='provision_env')
+        self._write(os.getppid(), second)
+        scalars, _ = registry.collect()
+        assert_that(scalars[('nti_celery_tasks_started_total', labels)], is_(3))
+
+    def test_write(self):
+        registry = MetricsRegistry(self.directory, write_interval=0.01)
+        registry.inc('nti_celery_tasks_started_total', task='provision_env')
+        registry.stop()
+
+        with open(os.path.join(self.directory, '%i.json' % os.getpid())) as f:
+            snapshot = json.load(f)
+        assert_that(snapshot['counter'], is_([['nti_celery_tasks_started_total',
+                                               [['task', 'provision_env']], 1]]))
+
+    def test_fork(self):
+        registry = MetricsRegistry()
+        registry.inc('nti_celery_tasks_started_total', task='provision_env')
+        pid = os.fork()
+        if pid == 0: # pragma: no cover
+            # The child starts from nothing
+            os._exit(len(registry.snapshot()['counter']))
+        _, status = os.waitpid(pid, 0)
+        assert_that(os.WEXITSTATUS(status), is_(0))
+
+
+class TestMetricsServer(unittest.TestCase):
+
+    def test_default_directory(self):
+        settings = ConfigParser()
+        settings.read_dict({'monitoring': {'metrics_port': '9100'}})
+        try:
+            server = metrics_server(settings)
+            directory = server.registry.directory
+            assert_that(os.path.isdir(directory), is_(True))
+            assert_that(directory, contains_string(str(os.getpid())))
+        finally:
+            set_metrics_registry(None)
+        os.rmdir(directory)
+
+    def test_serve(self):
+        registry = MetricsRegistry()
+        registry.inc('nti_haproxy_reloads_total', outcome='success')
+        server = MetricsServer(registry, 0, address='127.0.0.1')
+        server.start()
+        try:
+            url = 'http://127.0.0.1:%i' % server.port
+            with urlopen(url + '/metrics') as response:
+                assert_that(response.headers['Content-Type'], is_(CONTENT_TYPE))
+                assert_that(response.read().decode('utf-8'),
+                            contains_string('nti_haproxy_reloads_total{outcome="success"} 1.0'))
+
+            with self.assertRaises(HTTPError) as exc:
+                urlopen(url + '/')
+            assert_that(exc.exception.code, is_(404))
+        finally:
+            server.stop()
+
+
+class TestInstrumentation(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = MetricsRegistry()
+        set_metrics_registry(self.registry)
+
+    def tearDown(self):
+        set_metrics_registry(None)
+
+    def test_tasks(self):
+        task = MockTask('provision_env')
+        task_prerun_handler(task.id, task)
+        assert_that(self.registry.render(),
+                    contains_string('nti_celery_tasks_in_flight{task="provision_env"} 1.0'))
+
+        task_success_handler(task)
+        task_postrun_handler(task.id, task)
+        text = self.registry.render()
+        assert_that(text, contains_string('nti_celery_tasks_in_flight{task="provision_env"} 0.0'))
+        assert_that(text, contains_string('nti_celery_tasks_started_total{task="provision_env"} 1.0'))
+        assert_that(text, contains_string(
+            'nti_celery_tasks_finished_total{outcome="success",task="provision_env"} 1.0'))
+        assert_that(text, contains_string('nti_celery_task_runtime_seconds_count{task="provision_env"} 1'))
+
+    @fudge.patch('nti.environments.management.haproxy.send_command')
+    def test_haproxy_reloads(self, mock_send_command):
+        mock_send_command.is_callable().with_args('', 'reload')
+        mock_send_command.next_call().with_args('', 'show proc').returns(GOOD_RELOAD_OUTPUT)
+        mock_send_command.next_call().with_args('', 'reload')
+        mock_send_command.next_call().with_args('', 'show proc').returns(BAD_RELOAD_OUTPUT)
+
+        reload_haproxy_cfg('')
+        with self.assertRaises(HAProxyCommandException):
+            reload_haproxy_cfg('')
+
+        text = self.registry.render()
+        assert_that(text, contains_string('nti_haproxy_reloads_total{outcome="success"} 1.0'))
+        assert_that(text, contains_string('nti_haproxy_reloads_total{outcome="failure"} 1.0'))
+
+    def test_provisioning_commands(self):
+        context = ProvisioningContext('S1', 'Site', 'site.nextthot.com', 'Larry Bird',
+                                      'larry@nextthought.com', '/tmp/S1', '/tmp/S1.xfs')
+        context.run('/bin/true')
+        context.run('/bin/true', name='start_pod_environment')
+
+        text = self.registry.render()
+        assert_that(text, contains_string('nti_provisioning_subprocess_seconds_count{command="true"} 1'))
+        assert_that(text, contains_string(
+            'nti_provisioning_subprocess_seconds_count{command="start_pod_environment"} 1'))
+        assert_that(text, is_not(contains_string('bin')))
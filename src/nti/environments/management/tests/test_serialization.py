@@ -0,0 +1,87 @@
+from hamcrest import assert_that
+from hamcrest import calling
+from hamcrest import has_entries
+from hamcrest import has_properties
+from hamcrest import is_
+from hamcrest import raises
+
+import datetime
+import unittest
+
+from kombu.serialization import dumps as kombu_dumps
+from kombu.serialization import loads as kombu_loads
+
+import msgpack
+
+from ..celery import configure_celery
+
+from ..serialization import CONTENT_TYPE
+from ..serialization import EXT_SITE_INFO
+from ..serialization import SERIALIZER
+from ..serialization import dumps
+from ..serialization import loads
+
+from ..tasks import SiteInfo
+
+
+def _site_info():
+    info = SiteInfo('S1234', 'foo.nextthot.com')
+    info.start_time = datetime.datetime(2020, 1, 1, 12, 30, 15, 250)
+    info.task_result_dict = {'host_system': 'host1',
+                             'admin_invitation': '/invite',
+                             'peer_environments': ['S1', 'S2']}
+    info.reload_task = (('abc', None), None)
+    info.phase_timings = {'dns': 0.25, 'provision': 30.5}
+    info.verify_attempts = (1.5, 2.0)
+    return info
+
+
+class TestSerialization(unittest.TestCase):
+
+    def test_site_info(self):
+        info = loads(dumps([_site_info(), {'timings': {'phases': {}}}]))[0]
+
+        assert_that(info, is_(SiteInfo))
+        assert_that(info, has_properties('site_id', 'S1234',
+                                         'dns_name', 'foo.nextthot.com',
+                                         'start_time', datetime.datetime(2020, 1, 1, 12, 30, 15, 250),
+                                         'end_time', None,
+                                         'host', 'host1',
+                                         'phase_timings', {'dns': 0.25, 'provision': 30.5}))
+        assert_that(info.peer_environments, is_(['S1', 'S2']))
+        assert_that(list(info.verify_attempts), is_([1.5, 2.0]))
+        # Decoded as lists, which result_from_tuple is happy with
+        assert_that(info.reload_task, is_([['abc', None], None]))
+
+    def test_datetime(self):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        assert_that(loads(dumps({'now': now})), is_({'now': now}))
+
+    def test_readable_without_codec(self):
+        raw = msgpack.unpackb(dumps({'site': _site_info()}), raw=False)
+        ext = raw['site']
+        assert_that(ext.code, is_(EXT_SITE_INFO))
+        assert_that(msgpack.unpackb(ext.data, raw=False),
+                    has_entries('site_id', 'S1234', 'dns_name', 'foo.nextthot.com'))
+
+    def test_unknown_type(self):
+        assert_that(calling(dumps).with_args({'obj': object()}), raises(TypeError))
+
+    def test_registered(self):
+        content_type, encoding, data = kombu_dumps((('S1',), {}, {}), serializer=SERIALIZER)
+        assert_that(content_type, is_(CONTENT_TYPE))
+        assert_that(kombu_loads(data, content_type, encoding, accept=[CONTENT_TYPE]),
+                    is_([['S1'], {}, {}]))
+
+    def test_configure(self):
+        settings = {'celery.broker_url': 'memory://',
+                    'celery.backend_url': 'cache+memory://'}
+        app = configure_celery(settings=settings)
+        assert_that(app.conf, has_properties('task_serializer', 'pickle',
+                                             'result_serializer', 'pickle'))
+
+        settings['celery.serializer'] = SERIALIZER
+        app = configure_celery(settings=settings)
+        assert_that(app.conf, has_properties('task_serializer', SERIALIZER,
+                                             'result_serializer', SERIALIZER))
+        assert_that(SERIALIZER in app.conf.accept_content, is_(True))
@@ -1,23 +1,81 @@
 from hamcrest import is_
 from hamcrest import raises
+from hamcrest import close_to
+from hamcrest import has_length
+from hamcrest import has_entries
 from hamcrest import calling
 from hamcrest import assert_that
 
+from celery.exceptions import MaxRetriesExceededError
+
 import fudge
 
 from requests.exceptions import HTTPError
 from requests.exceptions import ConnectionError
 
+import datetime
+import json
+import os
+import shutil
+import tempfile
+import threading
 import unittest
 
+from http.server import BaseHTTPRequestHandler
+
+from socketserver import ThreadingUnixStreamServer
+
 from . import SharedConfiguringTestLayer
 
+from ..celery import configure_celery
+
 from ..tasks import SiteInfo
+from ..tasks import SetupEnvironmentTask
+from ..tasks import await_setup_reload
+from ..tasks import join_setup_environment_task
+from ..tasks import verify_setup_site
 from ..tasks import _do_verify_site
+from ..tasks import verify_site_socket
 from ..tasks import SiteVerificationTimeout
 from ..tasks import SiteVerificationException
 
 
+class MockResponse(object):
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+class _PingHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        status, pong = self.server.respond(self)
+        body = json.dumps(pong).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        return 'unix'
+
+    def log_message(self, *args):
+        pass
+
+
+class _UnixPingServer(ThreadingUnixStreamServer):
+
+    daemon_threads = True
+
+    def __init__(self, path, responses):
+        ThreadingUnixStreamServer.__init__(self, path, _PingHandler)
+        self.responses = list(responses)
+        self.hosts = []
+
+    def respond(self, request):
+        self.hosts.append(request.headers['Host'])
+        return self.responses.pop(0) if len(self.responses) > 1 else self.responses[0]
+
+
 class TestTasks(unittest.TestCase):
 
     layer = SharedConfiguringTestLayer
@@ -44,10 +102,6 @@ class TestTasks(unittest.TestCase):
         fake_ping.next_call().returns(object())
         assert_that(call_verify(), is_(True))
 
-        class MockResponse(object):
-            def __init__(self, status_code):
-                self.status_code = status_code
-
         cannot_connect_response = MockResponse(503)
         not_found_response = MockResponse(404)
         unknown_response = MockResponse(500)
@@ -66,3 +120,172 @@ class TestTasks(unittest.TestCase):
         fake_ping.next_call().raises(http_error3)
         assert_that(calling(call_verify),
                     raises(SiteVerificationException))
+
+
+class TestSetupPipeline(unittest.TestCase):
+
+    def setUp(self):
+        self.app = configure_celery(settings={'celery.broker_url': 'memory://',
+                                              'celery.backend_url': 'cache+memory://'})
+        self.app.conf.task_always_eager = True
+        SetupEnvironmentTask.bind(self.app)
+        self.app.finalize()
+
+        self.site_info = SiteInfo(site_id='S1234', dns_name='dns.name')
+
+    def _step(self, step, *args, **kwargs):
+        return self.app.tasks[step.__name__].apply(args=(self.site_info,) + args, kwargs=kwargs)
+
+    @fudge.patch('nti.environments.management.tasks._do_ping_site')
+    def test_verify_step_retries(self, mock_ping):
+        fake_ping = mock_ping.is_callable()
+        fake_ping.raises(ConnectionError())
+        fake_ping.next_call().raises(HTTPError(response=MockResponse(503)))
+        fake_ping.next_call().returns({'Site': 's1234'})
+
+        result = self._step(verify_setup_site, wait=0)
+
+        assert_that(result.get(), is_(self.site_info))
+        assert_that(self.site_info.ds_site_id, is_('s1234'))
+
+    @fudge.patch('nti.environments.management.tasks._do_ping_site')
+    def test_verify_step_gives_up(self, mock_ping):
+        mock_ping.is_callable().raises(ConnectionError())
+
+        result = self._step(verify_setup_site, wait=0, tries=3)
+
+        assert_that(calling(result.get), raises(SiteVerificationException))
+
+    @fudge.patch('nti.environments.management.tasks._do_ping_site')
+    def test_verify_step_fatal(self, mock_ping):
+        mock_ping.is_callable().raises(HTTPError(response=MockResponse(500)))
+
+        result = self._step(verify_setup_site, wait=0)
+
+        assert_that(calling(result.get), raises(SiteVerificationException))
+
+    @fudge.patch('nti.environments.management.tasks._do_ping_site')
+    def test_verify_step_staged(self, mock_ping):
+        """
+        A site verified on the host only gets one public probe, and that
+        probe failing because dns isn't there yet doesn't fail the setup.
+        """
+        mock_ping.expects_call().times_called(1).raises(ConnectionError())
+        self.site_info.task_result_dict = {'socket_verified': True, 'ds_site_id': 's1234'}
+
+        assert_that(self._step(verify_setup_site).get(), is_(self.site_info))
+        assert_that(self.site_info.ds_site_id, is_('s1234'))
+        assert_that(self.site_info.public_verified, is_(False))
+
+    @fudge.patch('nti.environments.management.tasks._do_ping_site')
+    def test_verify_step_staged_fatal(self, mock_ping):
+        mock_ping.expects_call().raises(HTTPError(response=MockResponse(500)))
+        self.site_info.task_result_dict = {'socket_verified': True, 'ds_site_id': 's1234'}
+
+        result = self._step(verify_setup_site)
+
+        assert_that(calling(result.get), raises(SiteVerificationException))
+
+    @fudge.patch('nti.environments.management.tasks._do_ping_site')
+    def test_verify_step_times_attempts(self, mock_ping):
+        fake_ping = mock_ping.is_callable()
+        fake_ping.raises(ConnectionError())
+        fake_ping.next_call().returns({'Site': 's1234'})
+
+        site_info = self._step(verify_setup_site, wait=0).get()
+
+        assert_that(site_info.verify_attempts, has_length(2))
+        assert_that(site_info.phase_timings['verify'], is_(sum(site_info.verify_attempts)))
+
+    def test_join_merges_timings(self):
+        self.site_info.start_time = datetime.datetime.utcnow()
+        started_at = self.site_info.start_timestamp
+        group_result = [{'timings': {'host': 'dns1', 'started_at': started_at + 1,
+                                     'phases': {'dns_change': 0.5}}},
+                        {'live': True,
+                         'timings': {'host': 'tier1', 'started_at': started_at + 12,
+                                     'phases': {'backend_write': 0.25}}},
+                        {'host_system': 'host1',
+                         'timings': {'host': 'host1', 'started_at': started_at - 1,
+                                     'phases': {'provision': 60}}}]
+
+        join = self.app.tasks[join_setup_environment_task.__name__]
+        site_info = join.apply(args=(group_result, self.site_info)).get()
+
+        assert_that(site_info.phase_timings, has_entries('dns_change', 0.5,
+                                                          'backend_write', 0.25,
+                                                          'provision', 60,
+                                                          'queue_wait.dns', close_to(1, 0.001),
+                                                          'queue_wait.haproxy', close_to(2, 0.001),
+                                                          'queue_wait.provision', 0))
+
+    def test_join_skips_reload_after_backend_reloaded(self):
+        group_result = [{}, {'live': False, 'reloaded': True}, {'host_system': 'host1'}]
+
+        join = self.app.tasks[join_setup_environment_task.__name__]
+        site_info = join.apply(args=(group_result, self.site_info)).get()
+
+        assert_that(site_info.reload_task, is_(None))
+
+    def test_await_reload(self):
+        self.app.backend.mark_as_done('reload-id', {'timings': {'host': 'tier1',
+                                                                'started_at': 101,
+                                                                'phases': {'reload': 2}}})
+        self.site_info.reload_task = (('reload-id', None), None)
+        self.site_info.reload_requested_at = 100
+
+        assert_that(self._step(await_setup_reload).get(), is_(self.site_info))
+        assert_that(self.site_info.phase_timings, is_({'reload': 2, 'queue_wait.reload': 1}))
+
+    def test_await_reload_times_out(self):
+        self.site_info.reload_task = (('pending-id', None), None)
+
+        result = self._step(await_setup_reload, poll_interval=0.01, timeout=0.05)
+
+        assert_that(calling(result.get), raises(MaxRetriesExceededError))
+
+
+class TestSocketVerification(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.tmpdir, 'dataserver.sock')
+        self.site_info = SiteInfo(site_id='S1234', dns_name='dns.name')
+        self.server = None
+
+    def tearDown(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+        shutil.rmtree(self.tmpdir)
+
+    def _serve(self, *responses):
+        self.server = _UnixPingServer(self.socket_path, responses)
+        thread = threading.Thread(target=self.server.serve_forever, args=(0.05,))
+        thread.daemon = True
+        thread.start()
+        return self.server
+
+    def test_verify_socket(self):
+        server = self._serve((503, {}), (200, {'Site': 's1234'}))
+
+        assert_that(verify_site_socket(self.site_info, self.socket_path, wait=0), is_(True))
+        assert_that(self.site_info.ds_site_id, is_('s1234'))
+        assert_that(server.hosts, is_(['dns.name', 'dns.name']))
+
+    def test_verify_socket_not_listening(self):
+        assert_that(calling(verify_site_socket).with_args(self.site_info, self.socket_path,
+                                                          wait=0, tries=2),
+                    raises(SiteVerificationException, 'Unable to ping'))
+
+    def test_verify_socket_wrong_site(self):
+        self._serve((200, {'Site': 'other'}))
+
+        assert_that(calling(verify_site_socket).with_args(self.site_info, self.socket_path, wait=0),
+                    raises(SiteVerificationException, 'Expected site S1234'))
+
+    def test_verify_socket_fatal(self):
+        self._serve((500, {}))
+
+        assert_that(calling(verify_site_socket).with_args(self.site_info, self.socket_path, wait=0),
+                    raises(SiteVerificationException))
@@ -0,0 +1,57 @@
+from hamcrest import assert_that
+from hamcrest import contains_exactly
+from hamcrest import greater_than
+from hamcrest import has_entries
+from hamcrest import has_item
+from hamcrest import has_length
+from hamcrest import is_
+
+from perfmetrics import set_statsd_client
+
+from perfmetrics.testing import FakeStatsDClient
+
+from perfmetrics.testing.matchers import is_timer
+
+import unittest
+
+from ..timing import PhaseTimer
+
+
+class TestPhaseTimer(unittest.TestCase):
+
+    def setUp(self):
+        self.statsd = FakeStatsDClient()
+        set_statsd_client(self.statsd)
+
+    def tearDown(self):
+        set_statsd_client(None)
+
+    def test_phase(self):
+        timer = PhaseTimer(host='host1.nextthought.com')
+        with timer.phase('provision'):
+            pass
+
+        assert_that(timer.as_dict(), has_entries('host', 'host1.nextthought.com',
+                                                 'started_at', greater_than(0),
+                                                 'phases', has_entries('provision', greater_than(0))))
+        assert_that(self.statsd, has_item(is_timer('environments.setup.phase.provision.host1_nextthought_com')))
+
+    def test_failed_phase_not_recorded(self):
+        timer = PhaseTimer(host='host1')
+
+        def _fail():
+            with timer.phase('provision'):
+                raise ValueError()
+
+        self.assertRaises(ValueError, _fail)
+        assert_that(timer.timings, is_({}))
+        assert_that(self.statsd, has_length(0))
+
+    def test_repeated_phase(self):
+        timer = PhaseTimer(host='host1')
+        timer.record('verify', 1)
+        timer.record('verify', 2)
+
+        assert_that(timer.timings, is_({'verify': 3}))
+        assert_that(self.statsd.observations, contains_exactly(is_timer('environments.setup.phase.verify.host1', '1000'),
+                                                               is_timer('environments.setup.phase.verify.host1', '2000')))
@@ -0,0 +1,160 @@
+from hamcrest import assert_that
+from hamcrest import contains_exactly
+from hamcrest import has_entries
+from hamcrest import instance_of
+from hamcrest import is_
+
+import asyncio
+
+import threading
+
+import unittest
+
+from aiohttp import web
+
+from ..celery import configure_celery
+
+from ..tasks import SiteInfo
+from ..tasks import SiteVerificationException
+
+from ..verification import AsyncSiteVerifier
+from ..verification import VerifySitesTask
+
+
+class _StubSites(object):
+    """
+    A local http server answering pings for a handful of fake sites,
+    each of which behaves differently.
+    """
+
+    def __init__(self):
+        self.requests = {}
+        self.loop = asyncio.new_event_loop()
+        self.started = threading.Event()
+
+    async def _ping(self, request):
+        site = request.match_info['site']
+        count = self.requests[site] = self.requests.get(site, 0) + 1
+        if site == 'slow' and count < 3:
+            return web.Response(status=503)
+        if site == 'missing':
+            return web.Response(status=404)
+        if site == 'broken':
+            return web.Response(status=500)
+        if site == 'mismatch':
+            return web.json_response({'Site': 'someothersite'})
+        if site == 'starting' and count < 2:
+            return web.Response(text='<html>Bad Gateway</html>', content_type='text/html')
+        if site == 'proxy':
+            return web.Response(text='<html>Bad Gateway</html>', content_type='text/html')
+        if site == 'truncated':
+            resp = web.StreamResponse(headers={'Content-Length': '100'})
+            await resp.prepare(request)
+            await resp.write(b'{"Site": ')
+            request.transport.close()
+            return resp
+        return web.json_response({'Site': site})
+
+    async def _start(self):
+        app = web.Application()
+        app.router.add_get('/{site}/dataserver2/logon.ping', self._ping)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        self.started.set()
+
+    def start(self):
+        def _run():
+            asyncio.set_event_loop(self.loop)
+            self.loop.run_until_complete(self._start())
+            self.loop.run_forever()
+        self.thread = threading.Thread(target=_run, daemon=True)
+        self.thread.start()
+        self.started.wait()
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self.runner.cleanup(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    @property
+    def url(self):
+        return _StubURL(self.port)
+
+
+class _StubURL(object):
+    """
+    Builds ping urls for the stub server. Picklable, so it can
+    be passed to celery tasks.
+    """
+
+    def __init__(self, port):
+        self.port = port
+
+    def __call__(self, site_info):
+        return 'http://127.0.0.1:%i/%s/dataserver2/logon.ping' % (self.port, site_info.site_id)
+
+
+class TestAsyncSiteVerifier(unittest.TestCase):
+
+    def setUp(self):
+        self.stub = _StubSites()
+        self.stub.start()
+        self.verifier = AsyncSiteVerifier(tries=4, base_delay=0.01, max_delay=0.05,
+                                          url_factory=self.stub.url)
+
+    def tearDown(self):
+        self.stub.stop()
+
+    def _sites(self, *site_ids):
+        return [SiteInfo(site_id, '%s.nextthot.com' % site_id) for site_id in site_ids]
+
+    def test_verify_many(self):
+        sites = self._sites('ok', 'slow', 'missing', 'broken', 'mismatch')
+        results = self.verifier.verify_sites(sites)
+
+        assert_that(results[0], is_(True))
+        assert_that(results[1], is_(True))
+        assert_that(results[2], instance_of(SiteVerificationException))
+        assert_that(results[3], instance_of(SiteVerificationException))
+        assert_that(results[4], instance_of(SiteVerificationException))
+
+        assert_that(sites[0].ds_site_id, is_('ok'))
+        assert_that(sites[1].ds_site_id, is_('slow'))
+
+        # 404s and 503s are retried, other errors are not
+        assert_that(self.stub.requests, is_({'ok': 1, 'slow': 3, 'missing': 4,
+                                             'broken': 1, 'mismatch': 1}))
+
+    def test_unreadable_response(self):
+        sites = self._sites('ok', 'starting', 'proxy', 'truncated')
+        results = self.verifier.verify_sites(sites)
+
+        # Retried, and only fail their own site
+        assert_that(results[0], is_(True))
+        assert_that(results[1], is_(True))
+        assert_that(results[2], instance_of(SiteVerificationException))
+        assert_that(results[3], instance_of(SiteVerificationException))
+        assert_that(self.stub.requests, has_entries('starting', 2, 'proxy', 4, 'truncated', 4))
+
+    def test_unreachable(self):
+        verifier = AsyncSiteVerifier(tries=2, base_delay=0.01,
+                                     url_factory=lambda info: 'http://127.0.0.1:1/')
+        results = verifier.verify_sites(self._sites('ok'))
+        assert_that(results[0], instance_of(SiteVerificationException))
+
+    def test_celery_task(self):
+        app = configure_celery(settings={'celery.broker_url': 'memory://',
+                                         'celery.backend_url': 'cache+memory://'})
+        app.conf.task_always_eager = True
+        VerifySitesTask.bind(app)
+        app.finalize()
+
+        sites = self._sites('ok', 'broken')
+        result = VerifySitesTask(app)(sites, url_factory=self.stub.url, tries=2)
+
+        assert_that(result.get(), contains_exactly(has_entries(site_id='ok', verified=True, ds_site_id='ok'),
+                                                   has_entries(site_id='broken', verified=False)))
@@ -0,0 +1,142 @@
+from hamcrest import assert_that
+from hamcrest import has_item
+from hamcrest import has_length
+from hamcrest import is_
+
+from perfmetrics import set_statsd_client
+
+from perfmetrics.testing import FakeStatsDClient
+
+from perfmetrics.testing.matchers import is_gauge
+
+import fcntl
+
+import os
+
+import tempfile
+
+import unittest
+
+from zope import component
+
+from . import SharedConfiguringTestLayer
+
+from ..interfaces import IVolumePool
+
+from ..pod import AllocateVolumeStep
+from ..pod import ProvisioningContext
+
+from ..timing import hostname
+from ..timing import _metric_safe
+
+from ..volumes import WarmVolumePool
+
+
+class _FakeVolumePool(WarmVolumePool):
+
+    def __init__(self, *args, **kwargs):
+        super(_FakeVolumePool, self).__init__(*args, **kwargs)
+        self.built = []
+
+    def _format(self, path):
+        pass
+
+    def _seed(self, path):
+        self.built.append(path)
+        with open(path, 'r+') as f:
+            f.write('seeded')
+
+
+class TestWarmVolumePool(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.pool_dir = os.path.join(self.tmpdir.name, 'pool')
+        self.pool = _FakeVolumePool(self.pool_dir, 3, low_watermark=2, volume_size=1)
+        self.statsd = FakeStatsDClient()
+        set_statsd_client(self.statsd)
+
+    def tearDown(self):
+        set_statsd_client(None)
+        self.tmpdir.cleanup()
+
+    def test_refill(self):
+        assert_that(self.pool.depth(), is_(0))
+        assert_that(self.pool.needs_refill(), is_(True))
+
+        assert_that(self.pool.refill(), is_(3))
+
+        assert_that(self.pool.depth(), is_(3))
+        assert_that(self.pool.needs_refill(), is_(False))
+        assert_that(self.pool.refill(), is_(0))
+        # Only the finished volumes are left in the pool
+        assert_that(sorted(os.listdir(self.pool_dir)),
+                    is_(['.refill.lock'] + sorted(os.path.basename(p).replace('.building-', 'ready-')
+                                                  for p in self.pool.built)))
+        assert_that(self.statsd, has_item(is_gauge('environments.volume_pool.depth.%s' % _metric_safe(hostname()),
+                                                   '3')))
+
+    def test_claim(self):
+        self.pool.refill()
+        target = os.path.join(self.tmpdir.name, 'S1.img')
+
+        assert_that(self.pool.claim(target), is_(True))
+
+        assert_that(self.pool.depth(), is_(2))
+        assert_that(self.pool.needs_refill(), is_(False))
+        with open(target) as f:
+            assert_that(f.read(6), is_('seeded'))
+
+        self.pool.claim(os.path.join(self.tmpdir.name, 'S2.img'))
+        assert_that(self.pool.needs_refill(), is_(True))
+
+    def test_claim_empty(self):
+        assert_that(self.pool.claim(os.path.join(self.tmpdir.name, 'S1.img')), is_(False))
+
+    def test_claim_race(self):
+        self.pool.refill()
+        first = os.path.join(self.pool_dir, self.pool._ready()[0])
+        os.unlink(first)
+
+        # The listing is stale, the next volume is claimed
+        self.pool._ready = lambda: [os.path.basename(first)] + WarmVolumePool._ready(self.pool)
+        assert_that(self.pool.claim(os.path.join(self.tmpdir.name, 'S1.img')), is_(True))
+        assert_that(WarmVolumePool._ready(self.pool), has_length(1))
+
+    def test_failed_build_cleaned_up(self):
+        def _fail(path):
+            raise OSError('mkfs failed')
+        self.pool._format = _fail
+
+        self.assertRaises(OSError, self.pool.refill)
+        assert_that(os.listdir(self.pool_dir), is_(['.refill.lock']))
+
+    def test_concurrent_refill(self):
+        os.makedirs(self.pool_dir)
+        with open(os.path.join(self.pool_dir, '.refill.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            assert_that(self.pool.refill(), is_(0))
+
+    def test_allocate_step_claims(self):
+        self.pool.refill()
+        context = ProvisioningContext('S1', 'Site', 'site.nextthot.com', 'Larry Bird', 'larry@nextthought.com',
+                                      os.path.join(self.tmpdir.name, 'S1'),
+                                      os.path.join(self.tmpdir.name, 'S1.img'))
+        try:
+            AllocateVolumeStep(pool=self.pool)(context)
+        finally:
+            context.log.close()
+
+        assert_that(context.seeded, is_(True))
+        assert_that(os.path.exists(context.volume), is_(True))
+
+
+class TestVolumePoolConfiguration(unittest.TestCase):
+
+    layer = SharedConfiguringTestLayer
+
+    def test_disabled_by_default(self):
+        pool = component.getUtility(IVolumePool)
+
+        assert_that(pool.size, is_(0))
+        assert_that(pool.needs_refill(), is_(False))
@@ -0,0 +1,50 @@
+from hamcrest import assert_that
+from hamcrest import is_
+from hamcrest import same_instance
+
+import fudge
+
+import unittest
+
+from configparser import ConfigParser
+
+from .. import worker
+
+_SETTINGS = ConfigParser()
+_SETTINGS.read_dict({'celery': {'celery.broker_url': 'memory://',
+                                'celery.backend_url': 'cache+memory://'}})
+
+
+class TestWorker(unittest.TestCase):
+
+    def setUp(self):
+        worker._app = None
+
+    def tearDown(self):
+        worker._app = None
+
+    @fudge.patch('nti.environments.management.worker.configure_worker')
+    def test_configured_once(self, mock_configure):
+        mock_configure.expects_call().returns(_SETTINGS).times_called(1)
+
+        app = worker.get_app()
+        assert_that(app.finalized, is_(True))
+        assert_that(worker.get_app(), same_instance(app))
+        assert_that(worker.app, same_instance(app))
+
+    def test_no_other_attributes(self):
+        with self.assertRaises(AttributeError):
+            getattr(worker, 'celery')
+
+    @fudge.patch('nti.environments.management.worker.configure_worker')
+    def test_lock_held_across_fork(self, mock_configure):
+        mock_configure.expects_call().returns(_SETTINGS)
+
+        # As if another thread was configuring when we forked
+        held = worker._lock
+        held.acquire()
+        try:
+            worker._reset_lock()
+            assert_that(worker.get_app().finalized, is_(True))
+        finally:
+            held.release()
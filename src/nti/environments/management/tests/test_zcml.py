@@ -0,0 +1,81 @@
+from hamcrest import assert_that
+from hamcrest import contains_inanyorder
+from hamcrest import has_entries
+from hamcrest import has_item
+from hamcrest import has_length
+from hamcrest import is_
+from hamcrest import is_not
+
+import unittest
+
+from zope import component
+
+from . import SharedConfiguringTestLayer
+
+from ..celery import _bindable_tasks
+from ..celery import configure_celery
+
+from ..dns import MockAddDNSMappingTask
+
+from ..haproxy import MockHAProxyReload
+from ..haproxy import MockRemoveHAProxyBackend
+from ..haproxy import MockSetupHAProxyBackend
+
+from ..interfaces import IApplicationTask
+from ..interfaces import ICeleryApp
+from ..interfaces import IDNSMappingTask
+
+from ..pod import MockProvisionEnvironmentTask
+
+from ..tasks import SetupEnvironmentTask
+
+from ..verification import VerifySitesTask
+
+from ..zcml import _task_factories
+from ..zcml import record_adapter_tasks
+
+from ..volumes import RefillVolumePoolTask
+
+
+class _PlainAdapterTask(object):
+
+    @classmethod
+    def bind(cls, app):
+        pass
+
+
+class TestTaskDirective(unittest.TestCase):
+
+    layer = SharedConfiguringTestLayer
+
+    def test_tasks_recorded(self):
+        # The test layer configures in devmode
+        assert_that(_bindable_tasks(), contains_inanyorder(MockAddDNSMappingTask,
+                                                           MockSetupHAProxyBackend,
+                                                           MockHAProxyReload,
+                                                           MockRemoveHAProxyBackend,
+                                                           MockProvisionEnvironmentTask,
+                                                           SetupEnvironmentTask,
+                                                           VerifySitesTask,
+                                                           RefillVolumePoolTask))
+
+    def test_plain_adapter_found(self):
+        gsm = component.getGlobalSiteManager()
+        gsm.registerAdapter(_PlainAdapterTask, (ICeleryApp,), IApplicationTask)
+        try:
+            assert_that(_bindable_tasks(), is_not(has_item(_PlainAdapterTask)))
+            record_adapter_tasks(gsm)
+            assert_that(_bindable_tasks(), has_item(_PlainAdapterTask))
+            # Recorded once, with the directive's tasks left alone
+            record_adapter_tasks(gsm)
+            assert_that(_bindable_tasks(), has_length(9))
+        finally:
+            gsm.unregisterAdapter(_PlainAdapterTask, (ICeleryApp,), IApplicationTask)
+            del _task_factories[IApplicationTask]
+
+    def test_adapter_registered(self):
+        app = configure_celery(settings={'celery.broker_url': 'memory://',
+                                         'celery.backend_url': 'cache+memory://'})
+        assert_that(component.getAdapter(app, IDNSMappingTask), is_(MockAddDNSMappingTask))
+        assert_that(app.conf.task_routes, has_entries('mock_add_dns_mapping', {'queue': 'dns', 'routing_key': 'dns'},
+                                                      'mock_provision_env', {'queue': 'any_host', 'routing_key': 'any_host'}))
@@ -0,0 +1,73 @@
+"""
+Timing of the individual phases of an environment setup.
+
+Each task that does part of a setup measures its phases with a
+`PhaseTimer`, which emits a statsd timer for each phase as it is
+recorded and can be returned from the task so the setup pipeline can
+collect every phase on the SiteInfo.
+"""
+
+import socket
+import time
+
+from contextlib import contextmanager
+
+from perfmetrics import statsd_client
+
+logger = __import__('logging').getLogger(__name__)
+
+_METRIC_PREFIX = 'environments.setup.phase'
+
+
+def hostname():
+    return socket.gethostname()
+
+
+def _metric_safe(name):
+    # statsd uses the dot as a path separator
+    return str(name).replace('.', '_')
+
+
+def emit_phase_timing(phase, seconds, host=None):
+    """
+    Emit a statsd timer for `seconds` spent in `phase` on `host`,
+    which defaults to this host, as
+    `environments.setup.phase.<phase>.<host>`.
+    """
+    statsd = statsd_client()
+    if statsd is None:
+        return
+
+    statsd.timing('%s.%s.%s' % (_METRIC_PREFIX, phase, _metric_safe(host or hostname())),
+                  seconds * 1000)
+
+
+class PhaseTimer(object):
+    """
+    Times the phases of the work done by one task. `started_at` is
+    the wall clock time the timer was created, which lets the caller
+    work out how long the task sat in the queue.
+
+    Only phases that complete are recorded, a phase that raises is
+    not, so failures and retries don't skew the percentiles.
+    """
+
+    def __init__(self, host=None):
+        self.host = host or hostname()
+        self.started_at = time.time()
+        self.timings = {}
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        yield
+        self.record(name, time.perf_counter() - start)
+
+    def record(self, name, seconds):
+        self.timings[name] = self.timings.get(name, 0) + seconds
+        emit_phase_timing(name, seconds, self.host)
+
+    def as_dict(self):
+        return {'host': self.host,
+                'started_at': self.started_at,
+                'phases': dict(self.timings)}
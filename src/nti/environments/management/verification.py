@@ -0,0 +1,149 @@
+"""
+Verification of many sites at once using asyncio.
+"""
+
+import asyncio
+import random
+
+import aiohttp
+
+from zope import interface
+
+from .interfaces import ISiteVerificationTask
+
+from .tasks import AbstractTask
+from .tasks import SiteVerificationException
+from .tasks import SiteVerificationTimeout
+from .tasks import _ping_url
+
+logger = __import__('logging').getLogger(__name__)
+
+#: Status codes that suggest the site isn't up yet, rather than broken
+_RETRIABLE_STATUS = (404, 503)
+
+
+class _RetriableVerificationError(Exception):
+    """
+    The site isn't ready yet, but may be if we try again.
+    """
+
+
+class AsyncSiteVerifier(object):
+    """
+    Verifies sites are accessible by pinging them, like `_do_verify_site`,
+    but checks all pending sites concurrently over a shared pool of kept
+    alive connections. Each site is retried with exponential backoff
+    and full jitter, so a batch of sites coming up together doesn't
+    hammer tier1 in lockstep.
+
+    Connection errors, timeouts, 404s and 503s are retried, as are
+    responses whose body is truncated or isn't a json object, like a
+    proxy's error page or a dataserver that is still starting. Any
+    other http error, or a site that answers as the wrong site, fails
+    verification immediately.
+    """
+
+    def __init__(self, timeout=2, tries=30, base_delay=0.5, max_delay=10,
+                 max_connections=100, url_factory=_ping_url):
+        self.timeout = timeout
+        self.tries = tries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_connections = max_connections
+        self.url_factory = url_factory
+
+    def _backoff(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    async def _ping(self, session, url, site_info):
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        try:
+            async with session.get(url, timeout=timeout) as resp:
+                if resp.status in _RETRIABLE_STATUS:
+                    raise _RetriableVerificationError('%s returned %i' % (url, resp.status))
+                if resp.status >= 400:
+                    raise SiteVerificationException('Unable to verify site. %s returned %i'
+                                                    % (url, resp.status))
+                pong = await resp.json(content_type=None)
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+            raise _RetriableVerificationError('Unable to connect to %s. %r' % (url, e))
+        except (aiohttp.ClientPayloadError, ValueError) as e:
+            raise _RetriableVerificationError('Unable to read response from %s. %r' % (url, e))
+
+        if not isinstance(pong, dict):
+            raise _RetriableVerificationError('%s returned %r' % (url, pong))
+
+        pinged_site = pong.get('Site', None)
+        if pinged_site != site_info.site_id.lower():
+            raise SiteVerificationException('Site verification error. Expected site %s but found %s'
+                                            % (site_info.site_id, pinged_site))
+        return pong
+
+    async def verify(self, session, site_info):
+        """
+        Verify a single site using session, returning True or raising
+        a SiteVerificationException.
+        """
+        url = self.url_factory(site_info)
+        last_exception = None
+        for attempt in range(self.tries):
+            if attempt:
+                await asyncio.sleep(self._backoff(attempt - 1))
+            try:
+                pong = await self._ping(session, url, site_info)
+            except _RetriableVerificationError as e:
+                logger.debug('Site %s not yet verified. %s', site_info.site_id, e)
+                last_exception = e
+                continue
+            site_info.ds_site_id = pong['Site']
+            return True
+
+        if last_exception is not None:
+            raise SiteVerificationException('Unable to verify site. %s' % last_exception)
+        raise SiteVerificationTimeout()
+
+    async def verify_all(self, site_infos):
+        """
+        Verify all of site_infos concurrently. Returns a list with,
+        for each site, True or the SiteVerificationException it failed with.
+        """
+        connector = aiohttp.TCPConnector(limit=self.max_connections)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            return await asyncio.gather(*[self.verify(session, site_info) for site_info in site_infos],
+                                        return_exceptions=True)
+
+    def verify_sites(self, site_infos):
+        return asyncio.run(self.verify_all(site_infos))
+
+
+def verify_sites(task, site_infos, **options):
+    """
+    Verify a batch of SiteInfo objects, returning a list of dicts describing
+    the outcome for each site.
+    """
+    logger.info('Verifying %i site(s)', len(site_infos))
+    results = AsyncSiteVerifier(**options).verify_sites(site_infos)
+
+    outcomes = []
+    for site_info, result in zip(site_infos, results):
+        if isinstance(result, BaseException) and not isinstance(result, SiteVerificationException):
+            raise result
+        verified = result is True
+        if not verified:
+            logger.warning('Unable to verify site %s. %s', site_info.site_id, result)
+        outcomes.append({'site_id': site_info.site_id,
+                         'dns_name': site_info.dns_name,
+                         'ds_site_id': site_info.ds_site_id,
+                         'verified': verified,
+                         'error': None if verified else str(result)})
+    return outcomes
+
+
+@interface.implementer(ISiteVerificationTask)
+class VerifySitesTask(AbstractTask):
+
+    NAME = 'verify_sites'
+    TC = verify_sites
+
+    def __call__(self, site_infos, **options):
+        return self.task.apply_async((list(site_infos),), options)
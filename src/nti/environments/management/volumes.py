@@ -0,0 +1,195 @@
+"""
+A warm pool of pod data volumes.
+
+Creating a data volume means allocating the image, formatting it and
+copying the dataserver into it, none of which depends on the site.
+Each host keeps a pool of volumes that have already been through all
+that, so provisioning only has to claim one and render the site's
+configuration.
+"""
+
+import os
+import uuid
+import fcntl
+import shutil
+import tempfile
+import subprocess
+
+from perfmetrics import statsd_client
+
+from zope import component
+from zope import interface
+
+from .config import settings_sections
+
+from .interfaces import ISettings
+from .interfaces import IVolumePool
+from .interfaces import IRefillVolumePoolTask
+
+from .pod import _copy_tree
+from .pod import _DEFAULT_SKELETON
+from .pod import _DEFAULT_VOLUMES_DIR
+from .pod import _DEFAULT_VOLUME_SIZE
+
+from .placement import host_queue
+
+from .tasks import AbstractTask
+
+from .timing import hostname
+from .timing import _metric_safe
+
+logger = __import__('logging').getLogger(__name__)
+
+_READY_PREFIX = 'ready-'
+_BUILDING_PREFIX = '.building-'
+_SUFFIX = '.img'
+
+_DEFAULT_LOW_WATERMARK = 2
+
+
+@interface.implementer(IVolumePool)
+class WarmVolumePool(object):
+    """
+    Keeps up to `size` ready volumes in `pool_dir`, which must be on
+    the same filesystem as the volumes it is claimed into, so a claim
+    is a single atomic rename. Two environments can't claim the same
+    volume; whoever renames it second finds it gone and tries the next.
+
+    Volumes are built under a hidden name and only renamed to a ready
+    name once complete, so a crash mid build never leaves a partial
+    volume in the pool.
+    """
+
+    def __init__(self, pool_dir, size, low_watermark=_DEFAULT_LOW_WATERMARK,
+                 skeleton=_DEFAULT_SKELETON, volume_size=_DEFAULT_VOLUME_SIZE):
+        self.pool_dir = pool_dir
+        self.size = size
+        self.low_watermark = min(low_watermark, size)
+        self.skeleton = skeleton
+        self.volume_size = volume_size
+
+    def _ready(self):
+        try:
+            names = os.listdir(self.pool_dir)
+        except FileNotFoundError:
+            return []
+        return sorted(name for name in names
+                      if name.startswith(_READY_PREFIX) and name.endswith(_SUFFIX))
+
+    def depth(self):
+        return len(self._ready())
+
+    def claim(self, target):
+        for name in self._ready():
+            try:
+                os.rename(os.path.join(self.pool_dir, name), target)
+            except FileNotFoundError:
+                # Someone else claimed it first
+                continue
+            logger.info('Claimed warm volume %s as %s', name, target)
+            self._emit('claimed')
+            return True
+
+        if self.size:
+            logger.warning('Volume pool %s is empty', self.pool_dir)
+        self._emit('missed')
+        return False
+
+    def needs_refill(self):
+        return self.size > 0 and self.depth() < self.low_watermark
+
+    def refill(self):
+        """
+        Build volumes until the pool is full. Only one refill runs at a
+        time on a host, if another is already under way we return 0
+        immediately.
+        """
+        os.makedirs(self.pool_dir, exist_ok=True)
+        with open(os.path.join(self.pool_dir, '.refill.lock'), 'w') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                logger.info('Volume pool %s is already being refilled', self.pool_dir)
+                return 0
+
+            built = 0
+            while self.depth() < self.size:
+                self._build()
+                built += 1
+                self._emit()
+            logger.info('Built %i volume(s) for pool %s', built, self.pool_dir)
+            return built
+
+    def _build(self):
+        building = os.path.join(self.pool_dir, _BUILDING_PREFIX + uuid.uuid4().hex + _SUFFIX)
+        try:
+            with open(building, 'x') as f:
+                f.truncate(self.volume_size * 1024 ** 3)
+            self._format(building)
+            self._seed(building)
+            os.rename(building, os.path.join(self.pool_dir,
+                                             _READY_PREFIX + os.path.basename(building)[len(_BUILDING_PREFIX):]))
+        except BaseException:
+            if os.path.exists(building):
+                os.unlink(building)
+            raise
+
+    def _run(self, *args):
+        subprocess.run(args, check=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+    def _format(self, path):
+        self._run('mkfs.xfs', '-q', path)
+
+    def _seed(self, path):
+        mountpoint = tempfile.mkdtemp(prefix='.mnt-', dir=self.pool_dir)
+        try:
+            self._run('mount', '-o', 'loop', path, mountpoint)
+            try:
+                _copy_tree(self.skeleton, os.path.join(mountpoint, 'dataserver'))
+            finally:
+                self._run('umount', mountpoint)
+        finally:
+            shutil.rmtree(mountpoint, ignore_errors=True)
+
+    def _emit(self, event=None):
+        statsd = statsd_client()
+        if statsd is None:
+            return
+
+        host = _metric_safe(hostname())
+        if event:
+            statsd.incr('environments.volume_pool.%s.%s' % (event, host))
+        statsd.gauge('environments.volume_pool.depth.%s' % host, self.depth())
+
+
+@settings_sections('pods', 'volume_pool')
+def _volume_pool_factory():
+    settings = component.getUtility(ISettings)
+    volumes_dir = settings.get('pods', 'volumes_dir', fallback=_DEFAULT_VOLUMES_DIR)
+    return WarmVolumePool(settings.get('volume_pool', 'pool_dir', fallback=os.path.join(volumes_dir, 'pool')),
+                          settings.getint('volume_pool', 'size', fallback=0),
+                          settings.getint('volume_pool', 'low_watermark', fallback=_DEFAULT_LOW_WATERMARK),
+                          settings.get('pods', 'dataserver_skeleton', fallback=_DEFAULT_SKELETON),
+                          settings.getint('pods', 'volume_size', fallback=_DEFAULT_VOLUME_SIZE))
+
+
+def refill_volume_pool(task):
+    return component.getUtility(IVolumePool).refill()
+
+
+@interface.implementer(IRefillVolumePoolTask)
+class RefillVolumePoolTask(AbstractTask):
+    """
+    Refills the pool of whichever host picks up the task. Refills are
+    idempotent, a host whose pool is already full does nothing. Given a
+    host, the task is routed to that host's queue.
+    """
+
+    NAME = 'refill_volume_pool'
+    TC = refill_volume_pool
+    QUEUE = 'any_host'
+
+    def __call__(self, host=None):
+        if host is None:
+            return self.task.apply_async()
+        return self.task.apply_async(queue=host_queue(host))
@@ -1,24 +1,47 @@
 """
 Establishes a celery application that acts as the worker.
 
-This module can be passed as the -A argument of the 
-`celery worker` command.
+This module can be passed as the -A argument of the
+`celery worker` command. Nothing is configured when it is imported,
+the settings, statsd client and zcml are loaded the first time the app
+is asked for, either by celery looking up our `app` attribute or by
+calling `get_app`. Celery looks the app up before it starts the pool,
+so prefork children inherit the configured app rather than repeating
+the work.
 """
 
-from configparser import ConfigParser
+import atexit
+import os
+import threading
+
+from celery.signals import task_prerun
+from celery.signals import worker_init
+from celery.signals import worker_process_shutdown
+from celery.signals import worker_ready
+from celery.signals import worker_shutdown
 
 from perfmetrics import set_statsd_client
 
-import os
+from . import latency
+
+from .backlog import backlog_sampler
 
 from .celery import configure_celery
+
 from .config import configure_settings
 from .config import is_devmode
+from .config import settings_reloader
 
-from .interfaces import ISettings
+from .metrics import BufferedStatsdClient
+from .metrics import statsd_client_from_settings
+
+from .placement import capacity_publisher
+
+from .prometheus import metrics_server
+
+from .zcml import record_adapter_tasks
 
 from zope import component
-from zope import interface
 
 from zope.component.hooks import setHooks
 
@@ -27,32 +50,123 @@ from zope.configuration import xmlconfig
 
 from zope.dottedname import resolve as dottedname
 
-# TODO the worker loads a module for it's setup
-# So we load the zcml we want here. How can we make sure this
-# only happens in the context of spinning up the worker?
-# Doing it at import time is really nasty....
-
-setHooks()
-
-# Load and register our settings first
-config = configure_settings()
-
-if config.has_option('statsd', 'statsd_uri'):
-    uri = config.get('statsd', 'statsd_uri')
-    set_statsd_client(uri)
-
-context = zconfig.ConfigurationMachine()
-
-if is_devmode(config):
-    context.provideFeature('devmode')
-
-xmlconfig.registerCommonDirectives(context)
-
-xmlconfig.file('configure.zcml',
-               context=context,
-               package=dottedname.resolve('nti.environments.management'))
-
-app = configure_celery(settings=config['celery'])
-
-app.finalize()
-
+logger = __import__('logging').getLogger(__name__)
+
+_app = None
+_lock = threading.Lock()
+
+
+def _reset_lock():
+    # A thread that held the lock when we forked doesn't exist in
+    # the child, so it would never be released.
+    global _lock
+    _lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_reset_lock)
+
+
+def configure_worker():
+    """
+    Load and register our settings, the statsd client and our zcml,
+    returning the settings.
+    """
+    setHooks()
+
+    # Load and register our settings first
+    config = configure_settings()
+
+    statsd = statsd_client_from_settings(config)
+    if statsd is not None:
+        set_statsd_client(statsd)
+        if isinstance(statsd, BufferedStatsdClient):
+            _flush_on_shutdown(statsd)
+
+    context = zconfig.ConfigurationMachine()
+
+    if is_devmode(config):
+        context.provideFeature('devmode')
+
+    xmlconfig.registerCommonDirectives(context)
+
+    xmlconfig.file('configure.zcml',
+                   context=context,
+                   package=dottedname.resolve('nti.environments.management'))
+    record_adapter_tasks(component.getGlobalSiteManager())
+
+    # Pick up settings changes between tasks
+    reloader = settings_reloader(config)
+    if reloader is not None:
+        task_prerun.connect(reloader.check, weak=False)
+    return config
+
+
+def _flush_on_shutdown(statsd):
+    # Prefork children exit without running atexit handlers, but do
+    # send worker_process_shutdown
+    flush = lambda *args, **kwargs: statsd.flush()
+    worker_process_shutdown.connect(flush, weak=False)
+    worker_shutdown.connect(flush, weak=False)
+    atexit.register(statsd.flush)
+
+
+def _connect_backlog_sampler(app, config):
+    # Only the worker's main process samples, not its pool or a cli
+    sampler = backlog_sampler(app, config)
+    if sampler is not None:
+        worker_ready.connect(lambda sender, **kwargs: sampler.start(), weak=False)
+        worker_shutdown.connect(lambda sender, **kwargs: sampler.stop(), weak=False)
+
+
+def _connect_capacity_publisher(app, config):
+    # Only hosts that take environments publish their capacity
+    publisher = capacity_publisher(app, config)
+    if publisher is None:
+        return
+    def _start(sender, **kwargs):
+        if 'any_host' in sender.app.amqp.queues.consume_from:
+            publisher.start()
+    worker_ready.connect(_start, weak=False)
+    worker_shutdown.connect(lambda sender, **kwargs: publisher.stop(), weak=False)
+
+
+def _connect_metrics_server(config):
+    # Only a worker collects metrics, not a cli using the app. The
+    # registry is made by the main process before the pool's children
+    # are forked, so they inherit it.
+    def _init(sender, **kwargs):
+        server = metrics_server(config)
+        if server is None:
+            return
+        # So the latency command sees the histograms of the pool's children
+        server.registry.extras[latency.SNAPSHOT_KEY] = latency.histograms.snapshot
+        worker_ready.connect(lambda sender, **kwargs: server.start(), weak=False)
+        worker_shutdown.connect(lambda sender, **kwargs: server.stop(), weak=False)
+        # Children write what they have left before exiting
+        worker_process_shutdown.connect(lambda *args, **kwargs: server.registry.stop(), weak=False)
+    worker_init.connect(_init, weak=False)
+
+
+def get_app():
+    """
+    Returns the finalized worker app, configuring the worker the first
+    time it is called.
+    """
+    global _app
+    if _app is None:
+        with _lock:
+            if _app is None:
+                config = configure_worker()
+                app = configure_celery(settings=config['celery'])
+                app.finalize()
+                _connect_backlog_sampler(app, config)
+                _connect_capacity_publisher(app, config)
+                _connect_metrics_server(config)
+                logger.info('Configured worker app in process %i', os.getpid())
+                _app = app
+    return _app
+
+
+def __getattr__(name):
+    if name == 'app':
+        return get_app()
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
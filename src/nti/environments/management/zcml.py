@@ -0,0 +1,81 @@
+"""
+ZCML directives.
+"""
+
+from zope import interface
+
+from zope.component.zcml import adapter
+
+from zope.configuration.fields import GlobalInterface
+from zope.configuration.fields import GlobalObject
+
+from .interfaces import IApplicationTask
+from .interfaces import ICeleryApp
+
+logger = __import__('logging').getLogger(__name__)
+
+#: The task factories registered with the task directive, by the
+#: interface they provide, in registration order.
+_task_factories = {}
+
+
+class ITaskDirective(interface.Interface):
+    """
+    Register an IApplicationTask factory as an adapter of the
+    ICeleryApp and record it so the celery app can route and bind it
+    without searching the component registry.
+    """
+
+    factory = GlobalObject(title='The task factory',
+                           required=True)
+
+    provides = GlobalInterface(title='The IApplicationTask the factory provides',
+                               required=True)
+
+
+def register_task_factory(factory, provides):
+    _task_factories[provides] = factory
+
+
+def task_factories():
+    """
+    Returns the task factories registered with the task directive.
+    """
+    return list(_task_factories.values())
+
+
+def record_adapter_tasks(registry):
+    """
+    Record the IApplicationTask factories registered with a plain
+    `<adapter>` rather than the task directive, warning about each, so
+    they are still routed and bound. This searches every adapter
+    registration, so it is done once, after our zcml is loaded.
+    """
+    recorded = set(_task_factories.values())
+    for registration in registry.registeredAdapters():
+        if registration.provided.isOrExtends(IApplicationTask) \
+           and getattr(registration.factory, 'bind', None) \
+           and registration.factory not in recorded:
+            logger.warning('Task %s is registered as an adapter for %s. Register it with '
+                           '<environments:task> instead.',
+                           registration.factory, registration.provided.__identifier__)
+            _task_factories.setdefault(registration.provided, registration.factory)
+            recorded.add(registration.factory)
+
+
+def _clear():
+    _task_factories.clear()
+
+try:
+    from zope.testing.cleanup import addCleanUp
+except ImportError: # pragma: no cover
+    pass
+else:
+    addCleanUp(_clear)
+
+
+def task(_context, factory, provides):
+    adapter(_context, [factory], provides=provides, for_=[ICeleryApp])
+    _context.action(discriminator=('environments:task', provides),
+                    callable=register_task_factory,
+                    args=(factory, provides))